@@ -0,0 +1,299 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import time
+
+try:
+    import asyncio
+    HAS_ASYNCIO = True
+except ImportError:
+    try:
+        import trollius as asyncio
+        HAS_ASYNCIO = True
+    except ImportError:
+        HAS_ASYNCIO = False
+
+from peerz.crypto import CRYPTO_WORKERS
+from peerz.engine import Engine
+from peerz.routing import RoutingZone
+from peerz import transaction, transport
+
+# seconds between runs of the engine's periodic work
+HOUSEKEEPING_INTERVAL = 1.0
+# milliseconds before transactions without a max_duration time out
+TX_TIMEOUT = 5000
+# milliseconds before finished transactions are forgotten
+TX_EXPIRY = 30000
+
+class TimedTxMap(transaction.TxMap):
+    """
+    Transactions each timed out, and later forgotten, by timers of
+    their own on an event loop rather than by polling.
+    """
+    def __init__(self, loop, timeout=TX_TIMEOUT, expiry=TX_EXPIRY):
+        """
+        Create a new, empty map.
+        @param loop: Event loop to run the timers on
+        @param timeout: Milliseconds before transactions without a
+        max_duration time out
+        @param expiry: Milliseconds before transactions are forgotten
+        """
+        super(TimedTxMap, self).__init__()
+        self.loop = loop
+        self.default_timeout = timeout
+        self.expiry = expiry
+
+    def create(self, clazz, msg, engine, *args, **kwargs):
+        txid = super(TimedTxMap, self).create(clazz, msg, engine,
+                                              *args, **kwargs)
+        tx = self.transactions[txid]
+        duration = getattr(tx, 'max_duration', self.default_timeout)
+        self.loop.call_later(duration / 1000.0, self._timeout, txid, tx)
+        self.loop.call_later(self.expiry / 1000.0, self._expire, txid, tx)
+        return txid
+
+    def _timeout(self, txid, tx):
+        if self.transactions.get(txid) is not tx:
+            return
+        if not tx.is_complete():
+            tx.timeout()
+        # let waiters know when the transaction ended without a reply
+        callback = getattr(tx, 'callback', None)
+        if hasattr(callback, 'timeout'):
+            callback.timeout()
+
+    def _expire(self, txid, tx):
+        if self.transactions.get(txid) is tx:
+            del self.transactions[txid]
+
+class FutureReply(object):
+    """
+    Resolves a future with the decoded reply to a client api command.
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def __call__(self, msg=None, flags=0):
+        if self.future.done():
+            return
+        if msg:
+            msg = json.loads(msg)
+        else:
+            msg = None
+        self.future.set_result(msg)
+
+    def timeout(self):
+        if not self.future.done():
+            self.future.set_exception(asyncio.TimeoutError())
+
+class AsyncEngine(Engine):
+    """
+    Engine run by an asyncio (or trollius) event loop instead of a
+    thread of its own.  Datagrams are read as they arrive, paced
+    fragments, requests for missing fragments and transactions each
+    have their own timers, leaving only housekeeping on a periodic
+    tick.  Client api commands return futures of their replies, e.g.
+    with trollius:
+
+        engine = AsyncEngine(seeds, storage)
+        node = yield From(engine.join())
+        nodes = yield From(engine.find_nodes(target_id))
+    """
+    def __init__(self, seeds=None, storage=None, routing_table=RoutingZone,
+                 crypto_workers=CRYPTO_WORKERS, loop=None):
+        """
+        Create a new engine on an event loop, ready to join().
+        @param loop: Event loop to run on, the current one if None
+        Other arguments are as for Engine.setup().
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.listening = False
+        self.flush_handle = None
+        self.flush_due = None
+        self.nack_handle = None
+        self.setup(None, None, seeds, storage, routing_table, crypto_workers)
+        self.tick_handle = self.loop.call_later(HOUSEKEEPING_INTERVAL,
+                                                self._tick)
+
+    def new_txmap(self):
+        """
+        @return: Empty map of transactions, each with its own timers
+        """
+        return TimedTxMap(self.loop)
+
+    def listen(self):
+        """
+        Start reading datagrams from the socket as they arrive.
+        """
+        if self.listening:
+            return
+        self.udpserver.setblocking(False)
+        self.loop.add_reader(self.udpserver.fileno(), self._readable)
+        self.listening = True
+
+    def stop(self):
+        self.close()
+
+    def close(self):
+        """
+        Stop reading datagrams and cancel all timers, persisting state.
+        """
+        if self.shutdown:
+            return
+        self.shutdown = True
+        if self.listening:
+            self.loop.remove_reader(self.udpserver.fileno())
+            self.listening = False
+        for handle in (self.tick_handle, self.flush_handle, self.nack_handle):
+            if handle:
+                handle.cancel()
+        self._dump_state()
+        self.crypto.close()
+        self.udpserver.close()
+
+    def rearm(self):
+        """
+        Arm timers for the next paced fragments due and, while messages
+        are being reassembled, requests for missing fragments.
+        """
+        if self.shutdown:
+            return
+        due = self.scheduler.next_send()
+        if due and (self.flush_handle is None or due < self.flush_due):
+            if self.flush_handle:
+                self.flush_handle.cancel()
+            self.flush_due = due
+            self.flush_handle = self.loop.call_later(max(0, due - time.time()),
+                                                     self._flush)
+        if self.defrag.map and self.nack_handle is None:
+            self.nack_handle = self.loop.call_later(transport.NACK_IDLE,
+                                                    self._nack)
+
+    def _readable(self):
+        self.recv_external()
+        self.rearm()
+
+    def _flush(self):
+        self.flush_handle = None
+        try:
+            self.scheduler.flush()
+        except Exception, ex:
+            print 'Warning: %s... ignoring' % str(ex)
+        self.rearm()
+
+    def _nack(self):
+        self.nack_handle = None
+        self.send_nacks()
+        self.rearm()
+
+    def _tick(self):
+        self.tick_handle = self.loop.call_later(HOUSEKEEPING_INTERVAL,
+                                                self._tick)
+        self.housekeeping()
+        self.rearm()
+
+    def request(self, command, *args):
+        """
+        Run a client api command.
+        @param command: Name of the command, as sent by api.Network
+        @param args: Arguments of the command
+        @return: Future of the decoded reply.  It fails with
+        TimeoutError if a transaction times out without replying, and
+        with ValueError if the command is not known.
+        """
+        future = asyncio.Future(loop=self.loop)
+        if not self.handle_command(command, list(args), FutureReply(future)):
+            future.set_exception(ValueError('Invalid Command'))
+        elif self.shutdown and not future.done():
+            future.set_result(None)
+        self.rearm()
+        return future
+
+    def get_local(self):
+        """
+        @return: Future of the node that represents the local node
+        """
+        return self.request('NODE')
+
+    def get_peers(self):
+        """
+        @return: Future of the list of all known active nodes
+        """
+        return self.request('PEERS')
+
+    def get_stats(self):
+        """
+        @return: Future of the counters of the packet path
+        """
+        return self.request('STATS')
+
+    def join(self, node_id='', secret_key=''):
+        """
+        Connect this node into the network and start node discovery.
+        @param node_id: Curve public key to reset to
+        @param secret_key: Curve private key to reset to
+        @return: Future of the local node
+        """
+        return self.request('START', node_id, secret_key)
+
+    def leave(self):
+        """
+        Leave the network, closing the engine.
+        @return: Future done once closed
+        """
+        return self.request('STOP')
+
+    def publish(self, key, content, context='default'):
+        """
+        Publish the object content into the network.
+        @return: Future of the nodes stored to
+        """
+        return self.request('STOR', key, content, context)
+
+    def unpublish(self, key, context='default'):
+        """
+        Stop publishing the given object into the network.
+        @return: Future done once removed
+        """
+        return self.request('REMV', key, context)
+
+    def get_published(self):
+        """
+        @return: Future of the objects published by the local node
+        """
+        return self.request('PUBL')
+
+    def get_hashtable(self):
+        """
+        @return: Future of all known published objects
+        """
+        return self.request('HASH')
+
+    def fetch(self, key, context='default'):
+        """
+        Retrieve the given object from the network.
+        @return: Future of the object's content, None if not available
+        """
+        return self.request('FVAL', key, context)
+
+    def find_nodes(self, target_id):
+        """
+        Recursively find the nodes closest to target_id.
+        @param target_id: Id, z85 encoded, to find the closest nodes to
+        @return: Future of the list of nodes
+        """
+        return self.request('FNOD', target_id)
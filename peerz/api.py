@@ -20,6 +20,7 @@ import logging
 import zmq
 
 from peerz import engine, utils
+from peerz.routing import RoutingZone
 
 LOG = logging.Logger(__name__)
 
@@ -29,15 +30,18 @@ class Network(object):
     a nodes connection into the p2p network.
     """
 
-    def __init__(self, seeds, storage):
+    def __init__(self, seeds, storage, routing_table=RoutingZone):
         """
         Creates a new (not yet connected) network object.
 
         :param seeds: Default list of seeds (in host:port:id format) to connect
         :param storage: Filesystem path to root of local storage.
+        :param routing_table: Routing table implementation, either
+                              RoutingZone or RoutingTable.
         """
         ctx = zmq.Context()
-        self.engine = utils.Actor(ctx, engine.Engine, seeds, storage)
+        self.engine = utils.Actor(ctx, engine.Engine, seeds, storage,
+                                  routing_table=routing_table)
 
     def get_local(self):
         """
@@ -53,6 +57,14 @@ class Network(object):
         self.engine.send_unicode("PEERS")
         return json.loads(self.engine.recv())
 
+    def get_stats(self):
+        """
+        :return: Counters of the packet path, including queries dropped
+                 by admission control.
+        """
+        self.engine.send_unicode("STATS")
+        return json.loads(self.engine.recv())
+
     def reset(self, node_id='', secret_key=''):
         """
         Remove any existing state and reset as a new node.
@@ -0,0 +1,514 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import hashlib
+import hmac
+from multiprocessing.pool import ThreadPool
+import os
+import struct
+import time
+
+try:
+    from nacl.bindings import crypto_secretbox, crypto_secretbox_open
+    import nacl.utils
+    from nacl.exceptions import CryptoError
+    from nacl.public import PublicKey, Box
+    HAS_NACL = True
+except ImportError:
+    HAS_NACL = False
+
+    class CryptoError(Exception):
+        pass
+
+class UnknownSession(CryptoError):
+    """
+    Packet from a session the receiver did not issue, or has dropped.
+    """
+
+# maximum number of peers with a precomputed box
+BOX_CACHE_SIZE = 1024
+
+# session id and packet counter, the counter forms the nonce
+SESSION_HEADER = struct.Struct('!4sQ')
+# zero padded packet counter
+SESSION_NONCE = struct.Struct('!16xQ')
+# session id and the time, in milliseconds, the receiver issued it
+SESSION_OFFER = struct.Struct('!4sQ')
+# counters behind the highest seen that are still accepted
+REPLAY_WINDOW = 64
+# seconds a receiver accepts packets in a session it issued, senders
+# use a session for half of this, receivers offer a new one once half
+# has passed
+SESSION_LIFETIME = 3600
+# packets a sender numbers in a session
+SESSION_MAX_PACKETS = 2 ** 32
+# seconds between offers to a peer that seems to have lost its session
+SESSION_REOFFER = 1.0
+
+# crypto worker threads, crypto runs on the engine thread if 0
+CRYPTO_WORKERS = 0
+# smallest batch worth handing to the workers
+CRYPTO_MIN_BATCH = 4
+
+class BoxCache(object):
+    """
+    Least recently used cache of Boxes for peers.
+    Creating a Box computes the Curve25519 shared key with the peer,
+    by far the most expensive step of encrypting a packet, so boxes are
+    kept for the peers in use rather than created per packet.
+    """
+    def __init__(self, secret_key, maxsize=BOX_CACHE_SIZE):
+        """
+        Create a new, empty cache.
+        @param secret_key: PrivateKey of the local node
+        @param maxsize: Maximum number of cached boxes
+        """
+        self.secret_key = secret_key
+        self.maxsize = maxsize
+        self.boxes = OrderedDict() # peer id -> Box, least recent first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, peer_id):
+        """
+        @param peer_id: Public key of the peer
+        @return: Box shared with the peer
+        """
+        box = self.boxes.pop(peer_id, None)
+        if box is None:
+            self.misses += 1
+            box = Box(self.secret_key, PublicKey(peer_id))
+            if len(self.boxes) >= self.maxsize:
+                self.boxes.popitem(last=False)
+        else:
+            self.hits += 1
+        self.boxes[peer_id] = box
+        return box
+
+    def discard(self, peer_id):
+        """
+        Drop the box of a peer that has left the routing table.
+        @param peer_id: Public key of the peer
+        """
+        self.boxes.pop(peer_id, None)
+
+    def encrypt(self, peer_id, msg):
+        """
+        @param peer_id: Public key of the receiving peer
+        @param msg: Plain text
+        @return: Random nonce followed by the cipher text
+        """
+        return self.get(peer_id).encrypt(msg, nacl.utils.random(Box.NONCE_SIZE))
+
+    def decrypt(self, peer_id, msg):
+        """
+        @param peer_id: Public key of the sending peer
+        @param msg: Nonce and cipher text
+        @return: Plain text
+        @raise CryptoError: If the message fails authentication
+        """
+        return self.get(peer_id).decrypt(msg)
+
+    def encrypt_many(self, peer_id, msgs, pool=None):
+        """
+        @param peer_id: Public key of the receiving peer
+        @param msgs: List of plain texts
+        @param pool: CryptoPool to encrypt on, inline if None
+        @return: List of encrypted messages, in order
+        """
+        box = self.get(peer_id)
+        seal = lambda x: box.encrypt(x, nacl.utils.random(Box.NONCE_SIZE))
+        if pool:
+            return pool.map(seal, msgs)
+        return map(seal, msgs)
+
+    def stats(self):
+        """
+        @return: Dict of cache counters
+        """
+        return {'boxes': len(self.boxes),
+                'hits': self.hits,
+                'misses': self.misses}
+
+class ReplayWindow(object):
+    """
+    Sliding window of packet counters seen, rejecting repeats and
+    counters too far behind the highest seen.
+    """
+    __slots__ = ['size', 'highest', 'seen']
+
+    def __init__(self, size=REPLAY_WINDOW):
+        """
+        @param size: Counters behind the highest seen still accepted
+        """
+        self.size = size
+        self.highest = -1
+        self.seen = 0 # bit n set if highest - n has been seen
+
+    def check(self, counter):
+        """
+        @param counter: Packet counter
+        @return: True if the counter has not been seen and is recent
+        enough to be accepted
+        """
+        if counter > self.highest:
+            return True
+        offset = self.highest - counter
+        return offset < self.size and not self.seen & (1 << offset)
+
+    def update(self, counter):
+        """
+        Record a counter, only once its packet has been authenticated.
+        @param counter: Packet counter
+        """
+        if counter > self.highest:
+            shift = counter - self.highest
+            self.seen = shift < self.size and (self.seen << shift) | 1 or 1
+            self.seen &= (1 << self.size) - 1
+            self.highest = counter
+        else:
+            self.seen |= 1 << (self.highest - counter)
+
+class SessionCache(object):
+    """
+    Symmetric sessions with peers, encrypting with XSalsa20-Poly1305
+    (SecretBox) under a key derived from the Curve25519 shared key
+    rather than a Box per packet.  Receivers pick the session ids and
+    offer them to senders, in Box encrypted messages, so packets of a
+    session the receiver has not issued, has dropped or has expired
+    are rejected rather than starting a fresh replay window.  Senders
+    number their packets, the session id and counter are sent in place
+    of a random nonce and receivers reject counters already seen.
+    """
+    def __init__(self, boxes, maxsize=BOX_CACHE_SIZE,
+                 lifetime=SESSION_LIFETIME, max_packets=SESSION_MAX_PACKETS,
+                 reoffer=SESSION_REOFFER):
+        """
+        Create a new, empty cache.
+        @param boxes: BoxCache providing shared keys with peers
+        @param maxsize: Maximum number of sessions in each direction
+        @param lifetime: Seconds packets of an issued session are
+        accepted for
+        @param max_packets: Packets sent in a session before it is
+        no longer used
+        @param reoffer: Seconds between offers to a peer that seems to
+        have lost its session
+        """
+        self.boxes = boxes
+        self.node_id = str(boxes.secret_key.public_key)
+        self.maxsize = maxsize
+        self.lifetime = lifetime
+        self.max_packets = max_packets
+        self.reoffer = reoffer
+        self.outbound = OrderedDict() # peer id -> [session id, key, counter, expiry]
+        self.inbound = OrderedDict() # (peer id, session id) -> (key, ReplayWindow, expiry)
+        self.offered = OrderedDict() # peer id -> time a session was last issued
+        self.adopted = OrderedDict() # peer id -> issue time of the newest offer taken
+        self.replays = 0
+        self.unknown = 0
+
+    def _key(self, peer_id, sender_id, session_id):
+        """
+        @return: Key for packets from sender_id in the session
+        """
+        shared = self.boxes.get(peer_id).shared_key()
+        return hmac.new(shared, sender_id + session_id, hashlib.sha256).digest()
+
+    def offer(self, peer_id, lost=False, now=None):
+        """
+        Issue a new session for a peer to send in, if it is due one.
+        @param peer_id: Public key of the sending peer
+        @param lost: Whether the peer seems to have lost its session
+        @param now: Current time, for testing
+        @return: Offer of the new session to send to the peer, None if
+        it is not due one
+        """
+        if now is None:
+            now = time.time()
+        last = self.offered.get(peer_id)
+        if last is not None and now - last < self.lifetime / 2.0 and \
+                (not lost or now - last < self.reoffer):
+            return None
+        session_id = os.urandom(SESSION_HEADER.size - 8)
+        index = (peer_id, session_id)
+        if len(self.inbound) >= self.maxsize:
+            self.inbound.popitem(last=False)
+        self.inbound[index] = (self._key(peer_id, peer_id, session_id),
+                               ReplayWindow(), now + self.lifetime)
+        self.offered.pop(peer_id, None)
+        if len(self.offered) >= self.maxsize:
+            self.offered.popitem(last=False)
+        self.offered[peer_id] = now
+        return SESSION_OFFER.pack(session_id, int(now * 1000))
+
+    def adopt(self, peer_id, offer, now=None):
+        """
+        Send to a peer in a session it has offered.  Only offers issued
+        after the last one taken from the peer, and within half a
+        lifetime, are taken, so a replayed offer never restarts the
+        packet counter of a session key already used.
+        @param peer_id: Public key of the receiving peer
+        @param offer: Offer from the peer's offer()
+        @param now: Current time, for testing
+        @raise CryptoError: If the offer is malformed or stale
+        """
+        if len(offer) != SESSION_OFFER.size:
+            raise CryptoError('Invalid session offer')
+        session_id, issued = SESSION_OFFER.unpack(offer)
+        issued /= 1000.0
+        if now is None:
+            now = time.time()
+        oldest = now - self.lifetime / 2.0
+        # offers this old are refused anyway, no need to remember them
+        while self.adopted and next(self.adopted.itervalues()) < oldest:
+            self.adopted.popitem(last=False)
+        last = self.adopted.get(peer_id)
+        if issued < oldest or (last is not None and issued <= last):
+            raise CryptoError('Stale session offer')
+        if last is None and len(self.adopted) >= self.maxsize:
+            raise CryptoError('Too many session offers')
+        self.adopted.pop(peer_id, None)
+        self.adopted[peer_id] = issued
+        self.outbound.pop(peer_id, None)
+        if len(self.outbound) >= self.maxsize:
+            self.outbound.popitem(last=False)
+        self.outbound[peer_id] = [session_id,
+                                  self._key(peer_id, self.node_id, session_id),
+                                  0, now + self.lifetime / 2.0]
+
+    def has_session(self, peer_id, now=None):
+        """
+        @param peer_id: Public key of the receiving peer
+        @param now: Current time, for testing
+        @return: True if packets to the peer can be sent in a session
+        """
+        session = self.outbound.get(peer_id)
+        if session is None:
+            return False
+        if now is None:
+            now = time.time()
+        return session[2] < self.max_packets and session[3] > now
+
+    def forget(self, peer_id):
+        """
+        Stop sending to a peer in its session, e.g. when it stops
+        answering, until it offers another.
+        @param peer_id: Public key of the receiving peer
+        """
+        self.outbound.pop(peer_id, None)
+
+    def reserve(self, peer_id, count=1):
+        """
+        Number packets to a peer in its session.
+        @param peer_id: Public key of the receiving peer
+        @param count: Number of packets
+        @return: Tuple of session id, key and the first counter
+        @raise CryptoError: If there is no session with the peer
+        """
+        session = self.outbound.get(peer_id)
+        if session is None:
+            raise CryptoError('No session with peer')
+        session_id, key, counter, _ = session
+        session[2] += count
+        return session_id, key, counter
+
+    def encrypt(self, peer_id, msg):
+        """
+        @param peer_id: Public key of the receiving peer
+        @param msg: Plain text
+        @return: Session header followed by the cipher text
+        """
+        return seal(msg, *self.reserve(peer_id))
+
+    def encrypt_many(self, peer_id, msgs, pool=None):
+        """
+        @param peer_id: Public key of the receiving peer
+        @param msgs: List of plain texts
+        @param pool: CryptoPool to encrypt on, inline if None
+        @return: List of encrypted messages, in order
+        """
+        session_id, key, counter = self.reserve(peer_id, len(msgs))
+        jobs = [ (x, session_id, key, counter + i) for i, x in enumerate(msgs) ]
+        if pool:
+            return pool.map(_seal, jobs)
+        return map(_seal, jobs)
+
+    def _session(self, index, now=None):
+        session = self.inbound.get(index)
+        if session is None:
+            self.unknown += 1
+            raise UnknownSession('Unknown session')
+        if now is None:
+            now = time.time()
+        if session[2] <= now:
+            del self.inbound[index]
+            self.unknown += 1
+            raise UnknownSession('Expired session')
+        return session
+
+    def open(self, peer_id, msg, now=None):
+        """
+        First step of decrypting a packet, finding its session and
+        checking its counter has not been seen.
+        @param peer_id: Public key of the sending peer
+        @param msg: Session header and cipher text
+        @param now: Current time, for testing
+        @return: Ticket for unseal() and accept()
+        @raise UnknownSession: If the session was not issued to the
+        peer or has expired
+        @raise CryptoError: If the message is truncated or a replay
+        """
+        if len(msg) < SESSION_HEADER.size:
+            raise CryptoError('Truncated session packet')
+        session_id, counter = SESSION_HEADER.unpack_from(msg)
+        index = (peer_id, session_id)
+        session = self._session(index, now)
+        if not session[1].check(counter):
+            self.replays += 1
+            raise CryptoError('Replayed session packet')
+        return index, session, counter, msg
+
+    def accept(self, ticket, now=None):
+        """
+        Last step of decrypting a packet, once authenticated, recording
+        its counter.
+        @param ticket: Ticket from open()
+        @param now: Current time, for testing
+        @raise CryptoError: If the counter has been seen since open(),
+        or the session dropped
+        """
+        index, _, counter, _ = ticket
+        session = self._session(index, now)
+        window = session[1]
+        if not window.check(counter):
+            self.replays += 1
+            raise CryptoError('Replayed session packet')
+        window.update(counter)
+        del self.inbound[index]
+        self.inbound[index] = session
+
+    def decrypt(self, peer_id, msg, now=None):
+        """
+        @param peer_id: Public key of the sending peer
+        @param msg: Session header and cipher text
+        @param now: Current time, for testing
+        @return: Plain text
+        @raise CryptoError: If the message fails authentication, is
+        a replay or from an unknown session
+        """
+        ticket = self.open(peer_id, msg, now)
+        plain = unseal(ticket)
+        # only authenticated packets are remembered
+        self.accept(ticket, now)
+        return plain
+
+    def discard(self, peer_id):
+        """
+        Drop the sessions of a peer that has left the routing table,
+        its packets in them are no longer accepted.
+        @param peer_id: Public key of the peer
+        """
+        self.outbound.pop(peer_id, None)
+        self.offered.pop(peer_id, None)
+        for key in [ x for x in self.inbound if x[0] == peer_id ]:
+            del self.inbound[key]
+
+    def stats(self):
+        """
+        @return: Dict of session counters
+        """
+        return {'outbound': len(self.outbound),
+                'inbound': len(self.inbound),
+                'replays': self.replays,
+                'unknown': self.unknown}
+
+def seal(msg, session_id, key, counter):
+    """
+    @return: Session header followed by the cipher text of msg
+    """
+    return SESSION_HEADER.pack(session_id, counter) + \
+        crypto_secretbox(msg, SESSION_NONCE.pack(counter), key)
+
+def _seal(job):
+    return seal(*job)
+
+def unseal(ticket):
+    """
+    Decrypt a packet opened with SessionCache.open(), safe to call on
+    any thread.
+    @param ticket: Ticket from open()
+    @return: Plain text
+    @raise CryptoError: If the message fails authentication
+    """
+    _, session, counter, msg = ticket
+    return crypto_secretbox_open(msg[SESSION_HEADER.size:],
+                                 SESSION_NONCE.pack(counter), session[0])
+
+def _attempt(job):
+    func, arg = job
+    try:
+        return True, func(arg)
+    except Exception, ex:
+        return False, ex
+
+class CryptoPool(object):
+    """
+    Runs batches of independent crypto operations on worker threads,
+    libsodium releasing the GIL while it works, returning results in
+    the order given.  Batches smaller than min_batch, or any batch
+    without workers, run inline on the calling thread.
+    """
+    def __init__(self, workers=CRYPTO_WORKERS, min_batch=CRYPTO_MIN_BATCH):
+        """
+        Create a new pool.
+        @param workers: Number of worker threads, none if 0
+        @param min_batch: Smallest batch handed to the workers
+        """
+        self.workers = workers
+        self.min_batch = min_batch
+        self.pool = workers and ThreadPool(workers) or None
+
+    def map(self, func, items):
+        """
+        @param func: Function to apply, safe to call on any thread
+        @param items: List of arguments
+        @return: List of results, in order
+        """
+        if not self.pool or len(items) < self.min_batch:
+            return map(func, items)
+        # a few chunks per worker keeps them busy without a
+        # handoff per item
+        chunksize = max(1, len(items) // (self.workers * 2))
+        return self.pool.map(func, items, chunksize)
+
+    def attempt(self, jobs):
+        """
+        Apply functions that may fail, without one failure losing the
+        rest of the batch.
+        @param jobs: List of (function, argument) tuples
+        @return: List of (True, result) or (False, exception), in order
+        """
+        return self.map(_attempt, jobs)
+
+    def close(self):
+        """
+        Stop the worker threads.
+        """
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
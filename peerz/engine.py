@@ -14,14 +14,14 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import json
 import socket
 import tempfile
 import time
 
 try:
-    import nacl.utils
-    from nacl.public import PrivateKey, PublicKey, Box
+    from nacl.public import PrivateKey
     HAS_NACL = True
 except ImportError:
     HAS_NACL = False
@@ -30,6 +30,8 @@ except ImportError:
 import zmq
 from zmq.utils import z85
 
+from peerz.crypto import BoxCache, CryptoPool, SessionCache, CRYPTO_WORKERS
+from peerz.crypto import unseal, UnknownSession
 from peerz.persistence import LocalStorage
 from peerz.routing import Node, RoutingZone
 from peerz import transport, transaction
@@ -41,12 +43,44 @@ A = 3
 # number of comms fails to node before evicting from node tree
 MAX_NODE_FAILS = 2
 BASE_PORT = 7111
+# largest datagram read, a jumbo frame
+RECV_BUFFER_SIZE = 9216
+# datagrams handled per wakeup
+RECV_BUDGET = 64
+# non-blocking reads of further datagrams, where supported
+RECV_NOWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
 
 class Engine(object):
 
-    def __init__(self, ctx, pipe, seeds=None, storage=None, *args, **kwargs):
+    def __init__(self, ctx, pipe, seeds=None, storage=None,
+                 routing_table=RoutingZone, crypto_workers=CRYPTO_WORKERS,
+                 *args, **kwargs):
+        """
+        Create and run the engine (blocks until stopped).
+        @param ctx: ZMQ context
+        @param pipe: Actor pipe to the client api
+        Other arguments are as for setup().
+        """
+        self.setup(ctx, pipe, seeds, storage, routing_table, crypto_workers)
+        self.run()
+
+    def setup(self, ctx, pipe, seeds=None, storage=None,
+              routing_table=RoutingZone, crypto_workers=CRYPTO_WORKERS):
+        """
+        Bind the socket and load or create the local node, leaving the
+        engine ready to run.
+        @param ctx: ZMQ context
+        @param pipe: Actor pipe to the client api
+        @param seeds: List of seeds in addr:port:id format
+        @param storage: Filesystem path to root of local storage
+        @param routing_table: Routing table implementation to use,
+        RoutingZone (tree) or RoutingTable (flat bucket array).
+        @param crypto_workers: Threads to encrypt and decrypt batches of
+        fragments on, crypto runs on the engine thread if 0
+        """
         self.ctx = ctx
         self.pipe = pipe
+        self.routing_table = routing_table
         if seeds:
             self.seeds = seeds
         else:
@@ -58,9 +92,16 @@ class Engine(object):
         self.bindport = self.port
         self.bindaddr = ''
         self.udpserver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        transport.set_dont_fragment(self.udpserver)
+        self.writer = transport.PacketWriter(self.udpserver)
+        self.scheduler = transport.SendScheduler(self.writer)
+        self.recv_pool = [ bytearray(RECV_BUFFER_SIZE) for _ in xrange(RECV_BUDGET) ]
+        self.crypto = CryptoPool(crypto_workers)
         self.registry = dict([(id, val(self)) for id, val in messaging.registry.items()])
         self.defrag = transport.DefragMap()
-        self.txmap = transaction.TxMap()
+        self.retransmit = transport.RetransmitCache()
+        self.admission = transport.AdmissionControl()
+        self.txmap = self.new_txmap()
         self.node = None
         # TODO need to think about this better.. what happens if bindaddr is invalid??
         # how do we flag error back to client if terminal?
@@ -83,14 +124,12 @@ class Engine(object):
             self.reset()
         if HAS_NACL:
             self.secret_key = PrivateKey(self.node.secret_key)
+            self.boxes = BoxCache(self.secret_key)
+            self.sessions = SessionCache(self.boxes)
             self.secure = True
         else:
             self.secure = False
-
-        self.poller = zmq.Poller()
-        self.poller.register(self.pipe, zmq.POLLIN)
         self.shutdown = False
-        self.run()
 
     def reset(self, public_key=None, secret_key=None):
         """
@@ -111,14 +150,27 @@ class Engine(object):
         self.hashtabe = {}
         if HAS_NACL:
             self.secret_key = PrivateKey(self.node.secret_key)
-        self.nodetree = RoutingZone(self.node.node_id)
+            self.boxes = BoxCache(self.secret_key)
+            self.sessions = SessionCache(self.boxes)
+        self.nodetree = self.routing_table(self.node.node_id)
         # ensure we exist in own tree
         self.nodetree.add(self.node)
-        self.txmap = transaction.TxMap()
+        self.txmap = self.new_txmap()
         self.defrag = transport.DefragMap()
+        self.retransmit = transport.RetransmitCache()
+        self.admission = transport.AdmissionControl()
+        self.scheduler = transport.SendScheduler(self.writer)
         self._dump_state()
 
+    def new_txmap(self):
+        """
+        @return: Empty map of transactions, timed out by polling
+        """
+        return transaction.TxMap()
+
     def run(self):
+        self.poller = zmq.Poller()
+        self.poller.register(self.pipe, zmq.POLLIN)
         # Signal actor successfully initialized
         self.signal_api()
 
@@ -127,29 +179,60 @@ class Engine(object):
             timeout = next_timeout - time.time()
             if timeout < 0:
                 timeout = 0
+            if self.defrag.map:
+                # wake to request fragments that have not arrived
+                timeout = min(timeout, transport.NACK_IDLE)
+            next_send = self.scheduler.next_send()
+            if next_send:
+                timeout = max(0, min(timeout, next_send - time.time()))
             items = dict(self.poller.poll(timeout * 1000))
 
             if self.pipe in items and items[self.pipe] == zmq.POLLIN:
                 self.recv_api()
             if self.udpserver.fileno() in items and items[self.udpserver.fileno()] == zmq.POLLIN:
                 self.recv_external()
-            self._dump_state()
+            if self.defrag.map:
+                self.send_nacks()
+            try:
+                self.scheduler.flush()
+            except Exception, ex:
+                print 'Warning: %s... ignoring' % str(ex)
             
             if next_timeout <= time.time():
                 next_timeout += 1.0
                 self.txmap.timeout(5000)
                 self.txmap.expire(30000)
-                for x in self.registry.values():
-                    x.trigger_events()
+                self.housekeeping()
+        self._dump_state()
+        self.crypto.close()
+
+    def housekeeping(self):
+        """
+        Periodic work, once a second: persist state, expire what has
+        aged out and let messaging contexts run their events.
+        """
+        self._dump_state()
+        self.defrag.expire()
+        self.retransmit.expire()
+        self.scheduler.expire()
+        self.admission.expire()
+        for x in self.registry.values():
+            x.trigger_events()
 
     def start(self, node_id, secret_key=None):
         if node_id:
             self.reset(node_id, secret_key)
-        self.poller.register(self.udpserver.fileno(), zmq.POLLIN)
+        self.listen()
         for endpoint in self.seeds:
             addr, port, id = endpoint.split(':', 2)
             self.nodetree.add(Node(addr, int(port), z85.decode(id)))
 
+    def listen(self):
+        """
+        Start reading datagrams from the socket.
+        """
+        self.poller.register(self.udpserver.fileno(), zmq.POLLIN)
+
     def send_api_node(self, node, hasmore=False):
         self.send_api(json.dumps(node.to_json()))
         
@@ -159,28 +242,46 @@ class Engine(object):
     def recv_api(self):
         request = self.pipe.recv_multipart()
         command = request.pop(0).decode('UTF-8')
+        if not self.handle_command(command, request, self.send_api):
+            self.send_api('Invalid Command')  # placeholder, what should error handling look like from client
+
+    def handle_command(self, command, request, reply):
+        """
+        Run a client api command.
+        @param command: Name of the command
+        @param request: List of the command's arguments
+        @param reply: Function called with the JSON reply, if any, once
+        the command completes
+        @return: False if the command is not known
+        """
         if command == 'START':
             self.start(request.pop(0).decode('UTF-8'),
                        request.pop(0).decode('UTF-8'))
-            self.send_api_node(self.node)
+            reply(json.dumps(self.node.to_json()))
         elif command == 'STOP':
             self.stop()
         elif command == 'RESET':
             self.reset(request.pop(0).decode('UTF-8'),
                        request.pop(0).decode('UTF-8'))
-            self.send_api_node(self.node)
+            reply(json.dumps(self.node.to_json()))
         elif command == 'NODE':
-            self.send_api_node(self.node)
+            reply(json.dumps(self.node.to_json()))
         elif command == 'PEERS':
             filtered_nodes = [ x for x in self.nodetree.get_all_nodes()
                               if x.node_id != self.node.node_id ]
-            self.send_api(json.dumps([ x.to_json() for x in filtered_nodes]))
+            reply(json.dumps([ x.to_json() for x in filtered_nodes]))
+        elif command == 'STATS':
+            reply(json.dumps({'admission': self.admission.stats(),
+                              'defrag': self.defrag.stats(),
+                              'retransmit': self.retransmit.stats(),
+                              'scheduler': self.scheduler.stats()}))
         else:
             for x in messaging.registry.values():
                 if x.has_command(command):
-                    self.txmap.create(x.state_table[command], request, self, callback=self.send_api)
-                    return
-            self.send_api('Invalid Command')  # placeholder, what should error handling look like from client
+                    self.txmap.create(x.state_table[command], request, self, callback=reply)
+                    return True
+            return False
+        return True
 
     def send_api(self, msg, flags=0):
         self.pipe.send(msg, flags=flags)
@@ -189,54 +290,187 @@ class Engine(object):
         self.pipe.signal()
 
     def encrypt(self, peer_id, msg):
-        nonce = nacl.utils.random(Box.NONCE_SIZE)
-        box = Box(self.secret_key, PublicKey(peer_id))
-        return box.encrypt(msg, nonce)
+        return self.boxes.encrypt(peer_id, msg)
 
     def decrypt(self, peer_id, msg):
-        box = Box(self.secret_key, PublicKey(peer_id))
-        return box.decrypt(msg)
+        return self.boxes.decrypt(peer_id, msg)
+
+    def remove_peer(self, node):
+        """
+        Remove a node from the routing table along with its crypto
+        state.
+        @param node: Node to remove
+        """
+        self.nodetree.remove(node)
+        if self.secure:
+            self.boxes.discard(node.node_id)
+            self.sessions.discard(node.node_id)
 
     def verify_peer(self, addr, port, node_id):
         # IP filter/blacklisting...
         # public key whitelisting?
         
         node = self.nodetree.get_node_by_id(node_id)
+        if not node:
+            # keep history of nodes waiting in the replacement caches
+            node = self.nodetree.get_candidate_by_id(node_id)
         # same node?
         if node and node.address == addr and node.port == port:
             return node
         # exists but external address has changed
         elif node:
-            node.address = addr
-            node.port = port
+            self.nodetree.update_address(node, addr, port)
             return node
         return Node(addr, port, node_id)
 
     def recv_external(self):
+        """
+        Receive and handle pending datagrams, up to RECV_BUDGET per call,
+        read into a pool of reusable buffers.
+        """
+        batch = []
+        flags = 0
+        while len(batch) < RECV_BUDGET:
+            buf = self.recv_pool[len(batch)]
+            try:
+                size, addr = self.udpserver.recvfrom_into(buf, 0, flags)
+            except socket.error, ex:
+                if ex.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    print 'Warning: %s... ignoring' % str(ex)
+                break
+            batch.append((memoryview(buf)[:size], addr))
+            if not RECV_NOWAIT:
+                break
+            # only the first read is known not to block
+            flags = RECV_NOWAIT
+        self.handle_datagrams(batch)
+
+    def handle_datagram(self, data, addr):
+        """
+        Parse and dispatch a received datagram.
+        @param data: Datagram contents, a view of a receive buffer
+        @param addr: Tuple of sender address and port
+        """
+        self.handle_datagrams([(data, addr)])
+
+    def handle_datagrams(self, batch):
+        """
+        Parse, decrypt and dispatch a batch of received datagrams.
+        Encrypted payloads of the batch are decrypted together, on the
+        crypto workers if there are any, then dispatched in order.
+        @param batch: List of (datagram contents, sender address)
+        """
+        packets = []
+        jobs = []
+        for data, addr in batch:
+            try:
+                p = transport.Packet()
+                p.unpack(data)
+                # peers flooding queries are ignored for a while
+                if self.admission.blocked(p.node_id):
+                    continue
+                option = p.mode & transport.OPTION_MASK
+                ticket = None
+                if option == transport.OPTION_CURVE:
+                    jobs.append((self.boxes.get(p.node_id).decrypt,
+                                 p.payload.tobytes()))
+                elif option == transport.OPTION_SESSION:
+                    ticket = self.sessions.open(p.node_id, p.payload.tobytes())
+                    jobs.append((unseal, ticket))
+                packets.append((p, addr, option, ticket))
+            except UnknownSession, ex:
+                self.session_lost(p.node_id, addr)
+                print 'Warning: %s... ignoring' % str(ex)
+            except Exception, ex:
+                print 'Warning: %s... ignoring' % str(ex)
+        results = iter(self.crypto.attempt(jobs))
+        for p, addr, option, ticket in packets:
+            if option in (transport.OPTION_CURVE, transport.OPTION_SESSION):
+                ok, result = next(results)
+                try:
+                    if not ok:
+                        raise result
+                    if ticket:
+                        # only authenticated packets are remembered
+                        self.sessions.accept(ticket)
+                except UnknownSession, ex:
+                    self.session_lost(p.node_id, addr)
+                    print 'Warning: %s... ignoring' % str(ex)
+                    continue
+                except Exception, ex:
+                    print 'Warning: %s... ignoring' % str(ex)
+                    continue
+                p.payload = result
+            self.handle_packet(p, addr)
+
+    def handle_packet(self, p, addr):
+        """
+        Dispatch a received packet once decrypted.
+        @param p: Packet with a plain text payload
+        @param addr: Tuple of sender address and port
+        """
         try:
-            data, addr = self.udpserver.recvfrom(2048)
-            p = transport.Packet()
-            p.unpack(data)
-            if p.mode == 0x02:
-                p.payload = self.decrypt(p.node_id, p.payload)
+            version = 0
+            if p.mode & transport.HEADER_V1:
+                version = transport.PAYLOAD_V1
             data = transport.Payload()
-            data.unpack(p.payload)
+            data.unpack(p.payload, version)
             peer = self.verify_peer(addr[0], addr[1], p.node_id)
-            msg = self.defrag.get_msg(data.txid, data.fragment, data.lastfrag, data.content)
+            # packets in the baseline format do not unlearn features
+            if p.mode & transport.FEATURE_MASK:
+                peer.features = p.mode & transport.FEATURE_MASK
+            option = p.mode & transport.OPTION_MASK
+            if data.msgtype == transport.MSG_SESSION:
+                # offers are only taken from the peer's own key
+                if self.secure and option == transport.OPTION_CURVE:
+                    self.sessions.adopt(peer.node_id,
+                                        str(bytearray(data.content)))
+                return
+            if self.secure and option != transport.OPTION_PLAIN:
+                # peers still sending a Box per packet are missing one
+                self.offer_session(peer,
+                                   lost=option == transport.OPTION_CURVE)
+            if data.msgtype == transport.MSG_FEATURES:
+                peer.features = bytearray(data.content[:1] or '\0')[0] & \
+                    transport.FEATURE_MASK
+                # so the message sent after it is answered in kind
+                self.nodetree.add(peer)
+                return
+            if data.msgtype == transport.MSG_NACK:
+                self.handle_nack(peer, data.txid, data.content)
+                return
+            if data.msgtype == transport.MSG_ACK:
+                self.handle_ack(peer, data.txid, data.content)
+                return
+            msg = self.defrag.get_msg(data.txid, data.fragment, data.lastfrag,
+                                      data.content, peer.node_id,
+                                      fragsize=data.fragsize, address=addr,
+                                      features=peer.features)
             # TODO need messaging id?
             if msg != None:
+                # receive buffers are reused, handlers get their own copy
+                if isinstance(msg, memoryview):
+                    msg = msg.tobytes()
+                if (data.msgtype & ~transport.COMPRESSED) % 2 == 1 and \
+                        not self.admission.admit(peer.node_id):
+                    return
+                if data.lastfrag and \
+                        peer.features & transport.FEATURE_PAYLOAD_V1:
+                    self._send(peer, data.txid, transport.MSG_ACK,
+                               transport.ACK_HEADER.pack(data.lastfrag))
+                msgtype, msg = transport.decompress(data.msgtype, msg)
                 self.nodetree.add(peer)
                 # if is peer request...
-                if data.msgtype % 2 == 1:
+                if msgtype % 2 == 1:
                     peer.query_in()
-                    for x in messaging.registry.values():
-                        if x.has_message(data.msgtype):
-                            x(self).handle_peer(peer, data.txid, data.msgtype, data.content)
+                    for x in self.registry.values():
+                        if x.has_message(msgtype):
+                            x.handle_peer(peer, data.txid, msgtype, msg)
                 else:
                     peer.response_in()
                     tx = self.txmap.get(data.txid)
                     if tx:
-                        tx.handle_response(peer, data.txid, data.msgtype, data.content)
+                        tx.handle_response(peer, data.txid, msgtype, msg)
                     
         except Exception, ex:
             print ex
@@ -244,20 +478,153 @@ class Engine(object):
             #traceback.print_exc()
             print 'Warning: %s... ignoring' % str(ex)
 
-    def send_external(self, node, txid, mtype, content=b''):
+    def handle_nack(self, peer, txid, content):
+        """
+        Resend the fragments a peer has asked for, if the message is
+        still in the retransmit cache.
+        @param peer: Node requesting the fragments
+        @param txid: Transaction id of the message
+        @param content: Packed fragment numbers
+        """
+        entry = self.retransmit.get(peer.node_id, txid)
+        # fragments still waiting to be paced out have not been lost
+        missing = set(transport.unpack_nack(content)) - \
+            self.scheduler.pending(peer.node_id, txid)
+        if entry and missing:
+            self.scheduler.loss(peer.node_id)
+            mtype, msg, fragsize = entry
+            self._send(peer, txid, mtype, msg, fragsize, missing, paced=True)
+
+    def handle_ack(self, peer, txid, content):
+        """
+        A peer has received all of a fragmented message.
+        @param peer: Node acknowledging the message
+        @param txid: Transaction id of the message
+        @param content: Number of the last fragment of the message
+        """
+        lastfrag, = transport.ACK_HEADER.unpack_from(content)
+        self.scheduler.ack(peer.node_id, lastfrag + 1)
+        self.retransmit.discard(peer.node_id, txid)
+
+    def offer_session(self, peer, lost=False):
+        """
+        Offer a peer supporting sessions a new session to send to us
+        in, if it is due one.
+        @param peer: Node that sent an authenticated packet
+        @param lost: Whether the peer seems to have lost its session
+        """
+        if not peer.features & transport.FEATURE_SESSION:
+            return
+        offer = self.sessions.offer(peer.node_id, lost)
+        if offer:
+            self._send(peer, self.txmap.next_txid(), transport.MSG_SESSION,
+                       offer)
+
+    def session_lost(self, node_id, addr):
+        """
+        A peer sent a packet in a session we have not issued or have
+        dropped, e.g. after a restart, offer it another.  Only peers in
+        the routing table at the packet's address are offered one, the
+        packet itself is not authenticated.
+        @param node_id: Id the packet claims to be from
+        @param addr: Tuple of sender address and port
+        """
+        node = self.nodetree.get_node_by_id(node_id)
+        if node and node.address == addr[0] and node.port == addr[1]:
+            self.offer_session(node, lost=True)
+
+    def send_nacks(self):
+        """
+        Ask peers for the fragments of their messages that have not
+        arrived.  Only peers supporting the version 1 payload header
+        answer these requests.
+        """
+        for peer_id, addr, txid, missing, features in self.defrag.gaps():
+            if not addr:
+                continue
+            node = self.verify_peer(addr[0], addr[1], peer_id)
+            # peers on first contact are not in the routing table yet,
+            # use the features they sent with the message
+            if not node.features:
+                node.features = features
+            if node.features & transport.FEATURE_PAYLOAD_V1:
+                self._send(node, txid, transport.MSG_NACK,
+                           transport.pack_nack(missing))
+
+    def send_external(self, node, txid, mtype, content=b'', fragsize=None,
+                      compress=True):
+        """
+        Send a message to a peer.
+        @param node: Destination node
+        @param txid: Transaction id of the message
+        @param mtype: Message type
+        @param content: Message content
+        @param fragsize: Fragment size, defaults to the size probed for
+        peers supporting the version 1 payload header
+        @param compress: Compress the content if the peer supports it
+        """
         if mtype % 2 == 0:
             node.response_out()
         else:
             node.query_out()
-        payload = transport.Payload()
-        payload.pack(txid, mtype, content)
-        for x in payload.fragments:
-            if self.secure:
-                x = self.encrypt(node.node_id, x)
-            p = transport.Packet()
-            p.pack(x, self.node.node_id, self.secure and 0x02 or 0x01)
-            self.udpserver.sendto(p.msg, (node.address, node.port))
+        if compress:
+            mtype, content = transport.compress(mtype, content, node.features)
+        fragsize = fragsize or node.max_fragment
+        if self._send(node, txid, mtype, content, fragsize,
+                      paced=True) > 1 and \
+                node.features & transport.FEATURE_PAYLOAD_V1:
+            # kept to answer requests for lost fragments
+            self.retransmit.add(node.node_id, txid, mtype, content, fragsize)
 
+    def _send(self, node, txid, mtype, content=b'', fragsize=None,
+              fragments=None, paced=False):
+        """
+        Fragment, encrypt if secure and send a message as is.
+        Peers that have offered us a session are sent SecretBox packets
+        in it, others, and offers of sessions, a Box per packet.
+        Peers that acknowledge fragmented messages are sent them at the
+        pace of their congestion window when paced is set.
+        Peers that have not advertised any features get the baseline
+        format, preceded the first time by our features.
+        @return: Number of fragments sent or queued
+        """
+        encrypt = None
+        mode = transport.OPTION_PLAIN
+        if self.secure and node.failures:
+            # the peer may have dropped its session, fall back until
+            # it offers another
+            self.sessions.forget(node.node_id)
+        if self.secure and node.features & transport.FEATURE_SESSION and \
+                mtype != transport.MSG_SESSION and \
+                self.sessions.has_session(node.node_id):
+            encrypt = lambda x: self.sessions.encrypt_many(node.node_id, x,
+                                                           self.crypto)
+            mode = transport.OPTION_SESSION
+        elif self.secure:
+            encrypt = lambda x: self.boxes.encrypt_many(node.node_id, x,
+                                                        self.crypto)
+            mode = transport.OPTION_CURVE
+        features = transport.FEATURES
+        if self.secure:
+            features |= transport.FEATURE_SESSION
+        if node.features:
+            mode |= features
+        elif not node.advertised:
+            node.advertised = True
+            self.writer.send((node.address, node.port), self.node.node_id,
+                             mode, txid, transport.MSG_FEATURES,
+                             chr(features), encrypt)
+        version = 0
+        if node.features & transport.FEATURE_PAYLOAD_V1:
+            mode |= transport.HEADER_V1
+            version = transport.PAYLOAD_V1
+            if paced:
+                return self.scheduler.send(node, self.node.node_id, mode,
+                                           txid, mtype, content, encrypt,
+                                           fragsize, version, fragments)
+        return self.writer.send((node.address, node.port), self.node.node_id,
+                                mode, txid, mtype, content, encrypt, fragsize,
+                                version, fragments)
 
     def _dump_state(self):
         """
@@ -271,6 +638,15 @@ class Engine(object):
         Reload any persisted state.
         """
         self.nodetree = self.localstore.fetch('nodetree')
+        if self.nodetree and \
+                (not isinstance(self.nodetree, self.routing_table) or
+                 not hasattr(self.nodetree, 'index')):
+            # persisted with another implementation or an older version
+            # without node indexes, migrate nodes across
+            previous = self.nodetree
+            self.nodetree = self.routing_table(previous.node_id)
+            for x in previous.get_all_nodes():
+                self.nodetree.add(x)
         if self.nodetree:
             self.node = self.nodetree.get_node_by_id(self.nodetree.node_id)
         self.hashtable = self.localstore.fetch('hashtable') or {}
@@ -0,0 +1,210 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import cPickle
+import json
+import random
+import resource
+import subprocess
+import sys
+import time
+
+from peerz.examples.largetree import build_tree
+from peerz.routing import B, K, generate_random, Node, RoutingTable, RoutingZone
+
+# node counts covered by the suite
+SUITE_SIZES = [1000, 10000, 100000, 1000000]
+# maximum calls timed per operation
+SUITE_SAMPLES = 10000
+TABLES = {'zone': RoutingZone, 'table': RoutingTable}
+
+def bench_lookup(count=10000, binsize=1024, lookups=2000, table=RoutingZone):
+    """
+    Time closest_to() lookups and add() calls on a tree of count nodes.
+    @return: Dict of per operation costs in microseconds
+    """
+    nodetree, nodes = build_tree(count, binsize, B, table)
+    targets = [ generate_random() for _ in xrange(lookups) ]
+    start = time.time()
+    for x in targets:
+        nodetree.closest_to(x)
+    lookup = (time.time() - start) / lookups
+    start = time.time()
+    for x in nodes:
+        nodetree.get_node_by_id(x.node_id)
+    by_id = (time.time() - start) / len(nodes)
+    fresh = table(nodes[0].node_id, binsize=binsize)
+    start = time.time()
+    for x in nodes:
+        fresh.add(x)
+    insert = (time.time() - start) / len(nodes)
+    return {'nodes': float(len(nodetree.get_all_nodes())),
+            'closest_to_us': lookup * 1e6,
+            'get_node_by_id_us': by_id * 1e6,
+            'add_us': insert * 1e6}
+
+def bench_nodes(count=100000):
+    """
+    Time construction, pickling and memory use of count nodes.
+    Run in a fresh process as memory is taken from peak RSS.
+    @return: Dict of costs in microseconds/bytes per node
+    """
+    ids = [ generate_random() for _ in xrange(count) ]
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    nodes = [ Node('10.0.0.1', 7111, x) for x in ids ]
+    construct = (time.time() - start) / count
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    data = cPickle.dumps(nodes, cPickle.HIGHEST_PROTOCOL)
+    dump = (time.time() - start) / count
+    start = time.time()
+    cPickle.loads(data)
+    load = (time.time() - start) / count
+    return {'nodes': float(count),
+            'construct_us': construct * 1e6,
+            'pickle_us': dump * 1e6,
+            'unpickle_us': load * 1e6,
+            'bytes_per_node': (after - before) * 1024.0 / count}
+
+def _rate(f, args):
+    """
+    @return: Calls of f per second over each of the supplied arguments
+    """
+    start = time.time()
+    for x in args:
+        f(x)
+    return len(args) / max(time.time() - start, 1e-9)
+
+def peak_rss():
+    """
+    @return: Peak resident memory of this process in bytes
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def suite_binsize(count, bdepth=B):
+    """
+    @return: Smallest power of two bin size, at least K, with room
+    for count random nodes in a table allowing bdepth extra depth
+    """
+    binsize = K
+    while binsize << (bdepth - 1) < count:
+        binsize <<= 1
+    return binsize
+
+def bench_suite(count, table=RoutingZone, binsize=None, samples=SUITE_SAMPLES):
+    """
+    Measure the throughput of routing table operations on a table
+    of count random nodes.
+    Run in a fresh process as memory is taken from peak RSS.
+    @param count: Number of synthetic nodes
+    @param table: Routing table implementation to measure
+    @param binsize: Max size of routing bins, defaults to one holding
+    all count nodes
+    @param samples: Maximum calls timed per operation
+    @return: Dict of operation -> ops/sec along with node counts
+    and peak memory use.  Nodes beyond the table's capacity only
+    reach the replacement caches, see 'active' for those held.
+    """
+    binsize = binsize or suite_binsize(count)
+    node = Node('a', 0, generate_random())
+    nodes = [ Node('b', x, generate_random()) for x in xrange(1, count) ]
+    nodetree = table(node.node_id, bdepth=B, binsize=binsize)
+    nodetree.add(node)
+    results = {'add': _rate(nodetree.add, nodes)}
+    present = nodetree.get_all_nodes()
+    picked = random.sample(present, min(samples, len(present)))
+    targets = [ generate_random() for _ in xrange(min(samples, count)) ]
+    results['closest_to'] = _rate(nodetree.closest_to, targets)
+    results['get_node_by_id'] = _rate(nodetree.get_node_by_id,
+                                      [ x.node_id for x in picked ])
+    results['get_all_nodes'] = _rate(lambda _: nodetree.get_all_nodes(),
+                                     xrange(max(1, min(100, samples * 100 / count))))
+    start = time.time()
+    data = cPickle.dumps(nodetree, cPickle.HIGHEST_PROTOCOL)
+    results['pickle_dump'] = 1 / max(time.time() - start, 1e-9)
+    start = time.time()
+    cPickle.loads(data)
+    results['pickle_load'] = 1 / max(time.time() - start, 1e-9)
+    del data
+    results['remove'] = _rate(nodetree.remove, picked)
+    return {'table': table.__name__,
+            'nodes': count,
+            'active': len(present),
+            'binsize': binsize,
+            'ops_per_sec': results,
+            'peak_rss_bytes': peak_rss()}
+
+def run_suite(sizes=SUITE_SIZES, tables=('zone', 'table'), binsize=None):
+    """
+    Run bench_suite() for each table and size in its own process.
+    @param binsize: Max size of routing bins, defaults to one holding
+    all the nodes of each size
+    @return: List of bench_suite() results
+    """
+    results = []
+    for name in tables:
+        for count in sizes:
+            out = subprocess.check_output([sys.executable, '-m',
+                                           'peerz.examples.benchmark',
+                                           'run', str(count), name,
+                                           str(binsize or 0)])
+            results.append(json.loads(out))
+    return results
+
+if __name__ == '__main__':
+    """
+    Micro-benchmarks for the routing table.
+    Usage: benchmark.py [lookup|nodes] [node count] [bin size]
+           benchmark.py suite [sizes,...] [zone|table,...] [bin size]
+    The suite writes its results as JSON, by default with bins large
+    enough to hold all the nodes of each size.
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        print json.dumps(bench_suite(int(sys.argv[2]), TABLES[sys.argv[3]],
+                                     int(sys.argv[4])))
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'suite':
+        sizes = SUITE_SIZES
+        tables = ('zone', 'table')
+        binsize = None
+        if len(sys.argv) > 2:
+            sizes = [ int(x) for x in sys.argv[2].split(',') ]
+        if len(sys.argv) > 3:
+            tables = sys.argv[3].split(',')
+        if len(sys.argv) > 4:
+            binsize = int(sys.argv[4])
+        print json.dumps(run_suite(sizes, tables, binsize), indent=2,
+                         sort_keys=True)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'nodes':
+        count = 100000
+        if len(sys.argv) > 2:
+            count = int(sys.argv[2])
+        for k, v in sorted(bench_nodes(count).items()):
+            print '%s: %.2f' % (k, v)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'lookup':
+        del sys.argv[1]
+    count = 10000
+    binsize = 1024
+    if len(sys.argv) > 2:
+        binsize = int(sys.argv[2])
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    for table in (RoutingZone, RoutingTable):
+        print table.__name__
+        for k, v in sorted(bench_lookup(count, binsize, table=table).items()):
+            print '  %s: %.2f' % (k, v)
@@ -21,6 +21,23 @@ import webbrowser
 
 from peerz.routing import generate_random, Node, RoutingZone
 
+def build_tree(count, binsize=4, bdepth=4, table=RoutingZone):
+    """
+    Build a routing tree populated with count random nodes.
+    @param count: Number of synthetic nodes to add
+    @param binsize: Max size of routing bins
+    @param bdepth: Extra depth allowed for non-node_id subtrees
+    @param table: Routing table implementation to build
+    @return: Tuple of routing tree and the list of all generated nodes
+    """
+    node = Node('a', 0, generate_random())
+    nodetree = table(node.node_id, bdepth=bdepth, binsize=binsize)
+    nodetree.add(node)
+    nodes = [ Node('b', x, generate_random()) for x in xrange(1, count) ]
+    for x in nodes:
+        nodetree.add(x)
+    return nodetree, nodes
+
 def render_graph(dot):
     with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as tmp:
         data = urllib.urlencode({'cht': 'gv:dot', 'chl': dot})
@@ -31,9 +48,5 @@ def render_graph(dot):
         webbrowser.open_new_tab(tmp.name)
 
 if __name__ == '__main__':
-    node = Node('a', 0, generate_random())
-    nodetree = RoutingZone(node.node_id, bdepth=4, binsize=4)
-    nodetree.add(node)
-    for x in xrange(1, 500):
-        nodetree.add(Node('b', x, generate_random()))
+    nodetree, _ = build_tree(500)
     render_graph(nodetree.visualise())
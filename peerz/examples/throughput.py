@@ -0,0 +1,389 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import json
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import time
+
+import zmq
+
+try:
+    import nacl.utils
+    from nacl.public import PrivateKey, PublicKey, Box
+    HAS_NACL = True
+except ImportError:
+    HAS_NACL = False
+
+from peerz import transport
+from peerz.crypto import BoxCache, CryptoPool, SessionCache
+from peerz.routing import generate_random
+
+# message sizes covered by the loopback harness
+LOOPBACK_SIZES = [0, 64, 1024, 4096, 65536, 262144]
+# bytes sent per size, within the message count limits
+LOOPBACK_BYTES = 16 * 1024 * 1024
+LOOPBACK_MIN_MESSAGES = 200
+LOOPBACK_MAX_MESSAGES = 20000
+
+def send_concat(sock, address, node_id, mode, txid, msgtype, content,
+                encrypt=None):
+    """
+    Original send path, slicing the remaining content and building
+    each datagram by concatenation.
+    """
+    lastfrag = max(0, len(content) - 1) // transport.Payload.MAX_FRAGMENT
+    fragments = []
+    fragment = 0
+    while len(content) > transport.Payload.MAX_FRAGMENT:
+        part = content[:transport.Payload.MAX_FRAGMENT]
+        content = content[transport.Payload.MAX_FRAGMENT:]
+        fragments.append(struct.pack('!4sBBBH', txid, msgtype, fragment, lastfrag, len(part)) + part)
+        fragment += 1
+    fragments.append(struct.pack('!4sBBBH', txid, msgtype, fragment, lastfrag, len(content)) + content)
+    for x in fragments:
+        if encrypt:
+            x = encrypt(x)
+        p = transport.Packet()
+        p.pack(x, node_id, mode)
+        sock.sendto(p.msg, address)
+
+def bench_fanout(size=256 * 1024, peers=8, rounds=10, secure=False):
+    """
+    Time sending a STOR sized value to a number of peers over loopback.
+    Receiving sockets are never read, the kernel drops what overflows.
+    @param size: Size of the value in bytes
+    @param peers: Number of destinations per round
+    @param rounds: Number of times to send to every peer
+    @param secure: Encrypt each fragment as the engine does
+    @return: Dict of bytes/sec for the original and buffered send paths
+    """
+    sinks = []
+    for _ in xrange(peers):
+        x = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        x.bind(('127.0.0.1', 0))
+        sinks.append(x)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    writer = transport.PacketWriter(sock)
+    node_id = generate_random()
+    content = os.urandom(size)
+    encrypt = None
+    if secure:
+        key = PrivateKey.generate()
+        box = Box(key, key.public_key)
+        encrypt = lambda x: box.encrypt(x, nacl.utils.random(Box.NONCE_SIZE))
+    encrypt_many = encrypt and (lambda xs: [ encrypt(x) for x in xs ])
+    mode = secure and transport.OPTION_CURVE or transport.OPTION_PLAIN
+    results = {}
+    for name, send in (('concat', lambda a: send_concat(sock, a, node_id, mode,
+                                                        'tx01', 0x09, content,
+                                                        encrypt)),
+                       ('buffered', lambda a: writer.send(a, node_id, mode,
+                                                          'tx01', 0x09, content,
+                                                          encrypt_many))):
+        start = time.time()
+        for _ in xrange(rounds):
+            for x in sinks:
+                send(x.getsockname())
+        elapsed = max(time.time() - start, 1e-9)
+        results[name + '_bytes_per_sec'] = size * peers * rounds / elapsed
+    for x in sinks + [sock]:
+        x.close()
+    return results
+
+def bench_receive(count=20000, budget=64):
+    """
+    Time reading and parsing a flood of FNOD query datagrams, one
+    recvfrom() per wakeup against batches read into reusable buffers.
+    @param count: Number of datagrams per run
+    @param budget: Maximum datagrams read per wakeup when batching
+    @return: Dict of datagrams/sec for each receive loop
+    """
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sink.bind(('127.0.0.1', 0))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    writer = transport.PacketWriter(sock)
+    node_id = generate_random()
+    pool = [ bytearray(2048) for _ in xrange(budget) ]
+    flags = getattr(socket, 'MSG_DONTWAIT', 0)
+
+    def parse(data):
+        p = transport.Packet()
+        p.unpack(data)
+        payload = transport.Payload()
+        payload.unpack(p.payload)
+        return payload.content
+
+    # the engine waits on a zmq poller between reads
+    poller = zmq.Poller()
+    poller.register(sink, zmq.POLLIN)
+
+    def single(remaining):
+        poller.poll(1000)
+        data, _ = sink.recvfrom(2048)
+        parse(data)
+        return 1
+
+    def batched(remaining):
+        poller.poll(1000)
+        batch = []
+        while len(batch) < min(budget, remaining):
+            try:
+                size, _ = sink.recvfrom_into(pool[len(batch)], 0,
+                                             flags if batch else 0)
+            except socket.error:
+                break
+            batch.append(memoryview(pool[len(batch)])[:size])
+        for x in batch:
+            parse(x)
+        return len(batch)
+
+    results = {}
+    for name, recv in (('recvfrom', single), ('recvfrom_into', batched)):
+        received = 0
+        elapsed = 0.0
+        while received < count:
+            # queue up a burst then drain it
+            burst = min(1000, count - received)
+            for _ in xrange(burst):
+                writer.send(sink.getsockname(), node_id,
+                            transport.OPTION_PLAIN, 'tx01', 0x03,
+                            generate_random())
+            start = time.time()
+            remaining = burst
+            while remaining:
+                remaining -= recv(remaining)
+            elapsed += time.time() - start
+            received += burst
+        results[name + '_per_sec'] = count / max(elapsed, 1e-9)
+    sink.close()
+    sock.close()
+    return results
+
+def bench_boxes(size=256 * 1024, rounds=5):
+    """
+    Time encrypting and decrypting the fragments of a value between
+    two peers, creating a Box per fragment as the engine once did
+    against boxes kept in a BoxCache and symmetric sessions.
+    @param size: Size of the value in bytes
+    @param rounds: Number of times the value is sent
+    @return: Dict of fragments per value and microseconds per fragment
+    for each approach
+    """
+    sender = PrivateKey.generate()
+    receiver = PrivateKey.generate()
+    sender_id = str(sender.public_key)
+    receiver_id = str(receiver.public_key)
+    payload = transport.Payload()
+    payload.pack('tx01', 0x09, os.urandom(size))
+
+    def fresh(fragment):
+        box = Box(sender, PublicKey(receiver_id))
+        msg = box.encrypt(fragment, nacl.utils.random(Box.NONCE_SIZE))
+        return Box(receiver, PublicKey(sender_id)).decrypt(msg)
+
+    outbound = BoxCache(sender)
+    inbound = BoxCache(receiver)
+    def cached(fragment):
+        return inbound.decrypt(sender_id, outbound.encrypt(receiver_id, fragment))
+
+    outbound_session = SessionCache(outbound)
+    inbound_session = SessionCache(inbound)
+    # receivers pick the session and offer it to the sender
+    outbound_session.adopt(receiver_id, inbound_session.offer(sender_id))
+    def session(fragment):
+        return inbound_session.decrypt(sender_id,
+            outbound_session.encrypt(receiver_id, fragment))
+
+    results = {'fragments': len(payload.fragments)}
+    for name, f in (('box_per_fragment', fresh), ('box_cache', cached),
+                    ('session', session)):
+        start = time.time()
+        for _ in xrange(rounds):
+            for x in payload.fragments:
+                f(x)
+        elapsed = time.time() - start
+        results[name + '_us'] = elapsed / rounds / len(payload.fragments) * 1e6
+    return results
+
+def cpu_time():
+    """
+    @return: User and system CPU seconds used by this process
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def receive_messages(sock, count, box=None, idle=1.0):
+    """
+    Read, decrypt and reassemble messages as the engine does until
+    count have arrived or nothing has for the idle period.
+    @param sock: Bound datagram socket
+    @param count: Number of messages expected
+    @param box: Box to decrypt curve packets with
+    @param idle: Seconds to wait for further datagrams
+    @return: Dict of messages and bytes received, seconds from the
+    first datagram to the last message and CPU seconds used
+    """
+    sock.settimeout(idle)
+    buf = bytearray(transport.MAX_FRAGMENT_V1 + 1024)
+    defrag = transport.DefragMap()
+    received = 0
+    size = 0
+    first = last = None
+    cpu = cpu_time()
+    while received < count:
+        try:
+            length, _ = sock.recvfrom_into(buf)
+        except socket.timeout:
+            break
+        if first is None:
+            first = time.time()
+        p = transport.Packet()
+        p.unpack(memoryview(buf)[:length])
+        if p.mode & transport.OPTION_MASK == transport.OPTION_CURVE:
+            p.payload = box.decrypt(p.payload.tobytes())
+        data = transport.Payload()
+        data.unpack(p.payload, transport.PAYLOAD_V1)
+        msg = defrag.get_msg(data.txid, data.fragment, data.lastfrag,
+                             data.content, p.node_id, fragsize=data.fragsize)
+        if msg is not None:
+            received += 1
+            size += len(msg)
+            last = time.time()
+    return {'messages': received,
+            'bytes': size,
+            'elapsed': first and last and last - first or 0.0,
+            'cpu': cpu_time() - cpu}
+
+def bench_loopback(size, count=None, secure=False,
+                   fragsize=transport.Payload.MAX_FRAGMENT, workers=0):
+    """
+    Time messages sent as fast as possible to a receiving endpoint in
+    another process over loopback, using the version 1 payload header.
+    @param size: Size of each message in bytes
+    @param count: Number of messages, sized to LOOPBACK_BYTES if None
+    @param secure: Encrypt each fragment as the engine does
+    @param fragsize: Fragment size
+    @param workers: Crypto threads encrypting the fragments of each message
+    @return: Dict of messages/sec, goodput, CPU per message on both
+    ends and the fraction of messages lost
+    """
+    if count is None:
+        count = max(LOOPBACK_MIN_MESSAGES,
+                    min(LOOPBACK_MAX_MESSAGES, LOOPBACK_BYTES // max(size, 1)))
+    args = [sys.executable, '-m', 'peerz.examples.throughput', 'recv',
+            str(count)]
+    encrypt = None
+    pool = CryptoPool(workers)
+    if secure:
+        sender = PrivateKey.generate()
+        receiver = PrivateKey.generate()
+        box = Box(sender, receiver.public_key)
+        seal = lambda x: box.encrypt(x, nacl.utils.random(Box.NONCE_SIZE))
+        encrypt = lambda xs: pool.map(seal, xs)
+        args += [str(receiver).encode('hex'), str(sender.public_key).encode('hex')]
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE)
+    port = int(proc.stdout.readline())
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    writer = transport.PacketWriter(sock)
+    node_id = generate_random()
+    mode = (secure and transport.OPTION_CURVE or transport.OPTION_PLAIN) | \
+        transport.FEATURES | transport.HEADER_V1
+    content = os.urandom(size)
+    cpu = cpu_time()
+    for x in xrange(count):
+        writer.send(('127.0.0.1', port), node_id, mode,
+                    struct.pack('!I', x), 0x09, content, encrypt, fragsize,
+                    transport.PAYLOAD_V1)
+    cpu = cpu_time() - cpu
+    pool.close()
+    received = json.loads(proc.communicate()[0])
+    sock.close()
+    elapsed = max(received['elapsed'], 1e-9)
+    return {'size': size,
+            'secure': secure,
+            'workers': workers,
+            'sent': count,
+            'received': received['messages'],
+            'messages_per_sec': received['messages'] / elapsed,
+            'goodput_bytes_per_sec': received['bytes'] / elapsed,
+            'send_cpu_us_per_message': cpu / count * 1e6,
+            'recv_cpu_us_per_message': received['cpu'] /
+                max(received['messages'], 1) * 1e6,
+            'drop_rate': 1 - float(received['messages']) / count}
+
+def run_loopback(sizes=LOOPBACK_SIZES, workers=0):
+    """
+    Run bench_loopback() for each size, plain and, with PyNaCl
+    installed, curve.
+    @param workers: Crypto threads used by the curve runs
+    @return: List of bench_loopback() results
+    """
+    results = []
+    for secure in HAS_NACL and (False, True) or (False,):
+        for size in sizes:
+            results.append(bench_loopback(size, secure=secure,
+                                          workers=secure and workers or 0))
+    return results
+
+def _receiver(count, secret=None, public=None):
+    """
+    Receiving end of bench_loopback(), writes its port then results.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+    sock.bind(('127.0.0.1', 0))
+    box = None
+    if secret:
+        box = Box(PrivateKey(secret.decode('hex')),
+                  PublicKey(public.decode('hex')))
+    print sock.getsockname()[1]
+    sys.stdout.flush()
+    print json.dumps(receive_messages(sock, count, box))
+
+if __name__ == '__main__':
+    """
+    Send path throughput for large values fanned out to peers and
+    receive path throughput for floods of small queries.
+    Usage: throughput.py [value size] [peers] [rounds]
+           throughput.py loopback [sizes,...] [crypto workers]
+    The loopback harness measures the packet path between two
+    endpoints, writing its results as JSON.
+    """
+    if len(sys.argv) > 1 and sys.argv[1] == 'recv':
+        _receiver(int(sys.argv[2]), *sys.argv[3:5])
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'loopback':
+        sizes = LOOPBACK_SIZES
+        if len(sys.argv) > 2:
+            sizes = [ int(x) for x in sys.argv[2].split(',') ]
+        workers = 0
+        if len(sys.argv) > 3:
+            workers = int(sys.argv[3])
+        print json.dumps(run_loopback(sizes, workers), indent=2,
+                         sort_keys=True)
+        sys.exit(0)
+    args = [ int(x) for x in sys.argv[1:4] ]
+    results = {'plain': bench_fanout(*args)}
+    if HAS_NACL:
+        results['curve'] = bench_fanout(*args, secure=True)
+        results['boxes'] = bench_boxes()
+    results['receive'] = bench_receive()
+    print json.dumps(results, indent=2, sort_keys=True)
@@ -16,12 +16,15 @@
 
 import json
 import random
+import socket
 import time
 
 from zmq.utils import z85
 
 from peerz.messaging.base import MessageState
-from peerz.routing import distance_sort, generate_random
+from peerz.routing import distance_sort, generate_random_in, id_to_long
+from peerz.transport import FEATURE_PAYLOAD_V1, MTU_CANDIDATES
+from peerz.transport import pack_nodes, unpack_nodes
 
 class FindNodes(MessageState):
     states = ['initialised', 'querying', 'waiting response', 'exhausted', 'timedout']
@@ -35,17 +38,23 @@ class FindNodes(MessageState):
 
     def parse_message(self, msg):
         self.target = z85.decode(msg.pop(0))
+        self.target_long = id_to_long(self.target)
+        self.engine.nodetree.touch(self.target_long)
         # include peers that may be in bad states in case they have come good? will eventually be evicted
-        self.closest = self.engine.nodetree.closest_to(self.target)
+        self.closest = self.engine.nodetree.closest_to(self.target_long)
         self.unqueried = list(self.closest)  # shallow is fine
         self.queried = []
         self.outstanding = {} # peer_id -> query time
+        self.deadlines = {} # peer_id -> time a response is expected by
 
     def is_complete(self):
         return self.state in ['exhausted', 'timedout']
     
     def has_capacity(self):
-        return len(self.outstanding) < self.max_concurrency
+        # peers slower than their usual response time stop holding up the lookup
+        now = time.time() * 1000
+        waiting = [ x for x in self.deadlines.itervalues() if x > now ]
+        return len(waiting) < self.max_concurrency
 
     def has_unqueried(self):
         return self.unqueried
@@ -63,22 +72,12 @@ class FindNodes(MessageState):
         return self.target
 
     @staticmethod
-    def pack_response(closest):
-        resp = b''
-        for x in closest:
-            # possibly the world's worst serialisation scheme
-            resp += b'%s%s\0%i\0' % (x.node_id, x.address, x.port)
-        return resp
+    def pack_response(closest, support):
+        return pack_nodes(closest, support)
 
     @staticmethod
     def unpack_response(content):
-        while content:
-            try:
-                id = content[:32]
-                addr, port, content = content[32:].split(b'\0', 2)
-                yield addr, int(port), id
-            except:
-                break
+        return unpack_nodes(content)
 
     def handle_response(self, peer, txid, msgtype, content):
         if msgtype == 0x04:
@@ -88,11 +87,12 @@ class FindNodes(MessageState):
                 # only add new nodes
                 if not n.node_id in self.queried and not n.node_id in [ u.node_id for u in self.unqueried ]:
                     self.closest.append(n)
-            distance_sort(self.closest, self.target, key=lambda x: x.node_id)
+            distance_sort(self.closest, self.target_long, key=lambda x: x.long_id)
             self.closest = self.closest[:8]
             self.unqueried = [ x for x in self.closest if x.node_id not in self.queried ]
         # duplicate? first wins
         ts = self.outstanding.pop(peer.node_id, None)
+        self.deadlines.pop(peer.node_id, None)
         if ts:
             peer.add_rtt(time.time() * 1000 - ts)
             self.response()
@@ -102,6 +102,7 @@ class FindNodes(MessageState):
             peer = self.unqueried.pop(0)
             self.engine.send_external(peer, self.txid, 0x03, self.pack_request())
             self.outstanding[peer.node_id] = time.time() * 1000
+            self.deadlines[peer.node_id] = self.outstanding[peer.node_id] + peer.rto
             self.queried.append(peer.node_id)
 
     def _completed(self):
@@ -148,6 +149,34 @@ class Ping(MessageState):
         if self.peer:
             self.peer.timeout()
 
+class ProbeMtu(Ping):
+    """
+    Ping padded to fill a single fragment of the probed size.  Sent
+    with the don't fragment bit set, a pong shows the path to the
+    peer carries fragments of that size.
+    """
+    def unpack_request(self, msg):
+        super(ProbeMtu, self).unpack_request(msg)
+        self.size = int(msg.pop(0))
+
+    def handle_response(self, peer, txid, msgtype, content):
+        if msgtype == 0x02:
+            peer.max_fragment = max(peer.max_fragment, self.size)
+            self.pong()
+
+    def _send_ping(self):
+        try:
+            self.engine.send_external(self.peer, self.txid, 0x01,
+                                      '\0' * self.size, fragsize=self.size,
+                                      compress=False)
+        except socket.error:
+            # larger than the local interface allows
+            pass
+
+    def _timeout(self):
+        # lost probes are expected, they are not failures of the peer
+        pass
+
 class Discovery(object):
     id = 0x00
     mtype_table = {0x01: 'PING',
@@ -161,17 +190,21 @@ class Discovery(object):
 
     def __init__(self, engine, 
                  neighbour_poll=120, 
-                 random_poll=300,
+                 stale_poll=60,
+                 stale_age=900,
+                 stale_limit=3,
                  verify_poll=61,
                  verify_limit=3,
                  reap_poll=62):
         self.engine = engine
         self.neighbour_poll = neighbour_poll
-        self.random_poll = random_poll
+        self.stale_poll = stale_poll
+        self.stale_age = stale_age
+        self.stale_limit = stale_limit
         self.verify_poll = verify_poll
         self.verify_limit = verify_limit
         self.reap_poll = reap_poll
-        self.next_random_poll = time.time() + random_poll
+        self.next_stale_poll = time.time() + stale_poll
         self.next_verify_poll = time.time() + verify_poll
         self.next_reap_poll = time.time() + reap_poll
         self.next_neighbour_poll = time.time() # poll immediately as part of bootstrap/init 
@@ -184,7 +217,8 @@ class Discovery(object):
             self.engine.send_external(peer, txid, 0x04,
                 # do not include nodes of questionable status
                 FindNodes.pack_response(
-                    [ x for x in self.engine.nodetree.closest_to(content) if not x.is_failed() ]))
+                    [ x for x in self.engine.nodetree.closest_to(content) if not x.is_failed() ],
+                    peer.features))
 
     def trigger_events(self):
         now = time.time()
@@ -192,9 +226,9 @@ class Discovery(object):
             self.poll_neighbours()
             self.next_neighbour_poll += self.neighbour_poll
             
-        if self.next_random_poll - now <= 0:
-            self.poll_random()
-            self.next_random_poll += self.random_poll
+        if self.next_stale_poll - now <= 0:
+            self.poll_stale()
+            self.next_stale_poll += self.stale_poll
             
         if self.next_verify_poll - now <= 0:
             self.verify_peers()
@@ -208,10 +242,11 @@ class Discovery(object):
         self.engine.txmap.create(FindNodes,
                   [z85.encode(self.engine.node.node_id)], self.engine)
     
-    def poll_random(self):
-        # should really find a stale bucket not just random
-        self.engine.txmap.create(FindNodes,
-                  [z85.encode(generate_random())], self.engine)
+    def poll_stale(self):
+        # refresh the least recently active buckets with a lookup in their range
+        for _, depth, prefix in self.engine.nodetree.stale_bins(self.stale_age)[:self.stale_limit]:
+            self.engine.txmap.create(FindNodes,
+                  [z85.encode(generate_random_in(depth, prefix))], self.engine)
     
     # needed?
     def verify_peers(self):
@@ -225,11 +260,36 @@ class Discovery(object):
                 queried += 1
                 if queried >= self.verify_limit:
                     break
+        self.verify_candidates()
+        self.probe_mtu()
+
+    def verify_candidates(self):
+        # measure replacement candidates so the fastest live ones are promoted
+        candidates = [ x for x in self.engine.nodetree.get_all_candidates()
+                       if x.is_discovered() ]
+        random.shuffle(candidates)
+        for x in candidates[:self.verify_limit]:
+            self.engine.txmap.create(Ping,
+              [x.address, x.port, z85.encode(x.node_id)], self.engine)
+    
+    def probe_mtu(self):
+        # find the largest fragments verified peers can be sent
+        nodes = [ x for x in self.engine.nodetree.get_all_nodes()
+                  if x.is_verified() and not x.mtu_probed and
+                  x.features & FEATURE_PAYLOAD_V1 ]
+        random.shuffle(nodes)
+        for x in nodes[:self.verify_limit]:
+            x.mtu_probed = True
+            for size in MTU_CANDIDATES:
+                if size > x.max_fragment:
+                    self.engine.txmap.create(ProbeMtu,
+                      [x.address, x.port, z85.encode(x.node_id), size],
+                      self.engine)
     
     def reap_peers(self):
         for x in self.engine.nodetree.get_all_nodes():
             if x.is_failed():
-                self.engine.nodetree.remove(x)
+                self.engine.remove_peer(x)
     
     @staticmethod
     def has_command(command):
@@ -21,7 +21,8 @@ from zmq.utils import z85
 
 from peerz.messaging.base import MessageState
 from peerz.messaging.discovery import FindNodes
-from peerz.routing import distance_sort, id_for_key
+from peerz.routing import distance_sort, id_for_key, id_to_long
+from peerz.transport import pack_nodes, unpack_nodes
 
 class FindValue(MessageState):
     states = ['initialised', 'querying', 'waiting response', 'found', 'exhausted', 'timedout']
@@ -37,11 +38,14 @@ class FindValue(MessageState):
 
     def parse_message(self, msg):
         self.key = id_for_key(msg.pop(0))
+        self.key_long = id_to_long(self.key)
+        self.engine.nodetree.touch(self.key_long)
         self.context = msg.pop(0)
-        self.closest = self.engine.nodetree.closest_to(self.key)
+        self.closest = self.engine.nodetree.closest_to(self.key_long)
         self.unqueried = list(self.closest)  # shallow is fine
         self.queried = []
         self.outstanding = {} # peer_id -> query time
+        self.deadlines = {} # peer_id -> time a response is expected by
         self.value = None
 
     def is_complete(self):
@@ -51,7 +55,10 @@ class FindValue(MessageState):
         return self.value
 
     def has_capacity(self):
-        return len(self.outstanding) < self.max_concurrency
+        # peers slower than their usual response time stop holding up the lookup
+        now = time.time() * 1000
+        waiting = [ x for x in self.deadlines.itervalues() if x > now ]
+        return len(waiting) < self.max_concurrency
 
     def has_unqueried(self):
         return self.unqueried
@@ -69,22 +76,12 @@ class FindValue(MessageState):
         return self.key
 
     @staticmethod
-    def pack_node_response(closest):
-        resp = b''
-        for x in closest:
-            # possibly the world's worst serialisation scheme
-            resp += b'%s%s\0%i\0' % (x.node_id, x.address, x.port)
-        return resp
+    def pack_node_response(closest, support):
+        return pack_nodes(closest, support)
 
     @staticmethod
     def unpack_node_response(content):
-        while content:
-            try:
-                id = content[:32]
-                addr, port, content = content[32:].split(b'\0', 2)
-                yield addr, int(port), id
-            except:
-                break
+        return unpack_nodes(content)
 
     def handle_response(self, peer, txid, msgtype, content):
         if msgtype == 0x08:
@@ -97,11 +94,12 @@ class FindValue(MessageState):
                 # only add new nodes
                 if not n.node_id in self.queried and not n.node_id in [ u.node_id for u in self.unqueried ]:
                     self.closest.append(n)
-            distance_sort(self.closest, self.key, key=lambda x: x.node_id)
+            distance_sort(self.closest, self.key_long, key=lambda x: x.long_id)
             self.closest = self.closest[:8]
             self.unqueried = [ x for x in self.closest if x.node_id not in self.queried ]
         # duplicate? first wins
         ts = self.outstanding.pop(peer.node_id, None)
+        self.deadlines.pop(peer.node_id, None)
         if ts:
             peer.add_rtt(time.time() * 1000 - ts)
             self.response()
@@ -110,6 +108,7 @@ class FindValue(MessageState):
         peer = self.unqueried.pop(0)
         self.engine.send_external(peer, self.txid, 0x05, self.pack_request())
         self.outstanding[peer.node_id] = time.time() * 1000
+        self.deadlines[peer.node_id] = self.outstanding[peer.node_id] + peer.rto
         self.queried.append(peer.node_id)
         self.query()
 
@@ -131,8 +130,9 @@ class StoreValue(MessageState):
         self.key = msg.pop(0)
         self.content = msg.pop(0)
         self.context = msg.pop(0)
-        self.engine.hashtable[id_for_key(self.key)] = (self.engine.node.node_id, time.time(), self.content)
-        self.closest = [  x.to_json() for x in self.engine.nodetree.closest_to(id_for_key(self.key)) ]
+        target = id_for_key(self.key)
+        self.engine.hashtable[target] = (self.engine.node.node_id, time.time(), self.content)
+        self.closest = [  x.to_json() for x in self.engine.nodetree.closest_to(target) ]
 
     def is_complete(self):
         return self.state in ['stored', 'timedout']
@@ -235,7 +235,8 @@ class DistributedHashtable(object):
             else:
                 # send next closest nodes
                 self.engine.send_external(peer, txid, 0x06,
-                    FindNodes.pack_response(self.engine.nodetree.closest_to(content)))
+                    FindNodes.pack_response(self.engine.nodetree.closest_to(content),
+                                            peer.features))
 
         elif msgtype == 0x09:
             key = id_for_key(content)
@@ -260,13 +261,17 @@ class DistributedHashtable(object):
                   [k, content, 'default'], self.engine)
     
     def republish_closest(self):
-        for k, v in self.engine.hashtable.items():
-            node_id, last, content = v
-            if node_id != self.engine.node.node_id and time.time() > last + self.closest_refresh:
-                # are we the closest node we know of
-                if self.engine.nodetree.closest_to(id_for_key(k)):
-                    self.engine.txmap.create(StoreValue,
-                      [k, content, 'default'], self.engine)
+        now = time.time()
+        due = [ (k, v[2]) for k, v in self.engine.hashtable.items()
+                if v[0] != self.engine.node.node_id and now > v[1] + self.closest_refresh ]
+        if not due:
+            return
+        closest = self.engine.nodetree.closest_to_many([ id_for_key(k) for k, _ in due ])
+        for (k, content), nodes in zip(due, closest):
+            # are we amongst the closest nodes we know of
+            if self.engine.node in nodes:
+                self.engine.txmap.create(StoreValue,
+                  [k, content, 'default'], self.engine)
 
     
     def expire_values(self):
@@ -0,0 +1,132 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import Queue
+import socket
+import threading
+import time
+
+LOGGER = logging.getLogger(__name__)
+
+# seconds to keep resolved hostnames
+HOSTNAME_TTL = 3600
+# seconds to remember addresses with no hostname
+NEGATIVE_TTL = 300
+# maximum number of cached addresses
+MAX_ENTRIES = 4096
+
+class HostnameCache(object):
+    """
+    Reverse DNS cache that never blocks the caller.
+    Addresses missing from the cache (or expired) are queued for a
+    background thread to resolve while the caller gets the last known
+    hostname, or the supplied default, straight away.
+    """
+    def __init__(self, ttl=HOSTNAME_TTL, negative_ttl=NEGATIVE_TTL,
+                 maxsize=MAX_ENTRIES, lookup=socket.getfqdn):
+        """
+        Create a new hostname cache.
+        @param ttl: Seconds to keep resolved hostnames
+        @param negative_ttl: Seconds to keep failed lookups
+        @param maxsize: Maximum number of cached addresses
+        @param lookup: Blocking function mapping an address to hostname
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.maxsize = maxsize
+        self.lookup = lookup
+        self.entries = {} # address -> (hostname or None, expiry)
+        self.pending = set()
+        self.queue = Queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def hostname(self, address, default=None):
+        """
+        Cached hostname of the supplied address, scheduling a lookup
+        if it is not known or has expired.
+        @param address: IP address as string
+        @param default: Value to return if no hostname is known
+        @return: Hostname or default
+        """
+        entry = self.entries.get(address)
+        if not entry or entry[1] <= time.time():
+            self._request(address)
+        if entry and entry[0]:
+            return entry[0]
+        return default
+
+    def _request(self, address):
+        with self.lock:
+            if address in self.pending:
+                return
+            # resolved since the caller looked
+            entry = self.entries.get(address)
+            if entry and entry[1] > time.time():
+                return
+            self.pending.add(address)
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run,
+                                               name='peerz-resolver')
+                self.thread.daemon = True
+                self.thread.start()
+        self.queue.put(address)
+
+    def _resolve(self, address):
+        try:
+            name = self.lookup(address)
+        except Exception, ex:
+            LOGGER.debug('Reverse lookup of %s failed: %s', address, ex)
+            name = None
+        # getfqdn() hands back the address when there is no name
+        if not name or name == address:
+            return None, time.time() + self.negative_ttl
+        return name, time.time() + self.ttl
+
+    def _run(self):
+        while True:
+            address = self.queue.get()
+            try:
+                entry = self._resolve(address)
+                with self.lock:
+                    if len(self.entries) >= self.maxsize:
+                        self._evict()
+                    self.entries[address] = entry
+                    self.pending.discard(address)
+            finally:
+                self.queue.task_done()
+
+    def _evict(self):
+        now = time.time()
+        for k, v in self.entries.items():
+            if v[1] <= now:
+                del self.entries[k]
+        # still full, drop whatever expires soonest
+        while len(self.entries) >= self.maxsize:
+            del self.entries[min(self.entries,
+                                 key=lambda x: self.entries[x][1])]
+
+# shared by all nodes
+RESOLVER = HostnameCache()
+
+def hostname(address):
+    """
+    Non-blocking reverse DNS lookup using the shared cache.
+    @param address: IP address as string
+    @return: Hostname if known, otherwise the address itself
+    """
+    return RESOLVER.hostname(address, address)
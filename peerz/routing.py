@@ -15,17 +15,25 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import binascii
+from bisect import bisect_left, insort
 from collections import OrderedDict
 from datetime import datetime, timedelta
 import hashlib
+import heapq
 import logging
+import math
 import os
-import socket
 import time
 
-from transitions import Machine
+try:
+    import numpy
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
 from zmq.utils import z85
 
+from peerz import resolver, transport
+
 LOG = logging.Logger(__name__)
 EPOCH = datetime.utcfromtimestamp(0)
 
@@ -37,7 +45,17 @@ B = 5
 # bit length of node id/key values
 KEY_BITS = 256
 
-NODE_RTT_DATA_POINTS = 10
+# recent round trip times kept per node for percentiles
+NODE_RTT_DATA_POINTS = 32
+# smoothing gains of round trip time mean and variance (RFC 6298)
+RTT_ALPHA = 1.0 / 8
+RTT_BETA = 1.0 / 4
+# bounds (ms) on the time to wait for a node to respond
+NODE_RTO_INITIAL = 1000.0
+NODE_RTO_MIN = 200.0
+NODE_RTO_MAX = 5000.0
+# number of targets ranked together by closest_to_many
+BATCH_TARGETS = 4096
 
 def time_since_epoch(future=0):
     """
@@ -59,18 +77,43 @@ def generate_random():
     """
     return os.urandom(KEY_BITS / 8)
 
+def generate_random_in(depth, prefix):
+    """
+    Create a new random id sharing the given leading bits.
+    @param depth: Number of leading bits fixed by prefix
+    @param prefix: Leading bits of the id as an integer
+    @return: New randomly generated id within the prefix range
+    """
+    if not depth:
+        return generate_random()
+    shift = KEY_BITS - depth
+    value = (prefix << shift) | (id_to_long(generate_random()) & ((1 << shift) - 1))
+    return binascii.unhexlify('%0*x' % (KEY_BITS / 4, value))
+
+def id_to_long(node_id):
+    """
+    Convert a node id/key to its integer form.
+    Ids already in integer form are returned as is so
+    callers can pass either representation.
+    @param node_id: Node id/key as binary or long
+    @return: The id as long
+    """
+    if isinstance(node_id, (int, long)):
+        return node_id
+    return long(binascii.hexlify(node_id), 16)
+
 def distance(node_id1, node_id2):
     """
     The XOR distance betwen two keys/nodes.
-    @param node_id1: Node id/key 1 as hex
-    @param node_id2: Node id/key 2 as hex
+    @param node_id1: Node id/key 1 as binary or long
+    @param node_id2: Node id/key 2 as binary or long
     @return: The distance as long
     """
-    return long(binascii.hexlify(node_id1), 16) ^ \
-        long(binascii.hexlify(node_id2), 16)
+    return id_to_long(node_id1) ^ id_to_long(node_id2)
 
 def distance_sort(lst, target_id, key=lambda x: x):
-    lst.sort(key=lambda x: distance(key(x), target_id))
+    target_id = id_to_long(target_id)
+    lst.sort(key=lambda x: id_to_long(key(x)) ^ target_id)
 
 def bit_number(node_id, bit):
     """
@@ -78,14 +121,22 @@ def bit_number(node_id, bit):
     MSB = 0, for the specified node_id/key.
     The node_id is treated as a key of KEY_BITS length
     regardless of current size.
-    @param node_id: Node id/key as hex
+    @param node_id: Node id/key as binary or long
     @param bit: Bit position to return
     @return: Value at bit position 'bit' or 0 if > KEY_BITS
     """
     if bit >= KEY_BITS:
         return 0
-    return (long(binascii.hexlify(node_id), 16) \
-        >> (KEY_BITS - 1 - bit)) & 1
+    return (id_to_long(node_id) >> (KEY_BITS - 1 - bit)) & 1
+
+def prefix_length(node_id1, node_id2):
+    """
+    The number of leading bits two keys/nodes have in common.
+    @param node_id1: Node id/key 1 as binary or long
+    @param node_id2: Node id/key 2 as binary or long
+    @return: Common prefix length, KEY_BITS if the ids are equal
+    """
+    return max(0, KEY_BITS - distance(node_id1, node_id2).bit_length())
 
 def id_for_key(key):
     """
@@ -97,12 +148,125 @@ def id_for_key(key):
     hasher.update(key)
     return hasher.digest()
 
+def pack_ids(ids):
+    """
+    Pack ids into an array of big endian 64 bit words.
+    Requires numpy.
+    @param ids: List of ids as long or binary
+    @return: numpy uint64 array of shape (len(ids), 4)
+    """
+    data = b''.join([ x if isinstance(x, bytes) and len(x) == KEY_BITS // 8
+                      else binascii.unhexlify('%064x' % id_to_long(x))
+                      for x in ids ])
+    return numpy.frombuffer(data, dtype='>u8').reshape(-1, 4).astype(
+                                                                numpy.uint64)
+
+def _closest_words(keys, nodes, targets, max_nodes):
+    """
+    Rank the nodes closest to each target on the leading 64 bits of
+    their ids.
+    @param keys: Sorted uint64 array of the leading word of node ids
+    @param nodes: Nodes matching keys
+    @param targets: uint64 array of the leading word of target ids
+    @param max_nodes: Number of nodes to return per target, less than
+    the number of nodes
+    @return: List holding a list of nodes for each target, or None
+    where the leading words do not decide the ranking.
+    """
+    # largest prefix length (0 to 64) whose block holds max_nodes nodes
+    low = numpy.zeros(len(targets), dtype=numpy.int64)
+    high = numpy.empty(len(targets), dtype=numpy.int64)
+    high.fill(64)
+    while (low < high).any():
+        mid = (low + high + 1) // 2
+        lo, hi = _prefix_block(keys, targets, mid)
+        enough = (hi - lo) >= max_nodes
+        low = numpy.where(enough, mid, low)
+        high = numpy.where(enough, high, mid - 1)
+    lo, hi = _prefix_block(keys, targets, low)
+    width = hi - lo
+    # blocks are rarely much larger than max_nodes, leave outliers and
+    # ties on the whole leading word to an exact comparison
+    limit = max(4 * max_nodes, 64)
+    usable = (width <= limit) & (low < 64)
+    span = min(int(width.max()), limit)
+    offsets = lo[:, None] + numpy.arange(span)[None, :]
+    valid = offsets < hi[:, None]
+    offsets = numpy.minimum(offsets, len(keys) - 1)
+    dist = keys[offsets] ^ targets[:, None]
+    dist[~valid] = ~numpy.uint64(0)
+    rows = numpy.arange(len(dist))[:, None]
+    order = numpy.argsort(dist, axis=1)
+    ranked = dist[rows, order]
+    # any repeated distance within (or just past) the first max_nodes
+    # may hide an ordering only the later words can settle
+    last = min(max_nodes + 1, span)
+    ties = (ranked[:, 1:last] == ranked[:, :last - 1]).any(axis=1)
+    usable &= ~ties
+    picked = offsets[rows, order[:, :max_nodes]]
+    results = []
+    for ok, row in zip(usable.tolist(), picked.tolist()):
+        results.append([ nodes[x] for x in row ] if ok else None)
+    return results
+
+def _prefix_block(keys, targets, length):
+    """
+    Locate the nodes sharing a prefix with each target.
+    @param keys: Sorted uint64 array of the leading word of node ids
+    @param targets: uint64 array of the leading word of target ids
+    @param length: Array of prefix lengths in bits (0 to 64) per target
+    @return: Tuple of arrays holding the start and end index of each
+    target's block in keys
+    """
+    shift = (64 - length).astype(numpy.uint64)
+    # shifting a 64 bit word by 64 is undefined, split it in two
+    half = shift // numpy.uint64(2)
+    base = ((targets >> half) >> (shift - half)) << half << (shift - half)
+    last = base | ((((numpy.uint64(1) << half) << (shift - half))
+                    - numpy.uint64(1)))
+    lo = numpy.searchsorted(keys, base, side='left')
+    hi = numpy.searchsorted(keys, last, side='right')
+    return lo.astype(numpy.int64), hi.astype(numpy.int64)
+
+class InvalidTransition(Exception):
+    """
+    A node state trigger was fired from a state that does not allow it.
+    """
+    pass
+
+def _transition_table(states, transitions):
+    """
+    Index a list of transition definitions by trigger and source state.
+    @param states: List of state names, position is the state's number
+    @param transitions: List of transition definition dicts
+    @return: Dict of (trigger, source state number) -> list of
+    (dest state number, conditions, before, after) tuples in the order
+    they should be tried.
+    """
+    table = {}
+    for x in transitions:
+        sources = x['source']
+        if not isinstance(sources, list):
+            sources = [sources]
+        for source in sources:
+            table.setdefault((x['trigger'], states.index(source)), []).append(
+                (states.index(x['dest']), x.get('conditions', []),
+                 x.get('before'), x.get('after')))
+    return table
+
 class Node(object):
     """
     Represents a node in the peer to peer network
     and its related details/statistics.
     """
-    
+    __slots__ = ['address', 'port', 'node_id', 'long_id', 'secret_key',
+                 'discovered', 'first_contact', 'last_contact',
+                 'last_failure', '_state', 'failures', 'queries_in',
+                 'responses_in', 'queries_out', 'responses_out', 'start',
+                 'last_change', 'times', 'rtt', 'rtt_next', 'rtt_sorted',
+                 'rtt_sum', 'srtt', 'rttvar', 'features', 'advertised',
+                 'max_fragment', 'mtu_probed']
+
     states = ['discovered', 'verified', 'failed']
     transitions = [
         {'trigger': 'response_in', 'source': ['discovered', 'verified'], 'dest': 'verified', 'before': '_update', 'after': '_response_in'},
@@ -123,37 +287,99 @@ class Node(object):
         self.address = address
         self.port = int(port)
         self.node_id = node_id
+        self.long_id = id_to_long(node_id)
         self.secret_key = secret_key
         self.discovered = time_since_epoch()
         self.first_contact = self.last_contact = self.last_failure = None
         self.reset()
 
     def __getstate__(self):
-        # ignore state machine in pickling
-        state = self.__dict__.copy()
-        del state['machine']
-        for x in Node.states:
-            del state['to_' + x]
-            del state['is_' + x]
-        for x in Node.transitions:
-            state.pop(x['trigger'], None)
-        return state
+        return tuple(getattr(self, x) for x in Node._pickled)
     
     def __setstate__(self, state):
-        # reset state machine after unpickling
-        self.__dict__.update(state)
+        # reset state after unpickling
+        if isinstance(state, dict):
+            # pickled before slots, ignore the old state machine attributes
+            state = tuple(state.get(x) for x in Node._pickled)
+        for k, v in zip(Node._pickled, state):
+            setattr(self, k, v)
+        self.long_id = id_to_long(self.node_id)
         self.reset()
 
+    @property
+    def state(self):
+        return Node.states[self._state]
+
+    def _trigger(self, trigger):
+        """
+        Fire the named trigger, moving to the state of the first
+        transition from the current state whose conditions hold.
+        @param trigger: Name of the trigger
+        @return: True once transitioned
+        @raise InvalidTransition: If no transition allows the trigger
+        """
+        for dest, conditions, before, after in \
+                Node._transitions.get((trigger, self._state), ()):
+            if not all(getattr(self, x)() for x in conditions):
+                continue
+            if before:
+                getattr(self, before)()
+            self._state = dest
+            if after:
+                getattr(self, after)()
+            return True
+        raise InvalidTransition("Can't trigger event %s from state %s!" %
+                                (trigger, self.state))
+
+    def response_in(self):
+        return self._trigger('response_in')
+
+    def timeout(self):
+        return self._trigger('timeout')
+
     @property
     def hostname(self):
-        return socket.getfqdn(self.address)
+        return resolver.hostname(self.address)
     
     @property
     def latency(self):
+        """
+        @return: Mean of recent round trip times (ms)
+        """
         if self.rtt:
-            return sum(self.rtt) / len(self.rtt)
+            return self.rtt_sum / len(self.rtt)
         return 0.0
 
+    @property
+    def latency_p50(self):
+        return self.rtt_percentile(50)
+
+    @property
+    def latency_p95(self):
+        return self.rtt_percentile(95)
+
+    @property
+    def rto(self):
+        """
+        @return: Time (ms) to wait for a response before considering
+        a query to this node lost.
+        """
+        if not self.rtt:
+            return NODE_RTO_INITIAL
+        return min(NODE_RTO_MAX,
+                   max(NODE_RTO_MIN, self.srtt + 4 * self.rttvar))
+
+    def rtt_percentile(self, percent):
+        """
+        Nearest rank percentile of recent round trip times.
+        @param percent: Percentile to return (0-100)
+        @return: Round trip time (ms) or 0.0 if none are known
+        """
+        if not self.rtt_sorted:
+            return 0.0
+        rank = int(math.ceil(percent / 100.0 * len(self.rtt_sorted)))
+        return self.rtt_sorted[max(0, rank - 1)]
+
     @property
     def msg_loss(self):
         if self.queries_out:
@@ -161,8 +387,7 @@ class Node(object):
         
     def _update(self):
         now = time.time() * 1000
-        self.times.setdefault(self.state, 0.0)
-        self.times[self.state] += (now - self.last_change)
+        self.times[self._state] += (now - self.last_change)
         self.last_change = now
 
     def query_in(self):
@@ -181,10 +406,29 @@ class Node(object):
         self.responses_in += 1
     
     def add_rtt(self, rtt):
-        if rtt:
-            # only keep x last measurments
-            self.rtt.insert(0, rtt)
-            self.rtt = self.rtt[:NODE_RTT_DATA_POINTS]
+        """
+        Record a round trip time measurement.
+        @param rtt: Round trip time (ms)
+        """
+        if not rtt:
+            return
+        if not self.rtt:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar += RTT_BETA * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += RTT_ALPHA * (rtt - self.srtt)
+        # only keep x last measurements, overwriting the oldest
+        if len(self.rtt) < NODE_RTT_DATA_POINTS:
+            self.rtt.append(rtt)
+        else:
+            old = self.rtt[self.rtt_next]
+            self.rtt[self.rtt_next] = rtt
+            del self.rtt_sorted[bisect_left(self.rtt_sorted, old)]
+            self.rtt_sum -= old
+        self.rtt_next = (self.rtt_next + 1) % NODE_RTT_DATA_POINTS
+        insort(self.rtt_sorted, rtt)
+        self.rtt_sum += rtt
 
     def query_out(self):
         self.queries_out += 1
@@ -203,18 +447,24 @@ class Node(object):
         return self.failures >= 3
     
     def reset(self):
-        self.machine = Machine(model=self,
-                       states=Node.states,
-                       transitions=Node.transitions,
-                       initial='discovered')
+        self._state = 0
         self.failures = 0
         self.queries_in = 0
         self.responses_in = 0
         self.queries_out = 0
         self.responses_out = 0
         self.start = self.last_change = time.time() * 1000
-        self.times = {} # spent in state x
-        self.rtt = [] # list of recent round trip times
+        self.times = [0.0] * len(Node.states) # spent in state x
+        self.rtt = [] # ring buffer of recent round trip times
+        self.rtt_next = 0 # position of the oldest once full
+        self.rtt_sorted = [] # recent round trip times in order
+        self.rtt_sum = 0.0
+        self.srtt = 0.0 # smoothed round trip time
+        self.rttvar = 0.0 # round trip time variation
+        self.features = 0 # transport features the node has advertised
+        self.advertised = False # whether ours have been sent to the node
+        self.max_fragment = transport.Payload.MAX_FRAGMENT
+        self.mtu_probed = False
 
     def to_json(self, redact=True):
         """
@@ -230,6 +480,11 @@ class Node(object):
                 'last_contact': self.last_contact,
                 'last_failure': self.last_failure,
                 'latency_ms': self.latency,
+                'latency_p50_ms': self.latency_p50,
+                'latency_p95_ms': self.latency_p95,
+                'srtt_ms': self.srtt,
+                'rttvar_ms': self.rttvar,
+                'rto_ms': self.rto,
                 'msg_loss': self.msg_loss, 
                 'failures': self.failures,
                 'queries_in': self.queries_in,
@@ -239,7 +494,7 @@ class Node(object):
                 'status': self.state,
                 }
         if not redact and self.secret_key:
-            data.update['secret_key'] = z85.encode(self.secret_key)
+            data['secret_key'] = z85.encode(self.secret_key)
         return data
 
     def __str__(self):
@@ -250,6 +505,137 @@ class Node(object):
                                             z85.encode(self.node_id),
                                             self.hostname)
 
+Node._pickled = [ x for x in Node.__slots__ if x != 'long_id' ]
+Node._transitions = _transition_table(Node.states, Node.transitions)
+
+# shared is_<state>() and to_<state>() helpers for each state
+def _state_methods(number):
+    def is_state(self):
+        return self._state == number
+    def to_state(self):
+        self._state = number
+        return True
+    return is_state, to_state
+
+for _number, _name in enumerate(Node.states):
+    _is, _to = _state_methods(_number)
+    _is.__name__ = 'is_' + _name
+    _to.__name__ = 'to_' + _name
+    setattr(Node, _is.__name__, _is)
+    setattr(Node, _to.__name__, _to)
+del _number, _name, _is, _to
+
+
+class NodeIndex(object):
+    """
+    Maps node id and (address, port) to the active nodes of a routing
+    table so peers can be resolved without walking its bins.
+    A single index is shared by every routing bin of a table and kept
+    up to date as nodes enter and leave those bins.
+    """
+    def __init__(self):
+        self.by_id = {}
+        self.by_addr = {}
+        # bumped whenever the set of indexed ids changes
+        self.version = 0
+        self._packed = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_packed'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__.setdefault('version', 0)
+        self._packed = None
+
+    def add(self, node):
+        """
+        Index the supplied node.
+        @param node: Node that has become active.
+        """
+        if self.by_id.get(node.node_id) is not node:
+            self.version += 1
+        self.by_id[node.node_id] = node
+        self.by_addr[(node.address, node.port)] = node
+
+    def remove(self, node):
+        """
+        Stop indexing the supplied node.
+        @param node: Node that is no longer active.
+        """
+        if self.by_id.get(node.node_id) is node:
+            del self.by_id[node.node_id]
+            self.version += 1
+        if self.by_addr.get((node.address, node.port)) is node:
+            del self.by_addr[(node.address, node.port)]
+
+    def move(self, node, address, port):
+        """
+        Update the address details of the supplied node.
+        @param node: Node whose external address has changed.
+        @param address: New IP address of the node.
+        @param port: New port number of the node.
+        """
+        indexed = self.by_id.get(node.node_id) is node
+        if indexed:
+            self.remove(node)
+        node.address = address
+        node.port = port
+        if indexed:
+            self.add(node)
+
+    def packed(self):
+        """
+        Sorted view of the indexed nodes for batch distance queries,
+        rebuilt only after nodes enter or leave the index.
+        Requires numpy.
+        @return: Tuple of node list and a matching uint64[N,4] array of
+        their ids as big endian 64 bit words, both in id order.
+        """
+        if not self._packed or self._packed[0] != self.version:
+            nodes = sorted(self.by_id.itervalues(), key=lambda x: x.long_id)
+            self._packed = (self.version, nodes,
+                            pack_ids([ x.long_id for x in nodes ]))
+        return self._packed[1:]
+
+    def closest_to_many(self, targets, max_nodes=K):
+        """
+        Find the indexed nodes closest to each of the supplied targets.
+        Nodes sharing a prefix with a target are contiguous in id order,
+        so the smallest such prefix block holding max_nodes nodes is
+        found for all targets at once by binary search over the prefix
+        length, then ranked on the leading 64 bits of XOR distance.
+        Requires numpy.
+        @param targets: List of target ids
+        @param max_nodes: Maximum number of nodes to return per target
+        @return: List holding a list of nodes for each target, or None
+        where leading 64 bit distances tie and an exact comparison of
+        the full ids is needed.
+        """
+        nodes, words = self.packed()
+        if not targets or len(nodes) <= max_nodes or max_nodes < 1:
+            return [ None for _ in targets ]
+        keys = words[:, 0]
+        results = []
+        for start in xrange(0, len(targets), BATCH_TARGETS):
+            chunk = pack_ids(targets[start:start + BATCH_TARGETS])[:, 0]
+            results += _closest_words(keys, nodes, chunk, max_nodes)
+        return results
+
+
+def candidate_rank(node):
+    """
+    Sort key ordering replacement candidates from most to least
+    preferred: verified before unverified and failed nodes, then
+    fewest failures, then fastest smoothed round trip time.
+    @param node: Replacement candidate
+    @return: Tuple comparing lower for better candidates
+    """
+    return (node.is_failed(), not node.is_verified(), node.failures,
+            node.srtt if node.rtt else NODE_RTO_MAX)
+
 
 class RoutingBin(object):
     """
@@ -259,10 +645,20 @@ class RoutingBin(object):
     an LRU cache for known nodes but with a preference to keep nodes
     that have been active the longest duration.
     """
-    def __init__(self, maxsize=K):
+    # tables pickled before activity was tracked are stale on reload
+    last_activity = 0.0
+
+    def __init__(self, maxsize=K, index=None):
+        """
+        Create a new, empty routing bin.
+        @param maxsize: Maximum number of active nodes.
+        @param index: NodeIndex to keep in sync with the active nodes.
+        """
         self.maxsize = maxsize
+        self.index = index
         self.nodes = OrderedDict()
         self.replacements = OrderedDict()
+        self.last_activity = time.time()
 
     def get_by_id(self, node_id):
         """
@@ -306,17 +702,35 @@ class RoutingBin(object):
         @param node: Node to be added.
         """
         node_id = node.node_id
-        if self.remaining():
+        self.last_activity = time.time()
+        if node_id in self.nodes or self.remaining():
             self.nodes[node_id] = node
+            if self.index is not None:
+                self.index.add(node)
         else:
             # add to replacement cache
             # ensure pushed to end as most recent
             if node_id in self.replacements:
                 self.replacements.pop(node_id)
             self.replacements[node_id] = node
-            # trim if needed
-            if self.replacements > self.maxsize:
-                self.replacements.popitem()
+            # trim least preferred, oldest first, if needed
+            if len(self.replacements) > self.maxsize:
+                worst = max(self.replacements.itervalues(), key=candidate_rank)
+                del self.replacements[worst.node_id]
+
+    def get_candidate(self, node_id):
+        """
+        Return the replacement candidate with the supplied id.
+        @param node_id: Id of node to lookup.
+        @return Node with node_id or None if not found.
+        """
+        return self.replacements.get(node_id)
+
+    def get_candidates(self):
+        """
+        @return List of replacement candidates, oldest first.
+        """
+        return self.replacements.values()
 
     def get_oldest(self):
         """
@@ -334,13 +748,19 @@ class RoutingBin(object):
         @param node_id: Node to remove.
         @return: The node that was removed from the bin.
         """
-        if not node_id in self.get_node_ids():
+        if not node_id in self.nodes:
             return None
-        # promote a replacement node if available
+        # promote the best replacement node if available, newest first
         if self.replacements:
-            repl = self.replacements.popitem(last=True)
+            repl = min(reversed(self.replacements.values()), key=candidate_rank)
+            del self.replacements[repl.node_id]
             self.nodes[repl.node_id] = repl
-        return self.nodes.pop(node_id)
+            if self.index is not None:
+                self.index.add(repl)
+        node = self.nodes.pop(node_id)
+        if self.index is not None:
+            self.index.remove(node)
+        return node
 
     def get_closest_to(self, target, max_nodes=1):
         """
@@ -350,9 +770,9 @@ class RoutingBin(object):
         @param max_nodes: Maximum number of nodes to return.
         @return: A list of closest nodes with len() <= max_nodes
         """
-        nodes = sorted(self.get_all(), key=lambda x: distance(x.node_id, target))
-        nodes = nodes[:max_nodes]
-        return nodes
+        target = id_to_long(target)
+        return heapq.nsmallest(max_nodes, self.nodes.values(),
+                               key=lambda x: x.long_id ^ target)
 
     def remaining(self):
         """
@@ -367,6 +787,7 @@ class RoutingBin(object):
         """
         node = self.nodes.pop(node_id)
         self.nodes[node_id] = node
+        self.last_activity = time.time()
 
     def __len__(self):
         """
@@ -402,7 +823,9 @@ class RoutingZone(object):
         self.prefix = prefix
         self.bdepth = bdepth
         self.binsize = binsize
-        self.routing_bin = RoutingBin(binsize)
+        # one index shared across the whole tree
+        self.index = parent.index if parent else NodeIndex()
+        self.routing_bin = RoutingBin(binsize, self.index)
         self.children = [None, None]
 
     def add(self, node):
@@ -419,7 +842,7 @@ class RoutingZone(object):
         if self.is_leaf():
             self.routing_bin.push(node)
         else:
-            index = bit_number(node.node_id, self.depth)
+            index = bit_number(node.long_id, self.depth)
             self.children[index].add(node)
 
     def remove(self, node):
@@ -435,7 +858,7 @@ class RoutingZone(object):
             if self.parent and self.parent._can_consolidate():
                 self.parent._consolidate()
         else:
-            index = bit_number(node.node_id, self.depth)
+            index = bit_number(node.long_id, self.depth)
             self.children[index].remove(node)
 
     def is_leaf(self):
@@ -450,13 +873,29 @@ class RoutingZone(object):
         @param node_id: Id of node to find
         @return: The corresponding node or None if not found.
         """
+        return self.index.by_id.get(node_id)
+
+    def get_candidate_by_id(self, node_id):
+        """
+        Find the replacement candidate with the specified Id.
+        @param node_id: Id of node to find
+        @return: The corresponding node or None if not found.
+        """
+        target = id_to_long(node_id)
+        zone = self
+        while not zone.is_leaf():
+            zone = zone.children[bit_number(target, zone.depth)]
+        return zone.routing_bin.get_candidate(node_id)
+
+    def get_all_candidates(self):
+        """
+        @return List of replacement candidates waiting for a place
+        in the tree.
+        """
         if self.is_leaf():
-            return self.routing_bin.get_by_id(node_id)
-        else:
-            node = self.children[0].get_node_by_id(node_id)
-            if not node:
-                node = self.children[1].get_node_by_id(node_id)
-            return node
+            return self.routing_bin.get_candidates()
+        return self.children[0].get_all_candidates() + \
+            self.children[1].get_all_candidates()
 
     def get_node_by_addr(self, address, port):
         """
@@ -465,13 +904,16 @@ class RoutingZone(object):
         @param port: UDP port number of node to find
         @return: The corresponding node or None if not found.
         """
-        if self.is_leaf():
-            return self.routing_bin.get_by_address(address, port)
-        else:
-            node = self.children[0].get_node_by_addr(address, port)
-            if not node:
-                node = self.children[1].get_node_by_addr(address, port)
-            return node
+        return self.index.by_addr.get((address, port))
+
+    def update_address(self, node, address, port):
+        """
+        Record a change to the external address of a known node.
+        @param node: Node whose address has changed
+        @param address: New IP address of the node
+        @param port: New UDP port number of the node
+        """
+        self.index.move(node, address, port)
 
     def get_all_nodes(self):
         """
@@ -495,16 +937,71 @@ class RoutingZone(object):
         nodes will be returned if there are not max_nodes available
         in the tree.
         """
-        if self.is_leaf():
-            return self.routing_bin.get_closest_to(target, max_nodes)
-        else:
-            index = bit_number(target, self.depth)
-            nodes = self.children[index].closest_to(target, max_nodes)
-            # not enough nodes.. try other side
-            if len(nodes) < max_nodes:
-                nodes += self.children[not index].closest_to(
-                                            target, max_nodes - len(nodes))
-            return nodes
+        target = id_to_long(target)
+        nodes = []
+        # every node under the child matching the target's next bit is
+        # closer than any node under its sibling, so visiting that child
+        # first reaches the leaves in increasing distance order and we
+        # can stop as soon as enough nodes have been seen
+        zones = [self]
+        while zones and len(nodes) < max_nodes:
+            zone = zones.pop()
+            if zone.is_leaf():
+                nodes += zone.routing_bin.get_closest_to(target,
+                                                max_nodes - len(nodes))
+            else:
+                index = bit_number(target, zone.depth)
+                zones.append(zone.children[not index])
+                zones.append(zone.children[index])
+        return nodes
+
+    def closest_to_many(self, targets, max_nodes=K):
+        """
+        Find the nodes closest in XOR distance to each of the supplied
+        targets.  Equivalent to calling closest_to() per target but
+        ranks all targets together when numpy is available.
+        @param targets: List of target ids
+        @param max_nodes: Maximum number of nodes to return per target
+        @return: List holding the closest_to() result for each target
+        """
+        if not HAS_NUMPY:
+            return [ self.closest_to(x, max_nodes) for x in targets ]
+        results = self.index.closest_to_many(targets, max_nodes)
+        return [ y if y is not None else self.closest_to(x, max_nodes)
+                 for x, y in zip(targets, results) ]
+
+    def touch(self, target):
+        """
+        Record lookup activity in the leaf covering the target id.
+        @param target: Target id of a lookup
+        """
+        target = id_to_long(target)
+        zone = self
+        while not zone.is_leaf():
+            zone = zone.children[bit_number(target, zone.depth)]
+        zone.routing_bin.last_activity = time.time()
+
+    def stale_bins(self, age):
+        """
+        Find leaves without activity in the given period, such as
+        nodes being added or lookups touching their range.
+        @param age: Seconds without activity for a leaf to be stale
+        @return: List of (last activity, depth, prefix) for each stale
+        leaf, least recently active first.  Prefix holds the leading
+        depth bits of the leaf's range as an integer.
+        """
+        cutoff = time.time() - age
+        stale = []
+        zones = [self]
+        while zones:
+            zone = zones.pop()
+            if not zone.is_leaf():
+                zones += zone.children
+            elif zone.routing_bin.last_activity < cutoff:
+                stale.append((zone.routing_bin.last_activity, zone.depth,
+                              int(zone.prefix, 2) if zone.prefix else 0))
+        stale.sort()
+        return stale
 
     def max_depth(self):
         """
@@ -522,7 +1019,7 @@ class RoutingZone(object):
         """
         return self.is_leaf() and self.depth < KEY_BITS and \
             not self.routing_bin.remaining() and \
-            (self.node_id in self.routing_bin.get_node_ids() or \
+            (self.node_id in self.routing_bin.nodes or \
              self.depth < self.bdepth)
 
     def _can_consolidate(self):
@@ -538,7 +1035,7 @@ class RoutingZone(object):
         a leaf zone itself.
         """
         assert not self.is_leaf()
-        self.routing_bin = RoutingBin(self.binsize)
+        self.routing_bin = RoutingBin(self.binsize, self.index)
         for x in self.get_all_nodes():
             self.routing_bin.push(x)
         self.children = [None, None]
@@ -563,7 +1060,7 @@ class RoutingZone(object):
                                        self.routing_bin.maxsize)
         # split based on matching prefix
         for x in self.routing_bin.get_all():
-            index = bit_number(x.node_id, self.depth)
+            index = bit_number(x.long_id, self.depth)
             self.children[index].add(x)
 
         self.routing_bin = None
@@ -624,3 +1121,317 @@ class RoutingZone(object):
             edges += self.children[1]._generate_dot_edges()
         return edges
 
+
+
+class RoutingTable(object):
+    """
+    Flat alternative to the RoutingZone tree with the same public API.
+    Leaves are held in an array of buckets indexed by their common
+    prefix length with our node id, with the last bucket holding
+    every node sharing a longer prefix.  Buckets of short prefix length
+    may be further split by up to bdepth bits for lookup acceleration,
+    exactly as the non-node_id subtrees of a RoutingZone are.
+    Each leaf is keyed by its (depth, prefix) so finding the routing bin
+    for an id never needs more than bdepth dict lookups.
+    """
+    def __init__(self, node_id, bdepth=B, binsize=K):
+        """
+        Creates a new, empty routing table.
+        @param node_id: The id of our node.
+        @param bdepth: Extra depth allowed to split to in non-node_id
+        buckets.  This allows greater knowledge of the network for faster
+        lookups.
+        @param binsize: Max size of routing bins for each leaf.
+        """
+        self.node_id = node_id
+        self.long_id = id_to_long(node_id)
+        self.bdepth = bdepth
+        self.binsize = binsize
+        self.index = NodeIndex()
+        # bucket i maps (depth, prefix) -> RoutingBin
+        self.buckets = [{(0, 0): RoutingBin(binsize, self.index)}]
+
+    def _locate(self, long_id):
+        """
+        Find the leaf that does or would contain the given id.
+        @param long_id: Id in integer form
+        @return: Tuple of bucket index, leaf key and routing bin
+        """
+        index = min(len(self.buckets) - 1,
+                    max(0, KEY_BITS - (long_id ^ self.long_id).bit_length()))
+        bucket = self.buckets[index]
+        if index == len(self.buckets) - 1:
+            # last bucket is always a single leaf at depth == index
+            key, routing_bin = bucket.items()[0]
+            return index, key, routing_bin
+        for depth in xrange(index + 1, max(index + 1, self.bdepth) + 1):
+            key = (depth, long_id >> (KEY_BITS - depth))
+            routing_bin = bucket.get(key)
+            if routing_bin is not None:
+                return index, key, routing_bin
+        raise AssertionError('No leaf for id')
+
+    def _can_split(self, key, routing_bin):
+        """
+        @return: True if the given leaf is eligible to split, otherwise False.
+        """
+        depth = key[0]
+        return depth < KEY_BITS and not routing_bin.remaining() and \
+            (self.node_id in routing_bin.nodes or depth < self.bdepth)
+
+    def _split(self, index, key, routing_bin):
+        """
+        Split the given leaf into two leaves one bit deeper.
+        Splitting the last bucket appends a new last bucket.
+        """
+        depth, prefix = key
+        children = [RoutingBin(self.binsize, self.index),
+                    RoutingBin(self.binsize, self.index)]
+        for x in routing_bin.get_all():
+            children[bit_number(x.long_id, depth)].push(x)
+        del self.buckets[index][key]
+        if index == len(self.buckets) - 1:
+            own = bit_number(self.long_id, depth)
+            self.buckets[index][(depth + 1, (prefix << 1) | (not own))] = \
+                children[not own]
+            self.buckets.append({(depth + 1, (prefix << 1) | own): children[own]})
+        else:
+            self.buckets[index][(depth + 1, prefix << 1)] = children[0]
+            self.buckets[index][(depth + 1, (prefix << 1) | 1)] = children[1]
+
+    def add(self, node):
+        """
+        Add the specified node into the table.
+        Node is assumed to not already exist and is not guaranteed
+        to be added if the bucket is full for its given prefix.
+        @param node: Node to add.
+        """
+        while True:
+            index, key, routing_bin = self._locate(node.long_id)
+            if not self._can_split(key, routing_bin):
+                routing_bin.push(node)
+                return
+            self._split(index, key, routing_bin)
+
+    def remove(self, node):
+        """
+        Remove the specified node from the table.
+        The node may not actually be removed if there is still
+        available space in the bucket for its given prefix.
+        @param node: Node to remove.
+        """
+        index, key, routing_bin = self._locate(node.long_id)
+        routing_bin.pop(node.node_id)
+        depth, prefix = key
+        if not depth:
+            return
+        if index == len(self.buckets) - 1 or depth == index + 1:
+            # parent is on our own id's path and spans every bucket
+            # from depth - 1 onwards
+            parent = depth - 1
+            count = sum(len(x) for x in self._bins(parent))
+            if count <= self.binsize / 2:
+                self._consolidate(parent, (parent, self.long_id >> (KEY_BITS - parent)))
+        else:
+            parent = (depth - 1, prefix >> 1)
+            leaves = [ x for x in self.buckets[index] if x[0] > parent[0]
+                      and x[1] >> (x[0] - parent[0]) == parent[1] ]
+            if sum(len(self.buckets[index][x]) for x in leaves) <= self.binsize / 2:
+                merged = RoutingBin(self.binsize, self.index)
+                for x in sorted(leaves):
+                    for y in self.buckets[index].pop(x).get_all():
+                        merged.push(y)
+                self.buckets[index][parent] = merged
+
+    def _bins(self, start=0):
+        """
+        @param start: First bucket index to include
+        @return: List of routing bins from the given bucket onwards
+        """
+        return [ y for x in self.buckets[start:] for _, y in sorted(x.items()) ]
+
+    def _consolidate(self, index, key):
+        """
+        Roll up every bucket from index onwards into a single last bucket.
+        """
+        merged = RoutingBin(self.binsize, self.index)
+        for x in self._bins(index):
+            for y in x.get_all():
+                merged.push(y)
+        self.buckets[index:] = [{key: merged}]
+
+    def is_leaf(self):
+        """
+        @return: True if the table has never split, otherwise False.
+        """
+        return len(self.buckets) == 1
+
+    def get_node_by_id(self, node_id):
+        """
+        Find the node with the specified Id.
+        @param node_id: Id of node to find
+        @return: The corresponding node or None if not found.
+        """
+        return self.index.by_id.get(node_id)
+
+    def get_candidate_by_id(self, node_id):
+        """
+        Find the replacement candidate with the specified Id.
+        @param node_id: Id of node to find
+        @return: The corresponding node or None if not found.
+        """
+        return self._locate(id_to_long(node_id))[2].get_candidate(node_id)
+
+    def get_all_candidates(self):
+        """
+        @return List of replacement candidates waiting for a place
+        in the table.
+        """
+        return [ y for x in self._bins() for y in x.get_candidates() ]
+
+    def get_node_by_addr(self, address, port):
+        """
+        Find the node with the specified address and port.
+        @param address: IP address of node to find
+        @param port: UDP port number of node to find
+        @return: The corresponding node or None if not found.
+        """
+        return self.index.by_addr.get((address, port))
+
+    def update_address(self, node, address, port):
+        """
+        Record a change to the external address of a known node.
+        @param node: Node whose address has changed
+        @param address: New IP address of the node
+        @param port: New UDP port number of the node
+        """
+        self.index.move(node, address, port)
+
+    def get_all_nodes(self):
+        """
+        @return List of all active nodes in table
+        """
+        return [ y for x in self._bins() for y in x.get_all() ]
+
+    def closest_to(self, target, max_nodes=K):
+        """
+        Find and return the specified number of nodes
+        closest in XOR distance to the supplied target value.
+        @param target: Target id to calculate distance
+        @param max_nodes: Maximum number of nodes to return
+        @return: List of nodes where len() <= max_nodes.  Fewer
+        nodes will be returned if there are not max_nodes available
+        in the table.
+        """
+        target = id_to_long(target)
+        last = len(self.buckets) - 1
+        index = min(last, max(0, KEY_BITS - (target ^ self.long_id).bit_length()))
+        # nodes in the target's own bucket are closest, then those sharing
+        # a longer prefix with our id (all differing from the target at
+        # bit index), then each shorter prefix bucket in turn
+        groups = [[index]]
+        if index < last:
+            groups.append(range(index + 1, last + 1))
+        groups += [ [x] for x in xrange(index - 1, -1, -1) ]
+        nodes = []
+        for group in groups:
+            if len(nodes) >= max_nodes:
+                break
+            # leaves cover disjoint distance ranges from the target so
+            # ordering them by their lower bound keeps nodes in order
+            leaves = []
+            for x in group:
+                for key, routing_bin in self.buckets[x].iteritems():
+                    shift = KEY_BITS - key[0]
+                    leaves.append((((target >> shift) ^ key[1]) << shift,
+                                   key, routing_bin))
+            leaves.sort()
+            for _, _, routing_bin in leaves:
+                if len(nodes) >= max_nodes:
+                    break
+                nodes += routing_bin.get_closest_to(target,
+                                                    max_nodes - len(nodes))
+        return nodes
+
+    def closest_to_many(self, targets, max_nodes=K):
+        """
+        Find the nodes closest in XOR distance to each of the supplied
+        targets.  Equivalent to calling closest_to() per target but
+        ranks all targets together when numpy is available.
+        @param targets: List of target ids
+        @param max_nodes: Maximum number of nodes to return per target
+        @return: List holding the closest_to() result for each target
+        """
+        if not HAS_NUMPY:
+            return [ self.closest_to(x, max_nodes) for x in targets ]
+        results = self.index.closest_to_many(targets, max_nodes)
+        return [ y if y is not None else self.closest_to(x, max_nodes)
+                 for x, y in zip(targets, results) ]
+
+    def touch(self, target):
+        """
+        Record lookup activity in the leaf covering the target id.
+        @param target: Target id of a lookup
+        """
+        self._locate(id_to_long(target))[2].last_activity = time.time()
+
+    def stale_bins(self, age):
+        """
+        Find leaves without activity in the given period, such as
+        nodes being added or lookups touching their range.
+        @param age: Seconds without activity for a leaf to be stale
+        @return: List of (last activity, depth, prefix) for each stale
+        leaf, least recently active first.  Prefix holds the leading
+        depth bits of the leaf's range as an integer.
+        """
+        cutoff = time.time() - age
+        stale = [ (routing_bin.last_activity, key[0], key[1])
+                  for bucket in self.buckets
+                  for key, routing_bin in bucket.iteritems()
+                  if routing_bin.last_activity < cutoff ]
+        stale.sort()
+        return stale
+
+    def max_depth(self):
+        """
+        @return: Maximum depth level of the table.
+        """
+        return max(key[0] for x in self.buckets for key in x)
+
+    def visualise(self):
+        """
+        Generate a dot file representing this routing table
+        in the same form as RoutingZone.visualise().
+        @return String buffer with dot syntax reprensenting the table.
+        """
+        def label(depth, prefix):
+            return depth and format(prefix, '0%ib' % depth) or 'None'
+
+        def format_node(node):
+            if self.node_id == node.node_id:
+                return '{{** {0} **|{1}:{2}}}' \
+                    .format(binascii.hexlify(node.node_id),
+                            node.address, node.port)
+            return '{{{0}|{1}:{2}}}' \
+                .format(binascii.hexlify(node.node_id),
+                        node.address, node.port)
+        leaves = sorted((key, y) for x in self.buckets for key, y in x.items())
+        branches = set()
+        for (depth, prefix), _ in leaves:
+            for x in xrange(depth):
+                branches.add((x, prefix >> (depth - x)))
+        nodes = ''
+        edges = ''
+        for depth, prefix in sorted(branches):
+            nodes += '{0}[label="prefix={0}"];'.format(label(depth, prefix))
+            for x in (0, 1):
+                edges += '{0}->{1}[label={2}];' \
+                    .format(label(depth, prefix),
+                            label(depth + 1, (prefix << 1) | x), x)
+        for (depth, prefix), routing_bin in leaves:
+            nodes += '{0}[label="{{prefix={0}|{1}}}"];' \
+                .format(label(depth, prefix),
+                        '|'.join([ format_node(x)
+                            for x in routing_bin.get_all() ]))
+        return 'digraph G{{graph[ranskep=0];' \
+            'node[shape=record];{0}{1}}}'.format(nodes, edges)
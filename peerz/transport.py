@@ -14,13 +14,20 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from functools import update_wrapper, wraps
 import logging
-import math
+import socket
 import struct
+import sys
 import time
+import zlib
 
+try:
+    import lz4.block
+    HAS_LZ4 = True
+except ImportError:
+    HAS_LZ4 = False
 import zmq
 from zmq.auth import CURVE_ALLOW_ANY
 from zmq.auth.thread import ThreadAuthenticator
@@ -34,6 +41,107 @@ LOGGER = logging.getLogger(__name__)
 
 OPTION_PLAIN = 0x01
 OPTION_CURVE = 0x02
+OPTION_SESSION = 0x03
+# low bits of the packet mode hold the option, high bits the features
+# the sender supports, codecs it can decompress and payload header
+# versions, along with the header version of this packet.  Peers that
+# have not advertised any features are sent the baseline mode alone.
+OPTION_MASK = 0x03
+FEATURE_MASK = 0x7C
+FEATURE_NODES = 0x04
+FEATURE_SESSION = 0x08
+FEATURE_PAYLOAD_V1 = 0x40
+HEADER_V1 = 0x80
+
+# message type flag for compressed content, prefixed by a codec id
+COMPRESSED = 0x80
+CODEC_ZLIB = 0x01
+CODEC_LZ4 = 0x02
+# smallest content worth compressing
+COMPRESS_MIN = 512
+# bytes trial compressed to detect incompressible content
+COMPRESS_SAMPLE = 4096
+# compressed size, relative to the original, worth sending
+COMPRESS_RATIO = 0.9
+# largest decompressed message accepted
+DECOMPRESS_MAX = 16 * 1024 * 1024
+
+# seconds to wait for all fragments of a message
+DEFRAG_TIMEOUT = 10
+# buffer budget for partially received messages
+DEFRAG_MAX_BYTES = 16 * 1024 * 1024
+# budget for the partial messages of any one peer, and so the largest
+# fragmented message accepted
+DEFRAG_MAX_PEER_BYTES = 4 * 1024 * 1024
+# partially received messages allowed per peer
+DEFRAG_MAX_PER_PEER = 16
+
+# message type of requests to resend missing fragments
+MSG_NACK = 0x7F
+# seconds without progress before missing fragments are requested
+NACK_IDLE = 0.25
+# requests sent for any one message
+NACK_RETRIES = 3
+# first missing fragment, followed by a bitmap of missing fragments
+NACK_HEADER = struct.Struct('!H')
+# budget for sent messages kept to answer resend requests
+RETRANSMIT_MAX_BYTES = 4 * 1024 * 1024
+# message type acknowledging a fragmented message
+MSG_ACK = 0x7D
+# number of the last fragment of the acknowledged message
+ACK_HEADER = struct.Struct('!H')
+# message type advertising the sender's features to peers not yet
+# known to support them, sent in the baseline format older peers
+# read and then ignore
+MSG_FEATURES = 0x7B
+# message type offering a peer a session to send to us in, only
+# accepted Box encrypted
+MSG_SESSION = 0x79
+
+# congestion window, in fragments per round trip, of new peers
+PACE_CWND_INITIAL = 32
+PACE_CWND_MIN = 4
+PACE_CWND_MAX = 4096
+# fragments that may be sent back to back
+PACE_BURST = 8
+# round trip in milliseconds assumed for peers not yet measured
+PACE_RTT_DEFAULT = 100.0
+# seconds before the state of idle peers is forgotten
+PACE_IDLE = 300
+
+# queries per second answered for each peer, and in bursts of
+QUERY_RATE = 20.0
+QUERY_BURST = 50
+# queries per second answered for all peers together, and in bursts of
+QUERY_GLOBAL_RATE = 1000.0
+QUERY_GLOBAL_BURST = 2000
+# maximum number of peers with query buckets
+QUERY_MAX_PEERS = 4096
+
+# node id and mode
+PACKET_HEADER = struct.Struct('!32sB')
+# txid, msgtype, fragment, last fragment and length
+FRAGMENT_HEADER = struct.Struct('!4sBBBH')
+# version, flags, txid, msgtype, fragment, last fragment, fragment size
+# and length
+FRAGMENT_HEADER_V1 = struct.Struct('!BB4sBHHHH')
+PAYLOAD_V1 = 1
+# largest fragment size, an encrypted fragment fits a 9000 byte jumbo
+# frame over IPv6
+MAX_FRAGMENT_V1 = 8860
+# fragment sizes probed per peer, largest first, the second fits a
+# 1500 byte ethernet frame over IPv6
+MTU_CANDIDATES = (MAX_FRAGMENT_V1, 1360)
+
+# binary node list entries, id and address family then address and
+# port, or for hostnames a family of 0 and the name's length
+NODE_IPV4 = '32sB4sH'
+NODE_IPV6 = '32sB16sH'
+NODE_HEADER = struct.Struct('!32sB')
+NODE_NAME = struct.Struct('!32sBB')
+NODE_PORT = struct.Struct('!H')
+NODE_V4 = struct.Struct('!' + NODE_IPV4)
+NODE_V6 = struct.Struct('!' + NODE_IPV6)
 
 class InvalidPacket(Exception):
     pass
@@ -53,12 +161,12 @@ class Packet(object):
         self.length = len(payload)
 
     def unpack(self, msg):
-        if msg < 36:
+        if len(msg) < PACKET_HEADER.size + FRAGMENT_HEADER.size:
             raise InvalidPacket("Packet too small")
 #         prot, self.major, self.minor, self.node_id, self.mode, self.length = struct.unpack('!3sBB32sBI', msg[:42])
 #         self.payload = msg[42:]
-        self.node_id, self.mode = struct.unpack('!32sB', msg[:33])
-        self.payload = msg[33:]
+        self.node_id, self.mode = PACKET_HEADER.unpack_from(msg)
+        self.payload = msg[PACKET_HEADER.size:]
 
 #         if prot != PROTOCOL_MAGIC:
 #             raise InvalidPacket("Expected protocol %s got %s" % (PROTOCOL_MAGIC, prot))
@@ -73,7 +181,7 @@ class Packet(object):
     @property
     def msg(self):
 #         return struct.pack('!3sBB32sBI', PROTOCOL_MAGIC, self.major, self.minor, self.node_id, self.mode, self.length) + self.payload
-        return struct.pack('!32sB', self.node_id, self.mode) + self.payload
+        return PACKET_HEADER.pack(self.node_id, self.mode) + self.payload
 
 class Payload(object):
     MAX_FRAGMENT = 1100
@@ -81,37 +189,850 @@ class Payload(object):
     def __init__(self):
         self.fragments = []
 
-    def pack(self, txid, msgtype, content=b''):
-        self.lastfrag = math.floor(len(content) / Payload.MAX_FRAGMENT)
-        fragment = 0
-        while len(content) > Payload.MAX_FRAGMENT:
-            part = content[:Payload.MAX_FRAGMENT]
-            content = content[Payload.MAX_FRAGMENT:]
-            self.fragments.append(struct.pack('!4sBBBH', txid, msgtype, fragment, self.lastfrag, len(part)) + part)
-            fragment += 1
-        self.fragments.append(struct.pack('!4sBBBH', txid, msgtype, fragment, self.lastfrag, len(content)) + content)
+    def pack(self, txid, msgtype, content=b'', fragsize=None, version=0):
+        self.fragsize = fragsize_for(version, fragsize)
+        self.lastfrag, spans = fragment_spans(len(content), self.fragsize)
+        check_fragments(version, self.lastfrag)
+        for fragment, start, end in spans:
+            self.fragments.append(pack_fragment_header(version, txid, msgtype, fragment, self.lastfrag, self.fragsize, end - start) + content[start:end])
 
-    def unpack(self, payload):
-        self.txid, self.msgtype, self.fragment, self.lastfrag, self.content_length = struct.unpack('!4sBBBH', payload[:9])
-        self.content = payload[9:self.content_length + 9]  # cater for padding
+    def unpack(self, payload, version=0):
+        if version >= PAYLOAD_V1:
+            header = FRAGMENT_HEADER_V1
+            _, _, self.txid, self.msgtype, self.fragment, self.lastfrag, self.fragsize, self.content_length = header.unpack_from(payload)
+        else:
+            header = FRAGMENT_HEADER
+            self.txid, self.msgtype, self.fragment, self.lastfrag, self.content_length = header.unpack_from(payload)
+            self.fragsize = Payload.MAX_FRAGMENT
+        self.content = payload[header.size:self.content_length + header.size]  # cater for padding
 
-class DefragMap(object):
-    def __init__(self):
-        self.map = {}
+def fragsize_for(version, fragsize=None):
+    """
+    @return: Fragment size to use with the given payload header version
+    """
+    if version >= PAYLOAD_V1:
+        return min(fragsize or Payload.MAX_FRAGMENT, MAX_FRAGMENT_V1)
+    return Payload.MAX_FRAGMENT
+
+def check_fragments(version, lastfrag):
+    """
+    @raise InvalidPacket: If the header version can not number the
+    given fragments.
+    """
+    if lastfrag > (version >= PAYLOAD_V1 and 0xFFFF or 0xFF):
+        raise InvalidPacket("Message needs %i fragments" % (lastfrag + 1))
+
+def pack_fragment_header(version, txid, msgtype, fragment, lastfrag,
+                         fragsize, length):
+    """
+    @return: Fragment header of the given payload header version
+    """
+    if version >= PAYLOAD_V1:
+        return FRAGMENT_HEADER_V1.pack(PAYLOAD_V1, 0, txid, msgtype, fragment,
+                                       lastfrag, fragsize, length)
+    return FRAGMENT_HEADER.pack(txid, msgtype, fragment, lastfrag, length)
+
+def fragment_spans(length, fragsize=None, fragments=None):
+    """
+    Split content of the given length into fragments.
+    @param length: Size of the content in bytes
+    @param fragsize: Maximum size of a fragment
+    @param fragments: Numbers of the fragments wanted, all if None
+    @return: Tuple of the last fragment number and a list of
+    (fragment number, start, end) offsets into the content.
+    """
+    fragsize = fragsize or Payload.MAX_FRAGMENT
+    lastfrag = max(0, length - 1) // fragsize
+    if fragments is None:
+        fragments = xrange(lastfrag + 1)
+    else:
+        fragments = [ x for x in sorted(set(fragments)) if x <= lastfrag ]
+    return lastfrag, [ (x, x * fragsize, min(length, (x + 1) * fragsize))
+                       for x in fragments ]
+
+def sendmsg(sock, buffers, address):
+    """
+    Send the buffers as a single datagram, using scatter/gather IO
+    where the platform supports it, otherwise copying them once into
+    a single buffer.
+    @param sock: Datagram socket
+    @param buffers: List of strings, bytearrays or memoryviews
+    @param address: Destination (address, port)
+    @return: Number of bytes sent
+    """
+    if hasattr(sock, 'sendmsg'):
+        return sock.sendmsg(buffers, [], 0, address)
+    data = bytearray()
+    for x in buffers:
+        data += x
+    return sock.sendto(data, address)
+
+class PacketWriter(object):
+    """
+    Sends messages as datagrams built in place in a single reusable
+    buffer.  Plain fragments go out as views of the buffer's headers
+    and the original content, while encrypted fragments need only the
+    copy taken for encryption.  All the fragments of a call are handed
+    to the encrypt function at once, so it may encrypt them in parallel.
+    """
+    def __init__(self, sock, fragsize=MAX_FRAGMENT_V1):
+        """
+        Create a new writer.
+        @param sock: Datagram socket to send on
+        @param fragsize: Largest fragment size to be sent
+        """
+        self.sock = sock
+        self.buffer = bytearray(PACKET_HEADER.size + FRAGMENT_HEADER_V1.size +
+                                fragsize)
+        self.view = memoryview(self.buffer)
+        self.scatter = hasattr(sock, 'sendmsg')
+
+    def send(self, address, node_id, mode, txid, msgtype, content=b'',
+             encrypt=None, fragsize=None, version=0, fragments=None):
+        """
+        Fragment and send a message.
+        @param address: Destination (address, port)
+        @param node_id: Id of the sending node
+        @param mode: Packet mode, OPTION_PLAIN or OPTION_CURVE
+        @param txid: Transaction id of the message
+        @param msgtype: Message type
+        @param content: Message content
+        @param encrypt: Function returning a list of fragments encrypted,
+        in order, given a list of fragments
+        @param fragsize: Fragment size, for version 1 payload headers
+        @param version: Payload header version the receiver supports
+        @param fragments: Numbers of the fragments to send, all if None
+        @return: Number of datagrams sent
+        @raise InvalidPacket: If the message needs too many fragments
+        """
+        content = memoryview(content)
+        fragsize = min(fragsize_for(version, fragsize),
+                       len(self.buffer) - PACKET_HEADER.size - FRAGMENT_HEADER_V1.size)
+        lastfrag, spans = fragment_spans(len(content), fragsize, fragments)
+        check_fragments(version, lastfrag)
+        PACKET_HEADER.pack_into(self.buffer, 0, node_id, mode)
+        header = version >= PAYLOAD_V1 and FRAGMENT_HEADER_V1 or FRAGMENT_HEADER
+        body = PACKET_HEADER.size + header.size
+        plain = []
+        for fragment, start, end in spans:
+            if version >= PAYLOAD_V1:
+                header.pack_into(self.buffer, PACKET_HEADER.size, PAYLOAD_V1, 0,
+                                 txid, msgtype, fragment, lastfrag, fragsize,
+                                 end - start)
+            else:
+                header.pack_into(self.buffer, PACKET_HEADER.size, txid,
+                                 msgtype, fragment, lastfrag, end - start)
+            if encrypt:
+                self.buffer[body:body + end - start] = content[start:end]
+                plain.append(self.view[PACKET_HEADER.size:body + end - start].tobytes())
+            elif self.scatter:
+                self.sock.sendmsg([self.view[:body], content[start:end]], [], 0, address)
+            else:
+                self.buffer[body:body + end - start] = content[start:end]
+                self.sock.sendto(self.view[:body + end - start], address)
+        if encrypt:
+            for data in encrypt(plain):
+                sendmsg(self.sock, [self.view[:PACKET_HEADER.size], data], address)
+        return len(spans)
+
+def set_dont_fragment(sock):
+    """
+    Ask the OS to set the don't fragment bit on datagrams sent from the
+    socket, so oversized fragments are dropped rather than fragmented
+    and probes find the real path MTU.  Only supported on Linux.
+    @param sock: IPv4 datagram socket
+    """
+    if not sys.platform.startswith('linux'):
+        return
+    try:
+        # IP_MTU_DISCOVER, IP_PMTUDISC_DO
+        sock.setsockopt(socket.IPPROTO_IP, getattr(socket, 'IP_MTU_DISCOVER', 10),
+                        getattr(socket, 'IP_PMTUDISC_DO', 2))
+    except socket.error, ex:
+        LOGGER.debug('Unable to set dont fragment: %s', ex)
+
+class PeerPacer(object):
+    """
+    Congestion window and queued messages of a single peer.
+    """
+    __slots__ = ['cwnd', 'ssthresh', 'rtt', 'tokens', 'updated', 'queue',
+                 'last_loss']
+
+    def __init__(self, cwnd, burst, now):
+        self.cwnd = float(cwnd)
+        self.ssthresh = float(PACE_CWND_MAX)
+        self.rtt = PACE_RTT_DEFAULT
+        self.tokens = float(burst)
+        self.updated = now
+        self.queue = deque() # [send() arguments, fragments, position]
+        self.last_loss = 0.0
+
+    def interval(self):
+        """
+        @return: Seconds between fragments at the current window
+        """
+        return self.rtt / 1000.0 / self.cwnd
+
+class SendScheduler(object):
+    """
+    Paces the fragments of messages sent to each peer, rather than
+    sending them back to back.  Peers get up to cwnd fragments per
+    round trip, released in bursts of at most PACE_BURST.  The window
+    grows as fragmented messages are acknowledged, doubling each
+    round trip until the first loss, and halves at most once per
+    round trip when fragments are reported missing.
+    """
+    def __init__(self, writer, cwnd=PACE_CWND_INITIAL, burst=PACE_BURST,
+                 idle=PACE_IDLE):
+        """
+        Create a new scheduler.
+        @param writer: PacketWriter to send fragments with
+        @param cwnd: Initial congestion window of each peer
+        @param burst: Fragments that may be sent back to back
+        @param idle: Seconds to keep the state of idle peers
+        """
+        self.writer = writer
+        self.cwnd = cwnd
+        self.burst = burst
+        self.idle = idle
+        self.peers = {} # peer id -> PeerPacer
+        self.failed = 0
+
+    def _pacer(self, peer, now):
+        pacer = self.peers.get(peer)
+        if pacer is None:
+            pacer = self.peers[peer] = PeerPacer(self.cwnd, self.burst, now)
+        return pacer
+
+    def send(self, node, node_id, mode, txid, msgtype, content=b'',
+             encrypt=None, fragsize=None, version=0, fragments=None,
+             now=None):
+        """
+        Queue a message to a peer, sending as many fragments as its
+        window allows straight away.  Arguments are as for
+        PacketWriter.send().
+        @param node: Destination node
+        @param now: Current time, for testing
+        @return: Number of fragments queued
+        """
+        if now is None:
+            now = time.time()
+        fragsize = fragsize_for(version, fragsize)
+        lastfrag, spans = fragment_spans(len(content), fragsize, fragments)
+        check_fragments(version, lastfrag)
+        pacer = self._pacer(node.node_id, now)
+        if node.srtt:
+            pacer.rtt = node.srtt
+        pacer.queue.append([((node.address, node.port), node_id, mode, txid,
+                             msgtype, content, encrypt, fragsize, version),
+                            [ x[0] for x in spans ], 0])
+        self._flush(pacer, now)
+        return len(spans)
+
+    def _flush(self, pacer, now):
+        pacer.tokens = min(self.burst, pacer.tokens +
+                           (now - pacer.updated) / pacer.interval())
+        pacer.updated = now
+        while pacer.queue and pacer.tokens >= 1:
+            job = pacer.queue[0]
+            args, fragments, position = job
+            take = fragments[position:position + int(pacer.tokens)]
+            try:
+                self.writer.send(*args, fragments=take)
+            except Exception, ex:
+                # e.g. too large for the path or the session with the
+                # peer dropped, retrying will not help
+                LOGGER.debug('Dropping queued message: %s', ex)
+                self.failed += 1
+                pacer.queue.popleft()
+                continue
+            pacer.tokens -= len(take)
+            job[2] += len(take)
+            if job[2] >= len(fragments):
+                pacer.queue.popleft()
+
+    def pending(self, peer, txid):
+        """
+        @param peer: Id of the peer
+        @param txid: Transaction id of the message
+        @return: Set of the message's fragments still queued
+        """
+        pacer = self.peers.get(peer)
+        if pacer is None:
+            return set()
+        return set(y for args, fragments, position in pacer.queue
+                   if args[3] == txid for y in fragments[position:])
+
+    def flush(self, now=None):
+        """
+        Send the queued fragments that are due.
+        @param now: Current time, for testing
+        """
+        if now is None:
+            now = time.time()
+        for pacer in self.peers.values():
+            if pacer.queue:
+                self._flush(pacer, now)
+
+    def next_send(self):
+        """
+        @return: Time the next queued fragment is due, None if nothing
+        is queued.
+        """
+        due = [ x.updated + (1 - x.tokens) * x.interval()
+                for x in self.peers.itervalues() if x.queue ]
+        return due and min(due) or None
+
+    def ack(self, peer, fragments):
+        """
+        Grow the window of a peer as it acknowledges a message.
+        @param peer: Id of the peer
+        @param fragments: Number of fragments acknowledged
+        """
+        pacer = self.peers.get(peer)
+        if pacer is None:
+            return
+        if pacer.cwnd < pacer.ssthresh:
+            pacer.cwnd += fragments
+        else:
+            pacer.cwnd += float(fragments) / pacer.cwnd
+        pacer.cwnd = min(pacer.cwnd, PACE_CWND_MAX)
+
+    def loss(self, peer, now=None):
+        """
+        Shrink the window of a peer reporting missing fragments.
+        @param peer: Id of the peer
+        @param now: Current time, for testing
+        """
+        pacer = self.peers.get(peer)
+        if pacer is None:
+            return
+        if now is None:
+            now = time.time()
+        # losses within a round trip are from the same burst
+        if now - pacer.last_loss < pacer.rtt / 1000.0:
+            return
+        pacer.last_loss = now
+        pacer.ssthresh = pacer.cwnd = max(PACE_CWND_MIN, pacer.cwnd / 2)
+
+    def expire(self, now=None):
+        """
+        Forget the state of peers with nothing queued for a while.
+        @param now: Current time, for testing
+        """
+        if now is None:
+            now = time.time()
+        for peer, pacer in self.peers.items():
+            if not pacer.queue and now - pacer.updated > self.idle:
+                del self.peers[peer]
+
+    def stats(self):
+        """
+        @return: Dict of peers paced, fragments queued and messages
+        dropped as they failed to send
+        """
+        return {'peers': len(self.peers),
+                'queued': sum(len(y[1]) - y[2] for x in self.peers.itervalues()
+                              for y in x.queue),
+                'failed': self.failed}
+
+class TokenBucket(object):
+    """
+    Allows rate events per second, in bursts of at most burst.
+    """
+    __slots__ = ['rate', 'burst', 'tokens', 'updated']
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = now
+
+    def refill(self, now):
+        """
+        Add the tokens earned since last updated.
+        @param now: Current time
+        """
+        if now > self.updated:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
 
-    # TODO add expiry
+    def take(self, now):
+        """
+        @param now: Current time
+        @return: True if a token was available and taken
+        """
+        self.refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class AdmissionControl(object):
+    """
+    Limits the queries answered for each peer, and for all peers,
+    with token buckets so one peer can not monopolise the engine.
+    Peers over their limit are blocked until their bucket has a token
+    again, letting their packets be dropped before being decrypted.
+    """
+    def __init__(self, rate=QUERY_RATE, burst=QUERY_BURST,
+                 global_rate=QUERY_GLOBAL_RATE,
+                 global_burst=QUERY_GLOBAL_BURST, maxpeers=QUERY_MAX_PEERS):
+        """
+        Create a new admission control.
+        @param rate: Queries per second answered for each peer
+        @param burst: Queries each peer may send back to back
+        @param global_rate: Queries per second answered for all peers
+        @param global_burst: Queries all peers may send back to back
+        @param maxpeers: Maximum number of peers with buckets
+        """
+        self.rate = rate
+        self.burst = burst
+        self.maxpeers = maxpeers
+        # starts full, so when it was last updated does not matter
+        self.total = TokenBucket(global_rate, global_burst, 0)
+        self.buckets = OrderedDict() # peer id -> TokenBucket, least recent first
+        self.blocking = set()
+        self.admitted = 0
+        self.dropped = 0
+        self.dropped_global = 0
+        self.dropped_early = 0
+
+    def _bucket(self, peer, now):
+        bucket = self.buckets.pop(peer, None)
+        if bucket is None:
+            if len(self.buckets) >= self.maxpeers:
+                oldest, _ = self.buckets.popitem(last=False)
+                self.blocking.discard(oldest)
+            bucket = TokenBucket(self.rate, self.burst, now)
+        self.buckets[peer] = bucket
+        return bucket
+
+    def blocked(self, peer, now=None):
+        """
+        Cheap check of a packet before it is decrypted.
+        @param peer: Id of the sending peer
+        @param now: Current time, for testing
+        @return: True if the peer is over its limit and the packet
+        should be dropped
+        """
+        if peer not in self.blocking:
+            return False
+        if now is None:
+            now = time.time()
+        bucket = self.buckets[peer]
+        bucket.refill(now)
+        if bucket.tokens >= 1:
+            self.blocking.discard(peer)
+            return False
+        self.dropped_early += 1
+        return True
 
-    def get_msg(self, txid, fragid, maxfrag, fragment):
+    def admit(self, peer, now=None):
+        """
+        Take a token for answering a query.
+        @param peer: Id of the querying peer
+        @param now: Current time, for testing
+        @return: True if the query should be answered
+        """
+        if now is None:
+            now = time.time()
+        bucket = self._bucket(peer, now)
+        if not bucket.take(now):
+            self.dropped += 1
+            self.blocking.add(peer)
+            return False
+        if not self.total.take(now):
+            # not the peer's fault, leave its token
+            bucket.tokens += 1
+            self.dropped_global += 1
+            return False
+        self.admitted += 1
+        return True
+
+    def expire(self, now=None):
+        """
+        Forget the buckets of peers that have refilled, new buckets
+        start full anyway.
+        @param now: Current time, for testing
+        """
+        if now is None:
+            now = time.time()
+        for peer, bucket in self.buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[peer]
+                self.blocking.discard(peer)
+
+    def stats(self):
+        """
+        @return: Dict of peers with buckets, peers blocked and counts
+        of queries admitted and dropped
+        """
+        return {'peers': len(self.buckets),
+                'blocked': len(self.blocking),
+                'admitted': self.admitted,
+                'dropped': self.dropped,
+                'dropped_global': self.dropped_global,
+                'dropped_early': self.dropped_early}
+
+class PartialMessage(object):
+    """
+    Fragments of a message received so far, kept as they arrive and
+    joined once all are in, so the memory held follows the bytes
+    received rather than the size the sender declared.
+    """
+    __slots__ = ['peer', 'address', 'features', 'maxfrag', 'fragsize',
+                 'fragments', 'remaining', 'size', 'deadline', 'updated',
+                 'nacks']
+
+    def __init__(self, peer, maxfrag, fragsize, deadline, address=None,
+                 updated=None, features=0):
+        self.peer = peer
+        self.address = address
+        self.features = features
+        self.maxfrag = maxfrag
+        self.fragsize = fragsize
+        self.fragments = {}
+        self.remaining = maxfrag + 1
+        self.size = 0
+        self.deadline = deadline
+        self.updated = updated
+        self.nacks = 0
+
+    def missing(self):
+        """
+        @return: Numbers of the fragments yet to arrive
+        """
+        return [ i for i in xrange(self.maxfrag + 1)
+                 if i not in self.fragments ]
+
+    def join(self):
+        """
+        @return: Content of the message, once all fragments are in
+        """
+        return b''.join(self.fragments[i] for i in xrange(self.maxfrag + 1))
+
+class DefragMap(object):
+    """
+    Reassembles fragmented messages within bounded time and memory.
+    Partial messages are dropped once older than the timeout, and the
+    oldest are evicted to stay within the byte budget, each peer's
+    share of it and the limit on partial messages from any one peer.
+    Only fragments received count against the budgets.
+    """
+    def __init__(self, timeout=DEFRAG_TIMEOUT, max_bytes=DEFRAG_MAX_BYTES,
+                 max_per_peer=DEFRAG_MAX_PER_PEER,
+                 fragsize=None, max_peer_bytes=DEFRAG_MAX_PEER_BYTES):
+        """
+        Create a new, empty reassembly map.
+        @param timeout: Seconds to wait for all fragments of a message
+        @param max_bytes: Budget for fragments of partial messages
+        @param max_per_peer: Maximum partial messages from one peer
+        @param fragsize: Size of all but the last fragment of a message
+        @param max_peer_bytes: Budget for fragments from one peer, also
+        the largest message accepted
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.max_per_peer = max_per_peer
+        self.max_peer_bytes = max_peer_bytes
+        self.fragsize = fragsize or Payload.MAX_FRAGMENT
+        self.map = OrderedDict() # (peer, txid) -> PartialMessage, oldest first
+        self.per_peer = {}
+        self.peer_bytes = {}
+        self.bytes = 0
+        self.expired = 0
+        self.evicted = 0
+        self.nacked = 0
+
+    def get_msg(self, txid, fragid, maxfrag, fragment, peer=None, now=None,
+                fragsize=None, address=None, features=0):
+        """
+        Add a received fragment.
+        @param txid: Transaction id of the message
+        @param fragid: Number of this fragment
+        @param maxfrag: Number of the last fragment of the message
+        @param fragment: Content of this fragment
+        @param peer: Id of the sending node
+        @param now: Current time, for testing
+        @param fragsize: Size of all but the last fragment of the
+        message, if given in its header
+        @param address: Address of the sender, for resend requests
+        @param features: Feature bits the sender has advertised, for
+        resend requests to peers not yet in the routing table
+        @return: The complete message once all fragments have been
+        received, otherwise None.
+        """
         # not fragmented
         if fragid == maxfrag == 0:
             return fragment
-        # list of all frags
-        frags = self.map.set_default(txid, [b''] * (maxfrag + 1))
-        frags[fragid] = fragment
-        if all(frags):
-            del self.map[txid]
-            return b''.join(frags)
-        return None
+        fragsize = fragsize or self.fragsize
+        if fragid > maxfrag or not 0 < fragsize <= MAX_FRAGMENT_V1 or \
+                len(fragment) > fragsize or \
+                (fragid < maxfrag and len(fragment) != fragsize):
+            return None
+        if now is None:
+            now = time.time()
+        self.expire(now)
+        key = (peer, txid)
+        partial = self.map.get(key)
+        if partial is None:
+            partial = self._create(peer, maxfrag, fragsize, now, address,
+                                   features)
+            if partial is None:
+                return None
+            self.map[key] = partial
+        elif partial.maxfrag != maxfrag or partial.fragsize != fragsize:
+            return None
+        elif features:
+            partial.features = features
+        if fragid not in partial.fragments:
+            if not self._reserve(key, partial, len(fragment)):
+                return None
+            # receive buffers are reused, keep a copy
+            if isinstance(fragment, memoryview):
+                fragment = fragment.tobytes()
+            partial.fragments[fragid] = fragment
+            partial.remaining -= 1
+            partial.updated = now
+        if partial.remaining:
+            return None
+        self._remove(key)
+        return partial.join()
+
+    def _create(self, peer, maxfrag, fragsize, now, address=None,
+                features=0):
+        # could never be completed within the peer's budget
+        if (maxfrag + 1) * fragsize > self.max_peer_bytes:
+            self.evicted += 1
+            return None
+        while self.per_peer.get(peer, 0) >= self.max_per_peer:
+            self._evict(self._oldest(peer))
+        self.per_peer[peer] = self.per_peer.get(peer, 0) + 1
+        return PartialMessage(peer, maxfrag, fragsize, now + self.timeout,
+                              address, now, features)
+
+    def _reserve(self, key, partial, size):
+        """
+        Make room for a fragment of a partial message, evicting the
+        peer's own oldest messages once over its share, then the oldest
+        overall.
+        @return: False if the message itself had to make way
+        """
+        peer = partial.peer
+        while self.peer_bytes.get(peer, 0) + size > self.max_peer_bytes:
+            self._evict(self._oldest(peer))
+        while self.bytes + size > self.max_bytes:
+            self._evict(next(iter(self.map)))
+        if key not in self.map:
+            return False
+        partial.size += size
+        self.bytes += size
+        self.peer_bytes[peer] = self.peer_bytes.get(peer, 0) + size
+        return True
+
+    def _oldest(self, peer):
+        return next(k for k, v in self.map.iteritems() if v.peer == peer)
+
+    def _remove(self, key):
+        partial = self.map.pop(key)
+        self.bytes -= partial.size
+        count = self.per_peer[partial.peer] - 1
+        if count:
+            self.per_peer[partial.peer] = count
+        else:
+            del self.per_peer[partial.peer]
+        held = self.peer_bytes.get(partial.peer, 0) - partial.size
+        if held:
+            self.peer_bytes[partial.peer] = held
+        else:
+            self.peer_bytes.pop(partial.peer, None)
+
+    def _evict(self, key):
+        self._remove(key)
+        self.evicted += 1
+
+    def expire(self, now=None):
+        """
+        Drop partial messages whose fragments have not all arrived
+        in time.
+        @param now: Current time, for testing
+        """
+        if now is None:
+            now = time.time()
+        # deadlines follow insertion order as the timeout is fixed
+        while self.map:
+            key, partial = next(self.map.iteritems())
+            if partial.deadline > now:
+                break
+            self._remove(key)
+            self.expired += 1
+
+    def gaps(self, now=None, idle=NACK_IDLE, retries=NACK_RETRIES):
+        """
+        Find partial messages that have stopped receiving fragments,
+        so their missing fragments can be requested again.  Each
+        message is reported at most once per idle period and only
+        the given number of times.
+        @param now: Current time, for testing
+        @param idle: Seconds without a new fragment before reporting
+        @param retries: Maximum times to report any one message
+        @return: List of (peer, address, txid, missing fragments,
+        feature bits of the peer)
+        """
+        if now is None:
+            now = time.time()
+        gaps = []
+        for (peer, txid), partial in self.map.iteritems():
+            if partial.nacks < retries and now - partial.updated >= idle:
+                partial.nacks += 1
+                partial.updated = now
+                self.nacked += 1
+                gaps.append((peer, partial.address, txid, partial.missing(),
+                             partial.features))
+        return gaps
+
+    def stats(self):
+        """
+        @return: Dict of reassembly counters
+        """
+        return {'partial': len(self.map),
+                'bytes': self.bytes,
+                'expired': self.expired,
+                'evicted': self.evicted,
+                'nacked': self.nacked}
+
+class RetransmitCache(object):
+    """
+    Recently sent fragmented messages, kept within a byte budget for
+    a limited time to answer requests for missing fragments.
+    """
+    def __init__(self, timeout=DEFRAG_TIMEOUT,
+                 max_bytes=RETRANSMIT_MAX_BYTES):
+        """
+        Create a new, empty cache.
+        @param timeout: Seconds to keep sent messages
+        @param max_bytes: Budget for the content of kept messages
+        """
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.map = OrderedDict() # (peer, txid) -> (deadline, message), oldest first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def add(self, peer, txid, msgtype, content, fragsize, now=None):
+        """
+        Keep a sent message.
+        @param peer: Id of the receiving node
+        @param txid: Transaction id of the message
+        @param msgtype: Message type, as sent
+        @param content: Message content, as sent
+        @param fragsize: Fragment size the message was sent with
+        @param now: Current time, for testing
+        """
+        if len(content) > self.max_bytes:
+            return
+        if now is None:
+            now = time.time()
+        key = (peer, txid)
+        if key in self.map:
+            self._remove(key)
+        while self.bytes + len(content) > self.max_bytes:
+            self._remove(next(iter(self.map)))
+        self.map[key] = (now + self.timeout, (msgtype, content, fragsize))
+        self.bytes += len(content)
+
+    def get(self, peer, txid, now=None):
+        """
+        @param peer: Id of the receiving node
+        @param txid: Transaction id of the message
+        @param now: Current time, for testing
+        @return: Tuple of message type, content and fragment size of
+        the message if still kept, otherwise None.
+        """
+        self.expire(now)
+        entry = self.map.get((peer, txid))
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def discard(self, peer, txid):
+        """
+        Stop keeping a message the receiver has acknowledged.
+        @param peer: Id of the receiving node
+        @param txid: Transaction id of the message
+        """
+        if (peer, txid) in self.map:
+            self._remove((peer, txid))
+
+    def _remove(self, key):
+        _, message = self.map.pop(key)
+        self.bytes -= len(message[1])
+
+    def expire(self, now=None):
+        """
+        Drop messages kept for longer than the timeout.
+        @param now: Current time, for testing
+        """
+        if now is None:
+            now = time.time()
+        while self.map:
+            key, (deadline, _) = next(self.map.iteritems())
+            if deadline > now:
+                break
+            self._remove(key)
+
+    def stats(self):
+        """
+        @return: Dict of cache counters
+        """
+        return {'messages': len(self.map),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses}
+
+def pack_nack(missing, size=Payload.MAX_FRAGMENT):
+    """
+    Encode fragment numbers as the first number followed by a bitmap,
+    most significant bit first, of the fragments from there on.
+    Numbers that do not fit in the given size are left out.
+    @param missing: Fragment numbers
+    @param size: Maximum encoded size in bytes
+    @return: Packed fragment numbers
+    """
+    if not missing:
+        return b''
+    first = min(missing)
+    bitmap = bytearray()
+    for x in sorted(set(missing)):
+        index = (x - first) // 8
+        if index >= size - NACK_HEADER.size:
+            break
+        if index >= len(bitmap):
+            bitmap.extend(b'\0' * (index + 1 - len(bitmap)))
+        bitmap[index] |= 0x80 >> ((x - first) % 8)
+    return NACK_HEADER.pack(first) + bytes(bitmap)
+
+def unpack_nack(content):
+    """
+    Decode fragment numbers produced by pack_nack().
+    @param content: Packed fragment numbers
+    @return: List of fragment numbers
+    """
+    if len(content) < NACK_HEADER.size:
+        return []
+    first, = NACK_HEADER.unpack_from(content)
+    missing = []
+    for i, byte in enumerate(bytearray(content[NACK_HEADER.size:])):
+        for bit in xrange(8):
+            if byte & (0x80 >> bit):
+                missing.append(first + i * 8 + bit)
+    return missing
 
 def pack_node(addr, port, node_id):
     """
@@ -132,6 +1053,165 @@ def unpack_node(node_str):
     x = node_str.split(':', 2)
     return (x[0], x[1], x[2])
 
+class CodecError(Exception):
+    pass
+
+def _lz4_decompress(content, limit):
+    size = struct.unpack('<I', content[:4])[0] if len(content) >= 4 else -1
+    if not 0 <= size <= limit:
+        raise CodecError('Decompressed size %i over limit' % size)
+    return lz4.block.decompress(content)
+
+def _zlib_decompress(content, limit):
+    d = zlib.decompressobj()
+    data = d.decompress(content, limit)
+    if d.unconsumed_tail:
+        raise CodecError('Decompressed size over limit')
+    return data
+
+# codec id -> (mode feature bit, compress, decompress), fastest first
+CODECS = OrderedDict()
+if HAS_LZ4:
+    CODECS[CODEC_LZ4] = (0x20, lz4.block.compress, _lz4_decompress)
+CODECS[CODEC_ZLIB] = (0x10, lambda x: zlib.compress(x, 6), _zlib_decompress)
+CODEC_SUPPORT = reduce(lambda x, y: x | y, [ x[0] for x in CODECS.values() ])
+# advertised in the packet mode of everything sent
+FEATURES = CODEC_SUPPORT | FEATURE_PAYLOAD_V1 | FEATURE_NODES
+
+def compress(msgtype, content, support):
+    """
+    Compress content with the fastest codec the receiver supports, if
+    it is large enough and compresses well.
+    @param msgtype: Message type
+    @param content: Message content
+    @param support: Feature bits advertised by the receiver
+    @return: Tuple of message type, flagged if compressed, and content
+    """
+    if len(content) < COMPRESS_MIN:
+        return msgtype, content
+    for codec, (bit, encode, _) in CODECS.iteritems():
+        if support & bit:
+            break
+    else:
+        return msgtype, content
+    # try a sample first so incompressible values cost little
+    if len(content) > COMPRESS_SAMPLE * 2:
+        sample = content[:COMPRESS_SAMPLE]
+        if len(encode(sample)) > COMPRESS_RATIO * len(sample):
+            return msgtype, content
+    data = encode(content)
+    if len(data) + 1 > COMPRESS_RATIO * len(content):
+        return msgtype, content
+    return msgtype | COMPRESSED, chr(codec) + data
+
+def decompress(msgtype, content, limit=DECOMPRESS_MAX):
+    """
+    Reverse compress().
+    @param msgtype: Message type as received
+    @param content: Message content as received
+    @param limit: Largest decompressed content accepted
+    @return: Tuple of message type and content
+    @raise CodecError: If the content can not be decompressed
+    """
+    if not msgtype & COMPRESSED:
+        return msgtype, content
+    codec = CODECS.get(ord(content[:1] or '\0'))
+    if not codec:
+        raise CodecError('Unsupported codec')
+    try:
+        return msgtype & ~COMPRESSED, codec[2](content[1:], limit)
+    except CodecError:
+        raise
+    except Exception, ex:
+        raise CodecError(str(ex))
+
+def pack_nodes(nodes, support=FEATURE_NODES):
+    """
+    Encode node details in binary, each as 32 byte id, address family
+    (4 or 6), 4 or 16 byte IP address and 2 byte port.  Addresses that
+    are not IP literals are sent as family 0, a length byte and the
+    name instead.  Peers without FEATURE_NODES are sent the older text
+    format.
+    @param nodes: List of nodes
+    @param support: Features of the receiving peer
+    @return: Packed node list
+    """
+    if not support & FEATURE_NODES:
+        return _pack_text_nodes(nodes)
+    fmt = ['!']
+    values = []
+    for x in nodes:
+        try:
+            addr = socket.inet_pton(socket.AF_INET, x.address)
+            fmt.append(NODE_IPV4)
+            values += [x.node_id, 4, addr, x.port]
+        except socket.error:
+            try:
+                addr = socket.inet_pton(socket.AF_INET6, x.address)
+                fmt.append(NODE_IPV6)
+                values += [x.node_id, 6, addr, x.port]
+            except socket.error:
+                name = x.address[:255]
+                fmt.append('32sBB%isH' % len(name))
+                values += [x.node_id, 0, len(name), name, x.port]
+    return struct.pack(''.join(fmt), *values)
+
+def _pack_text_nodes(nodes):
+    return b''.join(b'%s%s\0%i\0' % (x.node_id, x.address, x.port)
+                    for x in nodes)
+
+def unpack_nodes(content):
+    """
+    Decode a node list produced by pack_nodes(), in either format.
+    Entries in the text format start with an address, never a family
+    byte, after the id.
+    Decoding stops at the first malformed entry.
+    @param content: Packed node list
+    @return: List of (address, port, node_id) tuples
+    """
+    if len(content) > NODE_HEADER.size and \
+            content[NODE_HEADER.size - 1] not in b'\x00\x04\x06':
+        return _unpack_text_nodes(content)
+    nodes = []
+    offset = 0
+    while offset + NODE_HEADER.size <= len(content):
+        node_id, family = NODE_HEADER.unpack_from(content, offset)
+        if family == 0:
+            if offset + NODE_NAME.size > len(content):
+                break
+            _, _, length = NODE_NAME.unpack_from(content, offset)
+            end = offset + NODE_NAME.size + length
+            if end + NODE_PORT.size > len(content):
+                break
+            port, = NODE_PORT.unpack_from(content, end)
+            nodes.append((content[offset + NODE_NAME.size:end], port, node_id))
+            offset = end + NODE_PORT.size
+            continue
+        if family == 4:
+            entry = NODE_V4
+        elif family == 6:
+            entry = NODE_V6
+        else:
+            break
+        if offset + entry.size > len(content):
+            break
+        _, _, addr, port = entry.unpack_from(content, offset)
+        nodes.append((socket.inet_ntop(family == 4 and socket.AF_INET or
+                                       socket.AF_INET6, addr), port, node_id))
+        offset += entry.size
+    return nodes
+
+def _unpack_text_nodes(content):
+    nodes = []
+    while content:
+        node_id = content[:32]
+        try:
+            addr, port, content = content[32:].split(b'\0', 2)
+            nodes.append((addr, int(port), node_id))
+        except ValueError:
+            break
+    return nodes
+
 def timer(f):
     """
     Time the given function and return the duration
@@ -31,7 +31,7 @@ setup(
     include_package_data=True,
     license="GPL",
     install_requires=open('requirements.txt').readlines(),
-    tests_require=['pytest>=2.5'],
+    tests_require=['pytest>=2.5', 'trollius'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Developers',
@@ -0,0 +1,184 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import itertools
+import shutil
+import socket
+import tempfile
+import time
+
+import pytest
+from zmq.utils import z85
+
+from peerz.aio import AsyncEngine, HAS_ASYNCIO, TimedTxMap
+from peerz.routing import generate_random, Node
+from peerz import transport
+
+if HAS_ASYNCIO:
+    from peerz.aio import FutureReply, asyncio
+
+class Timer(object):
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class SimpleLoop(object):
+    """
+    Just enough of an event loop to run timers, in order and on time,
+    where neither asyncio nor trollius is installed.
+    """
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+
+    def time(self):
+        return time.time()
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.time() + delay, callback, args)
+        heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+        return timer
+
+    def run_for(self, seconds):
+        """
+        Run the timers due in the next given seconds.
+        """
+        end = self.time() + seconds
+        while self.timers and self.timers[0][0] <= end:
+            when, _, timer = heapq.heappop(self.timers)
+            time.sleep(max(0, when - self.time()))
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+        time.sleep(max(0, end - self.time()))
+
+class Waiting(object):
+
+    def __init__(self, engine, txid, msg, callback=None, max_duration=5000):
+        self.callback = callback
+        self.max_duration = max_duration
+        self.state = 'waiting response'
+
+    def is_complete(self):
+        return self.state == 'timedout'
+
+    def timeout(self):
+        self.state = 'timedout'
+
+class Recorder(object):
+
+    def __init__(self):
+        self.timeouts = 0
+
+    def timeout(self):
+        self.timeouts += 1
+
+def test_timed_txmap():
+    loop = SimpleLoop()
+    txmap = TimedTxMap(loop, timeout=10, expiry=100)
+    callback = Recorder()
+    txid = txmap.create(Waiting, [], None, callback=callback,
+                        max_duration=10)
+    default = txmap.create(Waiting, [], None, max_duration=50)
+    loop.run_for(0.03)
+    # timed out on its own deadline, waiters told once
+    assert txmap.get(txid).state == 'timedout'
+    assert callback.timeouts == 1
+    assert txmap.get(default).state == 'waiting response'
+    loop.run_for(0.04)
+    assert txmap.get(default).state == 'timedout'
+    loop.run_for(0.05)
+    assert not txmap.has(txid) and not txmap.has(default)
+    assert callback.timeouts == 1
+    if HAS_ASYNCIO:
+        # api callers waiting on the reply's future see a TimeoutError
+        event_loop = asyncio.new_event_loop()
+        future = asyncio.Future(loop=event_loop)
+        txmap.create(Waiting, [], None, callback=FutureReply(future),
+                     max_duration=10)
+        loop.run_for(0.03)
+        assert isinstance(future.exception(), asyncio.TimeoutError)
+        event_loop.close()
+
+def test_engine_timers():
+    loop = SimpleLoop()
+    root = tempfile.mkdtemp('peerz_test')
+    peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    peer.bind(('127.0.0.1', 0))
+    peer.settimeout(1)
+    engine = AsyncEngine([], root, loop=loop)
+    try:
+        node = Node('127.0.0.1', peer.getsockname()[1], generate_random())
+        node.features = transport.FEATURES
+        content = 'x' * (node.max_fragment * 20)
+        engine.send_external(node, 'tx01', 0x02, content, compress=False)
+        # the first burst goes straight out, the rest are paced
+        engine.rearm()
+        assert engine.flush_handle and engine.scheduler.next_send()
+        loop.run_for(0.5)
+        assert len([ peer.recvfrom(9216) for _ in range(20) ]) == 20
+        assert engine.flush_handle is None
+        assert not engine.scheduler.next_send()
+        # missing fragments are asked for once the message stalls
+        engine.defrag.get_msg('tx02', 0, 3, 'x' * 100, node.node_id,
+                              fragsize=100, address=('127.0.0.1', 1))
+        engine.rearm()
+        assert engine.nack_handle
+        loop.run_for(transport.NACK_IDLE + 0.1)
+        assert engine.defrag.nacked == 1
+        # and the periodic tick rearms itself
+        loop.run_for(1.1)
+        assert engine.tick_handle and not engine.tick_handle.cancelled
+        engine.close()
+        assert engine.tick_handle.cancelled
+    finally:
+        engine.close()
+        peer.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+@pytest.mark.skipif(not HAS_ASYNCIO, reason='requires asyncio or trollius')
+def test_find_nodes():
+    loop = asyncio.new_event_loop()
+    root = tempfile.mkdtemp('peerz_test')
+    engines = []
+    try:
+        seed = AsyncEngine([], root, loop=loop)
+        engines.append(seed)
+        node = loop.run_until_complete(seed.join())
+        seeds = ['{0}:{1}:{2}'.format(node['address'], node['port'],
+                                      node['node_id'])]
+        for _ in range(3):
+            engines.append(AsyncEngine(seeds, root, loop=loop))
+            loop.run_until_complete(engines[-1].join())
+        # discovery runs on the first housekeeping tick
+        loop.run_until_complete(asyncio.sleep(1.5, loop=loop))
+        assert len(loop.run_until_complete(seed.get_peers())) == 3
+        target = z85.encode(generate_random())
+        found = loop.run_until_complete(engines[1].find_nodes(target))
+        assert len(found) == 4
+        with pytest.raises(ValueError):
+            loop.run_until_complete(seed.request('NOPE'))
+    finally:
+        for x in engines:
+            x.close()
+        loop.close()
+        shutil.rmtree(root, ignore_errors=True)
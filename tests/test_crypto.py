@@ -0,0 +1,229 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+import pytest
+
+from peerz.crypto import BoxCache, CryptoPool, HAS_NACL, ReplayWindow, \
+    SessionCache, SESSION_HEADER, SESSION_OFFER, UnknownSession, \
+    unseal
+
+if HAS_NACL:
+    from nacl.exceptions import CryptoError
+    from nacl.public import PrivateKey
+
+def test_replay_window():
+    w = ReplayWindow(size=4)
+    for x in (5, 3, 9):
+        assert w.check(x)
+        w.update(x)
+        assert not w.check(x)
+    # within the window and unseen
+    assert w.check(8) and w.check(6)
+    # too old
+    assert not w.check(5) and not w.check(0)
+    w.update(100)
+    assert not w.check(9) and w.check(99) and not w.check(96)
+
+def test_crypto_pool():
+    def fail(x):
+        raise ValueError(x)
+    for pool in (CryptoPool(0), CryptoPool(3, min_batch=2)):
+        # results come back in the order given
+        assert pool.map(lambda x: x * 2, range(50)) == range(0, 100, 2)
+        results = pool.attempt([ (x % 3 and abs or fail, -x)
+                                 for x in range(6) ])
+        assert [ x[0] for x in results ] == [False, True, True] * 2
+        assert results[1] == (True, 1)
+        assert isinstance(results[3][1], ValueError)
+        pool.close()
+    assert pool.pool is None
+
+@pytest.mark.skipif(not HAS_NACL, reason='requires PyNaCl')
+class TestBoxCache(object):
+
+    def test_round_trip(self):
+        a = PrivateKey.generate()
+        b = PrivateKey.generate()
+        alice = BoxCache(a)
+        bob = BoxCache(b)
+        for x in range(3):
+            msg = alice.encrypt(str(b.public_key), 'hello %i' % x)
+            assert bob.decrypt(str(a.public_key), msg) == 'hello %i' % x
+        # the shared key is only computed once per peer
+        assert alice.stats() == {'boxes': 1, 'hits': 2, 'misses': 1}
+        with pytest.raises(CryptoError):
+            bob.decrypt(str(a.public_key), msg[:-1] + chr(ord(msg[-1]) ^ 1))
+
+    def test_lru(self):
+        cache = BoxCache(PrivateKey.generate(), maxsize=2)
+        peers = [ str(PrivateKey.generate().public_key) for _ in range(3) ]
+        cache.get(peers[0])
+        cache.get(peers[1])
+        cache.get(peers[0])
+        cache.get(peers[2])
+        # least recently used makes way
+        assert list(cache.boxes) == [peers[0], peers[2]]
+        cache.discard(peers[0])
+        cache.discard(peers[1])
+        assert list(cache.boxes) == [peers[2]]
+
+@pytest.mark.skipif(not HAS_NACL, reason='requires PyNaCl')
+class TestSessionCache(object):
+
+    def setup_method(self, method):
+        self.a = PrivateKey.generate()
+        self.b = PrivateKey.generate()
+        self.a_id = str(self.a.public_key)
+        self.b_id = str(self.b.public_key)
+
+    def caches(self, **kwargs):
+        """
+        @return: Alice and Bob's caches, Alice sending in a session Bob
+        has offered
+        """
+        alice = SessionCache(BoxCache(self.a), **kwargs)
+        bob = SessionCache(BoxCache(self.b), **kwargs)
+        alice.adopt(self.b_id, bob.offer(self.a_id))
+        return alice, bob
+
+    def test_round_trip(self):
+        alice, bob = self.caches()
+        msgs = [ alice.encrypt(self.b_id, 'hello %i' % x) for x in range(3) ]
+        # smaller than a Box with its random nonce
+        assert len(msgs[0]) == 12 + 16 + len('hello 0')
+        # out of order delivery is fine
+        for x in (2, 0, 1):
+            assert bob.decrypt(self.a_id, msgs[x]) == 'hello %i' % x
+        # and the other direction has its own session
+        assert not bob.has_session(self.a_id)
+        with pytest.raises(CryptoError):
+            bob.encrypt(self.a_id, 'hi')
+        bob.adopt(self.a_id, alice.offer(self.b_id))
+        assert alice.decrypt(self.b_id, bob.encrypt(self.a_id, 'hi')) == 'hi'
+        assert bob.stats() == {'outbound': 1, 'inbound': 1, 'replays': 0,
+                               'unknown': 0}
+
+    def test_rejected(self):
+        alice, bob = self.caches()
+        msg = alice.encrypt(self.b_id, 'hello')
+        bob.decrypt(self.a_id, msg)
+        with pytest.raises(CryptoError):
+            bob.decrypt(self.a_id, msg)
+        assert bob.replays == 1
+        tampered = alice.encrypt(self.b_id, 'hello')
+        tampered = tampered[:-1] + chr(ord(tampered[-1]) ^ 1)
+        with pytest.raises(CryptoError):
+            bob.decrypt(self.a_id, tampered)
+        # a failed packet does not use up its counter
+        with pytest.raises(UnknownSession):
+            bob.decrypt(str(PrivateKey.generate().public_key), msg)
+        with pytest.raises(CryptoError):
+            bob.decrypt(self.a_id, 'short')
+        with pytest.raises(CryptoError):
+            alice.adopt(self.b_id, 'short')
+
+    def test_replayed_offer(self):
+        alice = SessionCache(BoxCache(self.a), lifetime=100)
+        bob = SessionCache(BoxCache(self.b), lifetime=100)
+        issued = time.time()
+        offer = bob.offer(self.a_id, now=issued)
+        alice.adopt(self.b_id, offer, now=issued)
+        first = alice.encrypt(self.b_id, 'x')
+        # taking the same offer again would reuse the key and counter
+        with pytest.raises(CryptoError):
+            alice.adopt(self.b_id, offer, now=issued + 1)
+        second = alice.encrypt(self.b_id, 'x')
+        assert first[:4] == second[:4]
+        assert [ SESSION_HEADER.unpack_from(x)[1] for x in (first, second) ] \
+            == [0, 1]
+        # as is an older offer, whether or not the peer was forgotten
+        newer = bob.offer(self.a_id, lost=True, now=issued + 2)
+        alice.adopt(self.b_id, newer, now=issued + 2)
+        alice.forget(self.b_id)
+        with pytest.raises(CryptoError):
+            alice.adopt(self.b_id, offer, now=issued + 3)
+        # and offers older than half a lifetime
+        alice = SessionCache(BoxCache(self.a), lifetime=100)
+        with pytest.raises(CryptoError):
+            alice.adopt(self.b_id, offer, now=issued + 51)
+
+    def test_unknown_session(self):
+        alice = SessionCache(BoxCache(self.a))
+        bob = SessionCache(BoxCache(self.b))
+        # a session the sender picked itself
+        alice.adopt(self.b_id, SESSION_OFFER.pack('\0\0\0\1',
+                                                  int(time.time() * 1000) - 1))
+        with pytest.raises(UnknownSession):
+            bob.decrypt(self.a_id, alice.encrypt(self.b_id, 'hello'))
+        alice.adopt(self.b_id, bob.offer(self.a_id))
+        msgs = [ alice.encrypt(self.b_id, 'hello') for _ in range(2) ]
+        bob.decrypt(self.a_id, msgs[0])
+        # nothing sent before the peer was dropped, or a restart, is
+        # accepted again
+        bob.discard(self.a_id)
+        assert not bob.inbound
+        for x in msgs:
+            with pytest.raises(UnknownSession):
+                bob.decrypt(self.a_id, x)
+        restarted = SessionCache(BoxCache(self.b))
+        with pytest.raises(UnknownSession):
+            restarted.decrypt(self.a_id, msgs[1])
+        assert bob.unknown == 3
+
+    def test_new_session(self):
+        alice, bob = self.caches(lifetime=100, max_packets=2)
+        issued = time.time()
+        # not due another session yet
+        assert bob.offer(self.a_id, now=issued + 1) is None
+        assert bob.offer(self.a_id, lost=True, now=issued + 0.5) is None
+        msgs = [ alice.encrypt(self.b_id, 'x') for _ in range(2) ]
+        assert not alice.has_session(self.b_id)
+        # a peer that lost its session is offered another soon after
+        alice.adopt(self.b_id, bob.offer(self.a_id, lost=True, now=issued + 2))
+        msgs.append(alice.encrypt(self.b_id, 'x'))
+        assert msgs[0][:4] == msgs[1][:4] != msgs[2][:4]
+        for x in msgs:
+            assert bob.decrypt(self.a_id, x, now=issued + 2) == 'x'
+        assert len(bob.inbound) == 2
+        # senders stop using a session half way through its lifetime,
+        # when the receiver offers the next
+        assert not alice.has_session(self.b_id, now=issued + 53)
+        assert bob.offer(self.a_id, now=issued + 53)
+        # and receivers stop accepting it at the end
+        with pytest.raises(UnknownSession):
+            bob.decrypt(self.a_id, msgs[1], now=issued + 101)
+        assert len(bob.inbound) == 2
+        bob.discard(self.a_id)
+        assert not bob.inbound
+
+    def test_batches(self):
+        pool = CryptoPool(2, min_batch=1)
+        alice, bob = self.caches()
+        plain = [ 'hello %i' % x for x in range(8) ]
+        msgs = alice.encrypt_many(self.b_id, plain, pool)
+        msgs.append(msgs[0])
+        # the same counter twice in one batch, only one is accepted
+        tickets = [ bob.open(self.a_id, x) for x in msgs ]
+        results = pool.attempt([ (unseal, x) for x in tickets ])
+        pool.close()
+        assert [ x[1] for x in results ] == plain + plain[:1]
+        for x in tickets[:-1]:
+            bob.accept(x)
+        with pytest.raises(CryptoError):
+            bob.accept(tickets[-1])
+        assert bob.replays == 1
@@ -0,0 +1,166 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import time
+
+import pytest
+
+from peerz.crypto import BoxCache, CryptoPool, HAS_NACL, SessionCache, \
+    SESSION_HEADER
+from peerz.engine import Engine
+from peerz.messaging.discovery import Discovery
+from peerz.routing import generate_random, Node, RoutingZone
+from peerz.transaction import TxMap
+from peerz import transport
+
+if HAS_NACL:
+    from nacl.public import PrivateKey
+
+def bare_engine(secure=False):
+    """
+    Engine with just the packet path set up, on a socket of its own.
+    @param secure: Encrypt packets, otherwise they are sent in plain
+    """
+    e = Engine.__new__(Engine)
+    e.secure = secure
+    e.udpserver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    e.udpserver.bind(('127.0.0.1', 0))
+    e.udpserver.settimeout(1)
+    node_id = generate_random()
+    if secure:
+        key = PrivateKey.generate()
+        node_id = str(key.public_key)
+        e.boxes = BoxCache(key)
+        e.sessions = SessionCache(e.boxes)
+    e.node = Node('127.0.0.1', e.udpserver.getsockname()[1], node_id)
+    e.writer = transport.PacketWriter(e.udpserver)
+    e.scheduler = transport.SendScheduler(e.writer)
+    e.nodetree = RoutingZone(e.node.node_id)
+    e.nodetree.add(e.node)
+    e.defrag = transport.DefragMap()
+    e.retransmit = transport.RetransmitCache()
+    e.admission = transport.AdmissionControl()
+    e.registry = {Discovery.id: Discovery(e)}
+    e.txmap = TxMap()
+    e.crypto = CryptoPool(0)
+    return e
+
+def receive(engine, count):
+    """
+    @return: List of the next count datagrams sent to the engine
+    """
+    return [ engine.udpserver.recvfrom(9216) for _ in range(count) ]
+
+def modes(datagrams):
+    return [ ord(x[32]) for x, _ in datagrams ]
+
+class TestFeatures(object):
+
+    def setup_method(self, method):
+        self.a = bare_engine()
+        self.b = bare_engine()
+
+    def teardown_method(self, method):
+        self.a.udpserver.close()
+        self.b.udpserver.close()
+
+    def test_negotiation(self):
+        b_node = Node(self.b.node.address, self.b.node.port,
+                      self.b.node.node_id)
+        self.a.send_external(b_node, 'tx01', 0x01)
+        # older peers only read the baseline mode, so features are
+        # advertised in a message of their own
+        datagrams = receive(self.b, 2)
+        assert modes(datagrams) == [transport.OPTION_PLAIN] * 2
+        self.a.send_external(b_node, 'tx02', 0x01)
+        assert modes(receive(self.b, 1)) == [transport.OPTION_PLAIN]
+        for data, addr in datagrams:
+            self.b.handle_datagram(memoryview(data), addr)
+        # the pong is in the format the ping advertised
+        pong = receive(self.a, 1)
+        assert modes(pong) == [transport.OPTION_PLAIN | transport.FEATURES |
+                               transport.HEADER_V1]
+        self.a.handle_datagram(memoryview(pong[0][0]), pong[0][1])
+        b_node = self.a.nodetree.get_node_by_id(b_node.node_id)
+        assert b_node.features == transport.FEATURES
+        self.a.send_external(b_node, 'tx03', 0x01)
+        assert modes(receive(self.b, 1))[0] & transport.HEADER_V1
+
+    def test_nack_first_contact(self):
+        b_node = Node(self.b.node.address, self.b.node.port,
+                      self.b.node.node_id)
+        b_node.features = transport.FEATURES
+        self.a.send_external(b_node, 'tx01', 0x02,
+                             'x' * (b_node.max_fragment * 3), compress=False)
+        datagrams = receive(self.b, 3)
+        for data, addr in datagrams[:1] + datagrams[2:]:
+            self.b.handle_datagram(memoryview(data), addr)
+        # a is not in b's routing table, its features came with the message
+        assert not self.b.nodetree.get_node_by_id(self.a.node.node_id)
+        time.sleep(transport.NACK_IDLE)
+        self.b.send_nacks()
+        nack = receive(self.a, 1)
+        self.a.handle_datagram(memoryview(nack[0][0]), nack[0][1])
+        # the lost fragment is sent again
+        assert receive(self.b, 1)[0][0] == datagrams[1][0]
+
+@pytest.mark.skipif(not HAS_NACL, reason='requires PyNaCl')
+class TestSessions(object):
+
+    def setup_method(self, method):
+        self.a = bare_engine(secure=True)
+        self.b = bare_engine(secure=True)
+
+    def teardown_method(self, method):
+        self.a.udpserver.close()
+        self.b.udpserver.close()
+
+    def counters(self, count):
+        """
+        @return: Session header of the next count packets from a to b
+        """
+        headers = []
+        for data, _ in receive(self.b, count):
+            p = transport.Packet()
+            p.unpack(memoryview(data))
+            assert (p.mode & transport.OPTION_MASK) == transport.OPTION_SESSION
+            headers.append(SESSION_HEADER.unpack_from(p.payload.tobytes()))
+        return headers
+
+    def test_replayed_offer(self):
+        b_node = Node(self.b.node.address, self.b.node.port,
+                      self.b.node.node_id)
+        b_node.features = transport.FEATURES | transport.FEATURE_SESSION
+        self.a.send_external(b_node, 'tx01', 0x01)
+        data, addr = receive(self.b, 1)[0]
+        self.b.handle_datagram(memoryview(data), addr)
+        # b offers a session along with its pong
+        offer, pong = receive(self.a, 2)
+        for x in (offer, pong):
+            self.a.handle_datagram(memoryview(x[0]), x[1])
+        # and a offers b one in return
+        data, addr = receive(self.b, 1)[0]
+        self.b.handle_datagram(memoryview(data), addr)
+        assert self.b.sessions.has_session(self.a.node.node_id)
+        b_node = self.a.nodetree.get_node_by_id(b_node.node_id)
+        self.a.send_external(b_node, 'tx02', 0x01)
+        first = self.counters(1)[0]
+        assert first[1] == 0
+        # a replayed offer does not restart the counter
+        self.a.handle_datagram(memoryview(offer[0]), offer[1])
+        self.a.send_external(b_node, 'tx03', 0x01)
+        assert self.counters(1) == [(first[0], 1)]
@@ -0,0 +1,60 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+
+from peerz.resolver import HostnameCache
+
+class TestHostnameCache(object):
+
+    def test_resolves_in_background(self):
+        lookups = []
+        def lookup(address):
+            lookups.append(address)
+            return 'host-%s.example' % address
+        cache = HostnameCache(lookup=lookup)
+        # nothing known yet, caller gets the default without waiting
+        assert cache.hostname('10.0.0.1', '10.0.0.1') == '10.0.0.1'
+        assert cache.hostname('10.0.0.1') is None
+        cache.queue.join()
+        assert cache.hostname('10.0.0.1') == 'host-10.0.0.1.example'
+        assert lookups == ['10.0.0.1']
+
+    def test_negative_cache(self):
+        lookups = []
+        def lookup(address):
+            lookups.append(address)
+            if address == '10.0.0.2':
+                raise socket.herror('unknown host')
+            return address
+        cache = HostnameCache(lookup=lookup)
+        cache.hostname('10.0.0.2')
+        cache.hostname('10.0.0.3')
+        cache.queue.join()
+        assert cache.hostname('10.0.0.2', 'x') == 'x'
+        assert cache.hostname('10.0.0.3', 'y') == 'y'
+        assert sorted(lookups) == ['10.0.0.2', '10.0.0.3']
+
+    def test_expiry(self):
+        cache = HostnameCache(ttl=-1, maxsize=2, lookup=lambda x: 'h' + x)
+        cache.hostname('a')
+        cache.queue.join()
+        # expired names are still served while being refreshed
+        assert cache.hostname('a') == 'ha'
+        cache.hostname('b')
+        cache.hostname('c')
+        cache.queue.join()
+        assert len(cache.entries) <= 2
@@ -16,7 +16,12 @@
 
 
 from peerz.routing import distance, distance_sort, bit_number
-from peerz.routing import RoutingBin, RoutingZone, Node
+from peerz.routing import id_to_long, prefix_length
+from peerz.routing import RoutingBin, RoutingZone, RoutingTable, Node
+from peerz.routing import generate_random, generate_random_in, InvalidTransition
+from peerz import routing
+import cPickle
+import pytest
 
 def test_distance():
     assert distance('10001', '10001') == 0
@@ -24,6 +29,18 @@ def test_distance():
     assert distance('\x42\xf0\xff', '\x42\xf1\x00') == 0x01ff
     assert distance('\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff', '\x00\x00\x00') == 0xffffffffffffffffffffffffffffffff
 
+def test_id_to_long():
+    assert id_to_long('\x00\x00\x00') == 0
+    assert id_to_long('\x42\xf1\x00') == 0x42f100
+    assert id_to_long(0x42f100) == 0x42f100
+    assert distance(0x42f100, '\x42\xf0\xff') == 0x01ff
+
+def test_prefix_length():
+    assert prefix_length('\x00' * 32, '\x00' * 32) == 256
+    assert prefix_length('\x80' + '\x00' * 31, '\x00' * 32) == 0
+    assert prefix_length('\x00\x01' + '\x00' * 30, '\x00' * 32) == 15
+    assert prefix_length(1, 0) == 255
+
 def test_bit_number():
     assert bit_number('\x00\x00\x00', 255) == 0
     assert bit_number('\x00\x00\x01', 255) == 1
@@ -39,6 +56,64 @@ def test_distance_sort():
     distance_sort(x, '\x00\x04\x00\x00\x00')
     assert x == ['\x00\x04\x00\x00\x00', '\x00\x01\x00\x00\x00', '\x00\x02\x00\x00\x00']
     
+class TestNode(object):
+
+    def test_transitions(self):
+        n = Node('127.0.0.1', 7781, '12345678f0')
+        assert n.state == 'discovered' and n.is_discovered()
+        n.timeout()
+        n.timeout()
+        assert n.state == 'discovered' and n.failures == 2
+        n.response_in()
+        assert n.is_verified() and n.failures == 0
+        n.timeout()
+        n.timeout()
+        n.timeout()
+        assert n.is_verified() and n.failures == 3
+        n.timeout()
+        assert n.is_failed()
+        n.timeout()
+        assert n.is_failed()
+        with pytest.raises(InvalidTransition):
+            n.response_in()
+        n.to_discovered()
+        assert n.is_discovered()
+        assert len(n.times) == len(Node.states)
+
+    def test_pickle(self):
+        n = Node('127.0.0.1', 7781, '12345678f0')
+        n.response_in()
+        n.first_contact = 1234
+        m = cPickle.loads(cPickle.dumps(n, cPickle.HIGHEST_PROTOCOL))
+        assert m.node_id == n.node_id and m.long_id == n.long_id
+        assert m.address == n.address and m.port == n.port
+        assert m.first_contact == 1234
+        # state statistics are reset after loading
+        assert m.is_discovered() and m.queries_in == 0
+        assert not hasattr(m, '__dict__')
+
+    def test_rtt(self):
+        n = Node('127.0.0.1', 7781, generate_random())
+        assert n.latency == 0.0 and n.latency_p95 == 0.0
+        assert n.rto == routing.NODE_RTO_INITIAL
+        n.add_rtt(100.0)
+        assert n.srtt == 100.0 and n.rttvar == 50.0
+        assert n.rto == 300.0
+        n.add_rtt(200.0)
+        assert n.srtt == 112.5 and n.rttvar == 62.5
+        assert n.latency == 150.0
+        # ring buffer only holds the most recent values
+        for x in range(1, routing.NODE_RTT_DATA_POINTS + 1):
+            n.add_rtt(float(x))
+        assert len(n.rtt) == routing.NODE_RTT_DATA_POINTS
+        assert n.rtt_sorted == sorted(n.rtt) == [ float(x) for x in range(1, routing.NODE_RTT_DATA_POINTS + 1) ]
+        assert n.latency_p50 == routing.NODE_RTT_DATA_POINTS / 2
+        assert n.latency_p95 == int(0.95 * routing.NODE_RTT_DATA_POINTS + 1)
+        assert n.rtt_percentile(100) == routing.NODE_RTT_DATA_POINTS
+        assert n.rto >= routing.NODE_RTO_MIN
+        data = n.to_json()
+        assert data['latency_p50_ms'] == n.latency_p50 and data['rto_ms'] == n.rto
+
 class TestRoutingBin(object):
 
     def test_get_by_id(self):
@@ -124,6 +199,50 @@ class TestRoutingBin(object):
         r.push(Node('127.0.0.2', 7777, '12345678f2'))
         assert len(r) == 3
 
+    def test_replacements(self):
+        r = RoutingBin(maxsize=2)
+        n1 = Node('127.0.0.1', 7781, '12345678f0')
+        r.push(n1)
+        r.push(Node('127.0.0.1', 7782, '12345678f1'))
+        # already active nodes do not overflow
+        r.push(n1)
+        assert not r.replacements
+        for x in range(3):
+            r.push(Node('127.0.0.2', x, '1234567800' + str(x)))
+        assert len(r.replacements) == 2
+        assert '12345678000' not in r.replacements
+        # newest replacement promoted
+        assert r.pop(n1.node_id) is n1
+        assert len(r) == 2
+        assert r.get_by_id('12345678002').port == 2
+        assert r.pop(n1.node_id) is None
+
+    def test_replacement_ranking(self):
+        r = RoutingBin(maxsize=2)
+        r.push(Node('127.0.0.1', 7781, 'active01'))
+        r.push(Node('127.0.0.1', 7782, 'active02'))
+        slow = Node('127.0.0.2', 1, 'slow0001')
+        fast = Node('127.0.0.2', 2, 'fast0001')
+        for x, rtt in ((slow, 200.0), (fast, 20.0)):
+            x.response_in()
+            x.add_rtt(rtt)
+            r.push(x)
+        # unverified newcomers are the first trimmed from a full cache
+        r.push(Node('127.0.0.2', 3, 'new00001'))
+        assert r.get_candidates() == [slow, fast]
+        assert r.get_candidate('fast0001') is fast
+        # fastest verified candidate takes the free slot
+        r.pop('active01')
+        assert r.get_by_id('fast0001') is fast
+        # failures count against a candidate
+        flaky = Node('127.0.0.2', 4, 'flaky001')
+        flaky.response_in()
+        flaky.add_rtt(1.0)
+        flaky.timeout()
+        r.push(flaky)
+        r.pop('active02')
+        assert r.get_by_id('slow0001') is slow
+
     def test_remaining(self):
         r = RoutingBin(maxsize=5)
         r.push(Node('127.0.0.1', 7781, '12345678f0'))
@@ -132,9 +251,10 @@ class TestRoutingBin(object):
         assert r.remaining() == 2
 
 class TestRoutingZone(object):
-    def test_split_balanced(self):
+    @pytest.mark.parametrize('table', [RoutingZone, RoutingTable])
+    def test_split_balanced(self, table):
         own_node = Node('127.0.0.1', 7001, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00')
-        r = RoutingZone(own_node.node_id, binsize=10)
+        r = table(own_node.node_id, binsize=10)
         r.add(own_node)
         r.add(Node('100.2.3.4', 7003, '\x00\x00\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x03'))
         r.add(Node('127.0.0.1', 7004, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x04'))
@@ -148,13 +268,14 @@ class TestRoutingZone(object):
         r.add(Node('127.0.0.1', 7012, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x0c'))
         assert not r.is_leaf()
         assert r.max_depth() == 1
-        assert len(r.children[0].get_all_nodes()) == 5
-        assert len(r.children[1].get_all_nodes()) == 6
-        assert own_node in r.children[1].get_all_nodes()
+        upper = [ x for x in r.get_all_nodes() if bit_number(x.node_id, 0) ]
+        assert len(r.get_all_nodes()) - len(upper) == 5
+        assert len(upper) == 6 and own_node in upper
 
-    def test_split_unbalanced(self):
+    @pytest.mark.parametrize('table', [RoutingZone, RoutingTable])
+    def test_split_unbalanced(self, table):
         own_node = Node('127.0.0.1', 7001, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x01')
-        r = RoutingZone(own_node.node_id, binsize=1, bdepth=1)
+        r = table(own_node.node_id, binsize=1, bdepth=1)
         r.add(own_node)
         r.add(Node('127.0.0.1', 7003, '\x00\x00\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x03'))
         r.add(Node('127.0.0.1', 7000, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00'))
@@ -164,9 +285,10 @@ class TestRoutingZone(object):
         assert r.max_depth() == 256  # will split entire key length when 'ffff..00' added
         assert len(r.get_all_nodes()) == 3  # non matching will get discarded after first split
 
-    def test_consolidate(self):
+    @pytest.mark.parametrize('table', [RoutingZone, RoutingTable])
+    def test_consolidate(self, table):
         own_node = Node('127.0.0.1', 7001, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x01')
-        r = RoutingZone(own_node.node_id, binsize=2, bdepth=1)
+        r = table(own_node.node_id, binsize=2, bdepth=1)
         r.add(own_node)
         r.add(Node('127.0.0.1', 7003, '\x00\x00\x00\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x03'))
         r.add(Node('127.0.0.1', 7000, '\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\xff\x00'))
@@ -179,3 +301,142 @@ class TestRoutingZone(object):
         assert r.is_leaf()
         assert r.max_depth() == 0
         assert len(r.get_all_nodes()) == 1
+
+def test_closest_to_exhaustive():
+    for table in (RoutingZone, RoutingTable):
+        own_node = Node('127.0.0.1', 7001, generate_random())
+        r = table(own_node.node_id, bdepth=3, binsize=4)
+        r.add(own_node)
+        for x in range(300):
+            r.add(Node('127.0.0.1', x, generate_random()))
+        nodes = r.get_all_nodes()
+        for max_nodes in (1, 8, 20, len(nodes) + 5):
+            target = generate_random()
+            expected = list(nodes)
+            distance_sort(expected, target, key=lambda x: x.long_id)
+            assert r.closest_to(target, max_nodes) == expected[:max_nodes]
+        # own id and ids of known nodes are their own closest match
+        assert r.closest_to(own_node.node_id, 1) == [own_node]
+        assert r.closest_to(nodes[-1].node_id, 1) == [nodes[-1]]
+
+def test_closest_to_many(monkeypatch):
+    for table in (RoutingZone, RoutingTable):
+        own_node = Node('127.0.0.1', 7001, generate_random())
+        r = table(own_node.node_id, bdepth=3, binsize=4)
+        r.add(own_node)
+        for x in range(300):
+            r.add(Node('127.0.0.1', x, generate_random()))
+        nodes = r.get_all_nodes()
+        targets = [ generate_random() for _ in range(50) ]
+        targets += [ x.node_id for x in nodes[:10] ] + [ own_node.long_id ]
+        for max_nodes in (1, 8, len(nodes), len(nodes) + 5):
+            expected = [ r.closest_to(x, max_nodes) for x in targets ]
+            assert r.closest_to_many(targets, max_nodes) == expected
+            monkeypatch.setattr(routing, 'HAS_NUMPY', False)
+            assert r.closest_to_many(targets, max_nodes) == expected
+            monkeypatch.undo()
+        # cached ids follow nodes leaving the table
+        r.remove(nodes[0])
+        assert nodes[0] not in r.closest_to_many([nodes[0].node_id])[0]
+        # short ids share their leading words so fall back to closest_to
+        r = table('\x00' * 32)
+        for x in range(100):
+            r.add(Node('127.0.0.1', x, '%05d' % x))
+        targets = [ '%05d' % x for x in range(0, 100, 7) ]
+        assert r.closest_to_many(targets) == [ r.closest_to(x) for x in targets ]
+
+def test_generate_random_in():
+    assert len(generate_random_in(0, 0)) == 32
+    for depth, prefix in ((1, 1), (5, 0x15), (12, 0), (256, 42)):
+        x = generate_random_in(depth, prefix)
+        assert len(x) == 32
+        assert id_to_long(x) >> (256 - depth) == prefix
+
+def test_stale_bins():
+    for table in (RoutingZone, RoutingTable):
+        own_node = Node('127.0.0.1', 7001, generate_random())
+        r = table(own_node.node_id, bdepth=3, binsize=4)
+        r.add(own_node)
+        for x in range(100):
+            r.add(Node('127.0.0.1', x, generate_random()))
+        assert r.stale_bins(60) == []
+        # every leaf is stale given a negative age
+        stale = r.stale_bins(-1)
+        assert len(stale) > 1 and stale == sorted(stale)
+        # leaves cover the whole id space between them
+        assert sum(2 ** (256 - x[1]) for x in stale) == 2 ** 256
+        # a lookup within a leaf's range makes it the most recently active
+        _, depth, prefix = stale[0]
+        r.touch(generate_random_in(depth, prefix))
+        assert r.stale_bins(-1)[-1][1:] == (depth, prefix)
+
+def test_get_candidate_by_id():
+    for table in (RoutingZone, RoutingTable):
+        own_node = Node('127.0.0.1', 7001, generate_random())
+        r = table(own_node.node_id, bdepth=2, binsize=2)
+        r.add(own_node)
+        nodes = [ Node('127.0.0.1', x, generate_random()) for x in range(50) ]
+        for x in nodes:
+            r.add(x)
+        candidates = r.get_all_candidates()
+        assert candidates
+        assert not set(candidates) & set(r.get_all_nodes())
+        for x in nodes:
+            if x in candidates:
+                assert r.get_candidate_by_id(x.node_id) is x
+                assert r.get_node_by_id(x.node_id) is None
+            else:
+                assert r.get_candidate_by_id(x.node_id) is None
+
+def test_node_index():
+    for table in (RoutingZone, RoutingTable):
+        own_node = Node('127.0.0.1', 7001, generate_random())
+        r = table(own_node.node_id, bdepth=2, binsize=2)
+        r.add(own_node)
+        nodes = [ Node('10.0.0.1', x, generate_random()) for x in range(200) ]
+        for x in nodes:
+            r.add(x)
+        # index matches table contents through splits and overflow
+        active = r.get_all_nodes()
+        assert sorted(r.index.by_id.values()) == sorted(active)
+        for x in active:
+            assert r.get_node_by_id(x.node_id) is x
+            assert r.get_node_by_addr(x.address, x.port) is x
+        for x in nodes:
+            if x not in active:
+                assert r.get_node_by_id(x.node_id) is None
+                assert r.get_node_by_addr(x.address, x.port) is None
+        # promoted replacements and consolidation stay in sync
+        for x in nodes:
+            r.remove(x)
+            assert sorted(r.index.by_id.values()) == sorted(r.get_all_nodes())
+            assert len(r.index.by_addr) == len(r.get_all_nodes())
+        # address changes
+        n = r.get_all_nodes()[0]
+        r.update_address(n, '10.0.0.2', 1234)
+        assert r.get_node_by_addr('10.0.0.2', 1234) is n
+        assert n.address == '10.0.0.2' and n.port == 1234
+
+def test_routing_table_matches_zone():
+    own_node = Node('127.0.0.1', 7001, generate_random())
+    zone = RoutingZone(own_node.node_id, bdepth=3, binsize=4)
+    table = RoutingTable(own_node.node_id, bdepth=3, binsize=4)
+    zone.add(own_node)
+    table.add(own_node)
+    nodes = [ Node('127.0.0.1', x, generate_random()) for x in range(500) ]
+    for x in nodes:
+        zone.add(x)
+        table.add(x)
+    assert zone.max_depth() == table.max_depth()
+    assert set(zone.get_all_nodes()) == set(table.get_all_nodes())
+    for x in zone.get_all_nodes():
+        assert table.get_node_by_id(x.node_id) is x
+        assert table.get_node_by_addr(x.address, x.port) is x
+    for _ in range(20):
+        target = generate_random()
+        assert zone.closest_to(target) == table.closest_to(target)
+    for x in nodes[:450]:
+        zone.remove(x)
+        table.remove(x)
+    assert zone.max_depth() == table.max_depth()
+    assert set(zone.get_all_nodes()) == set(table.get_all_nodes())
@@ -0,0 +1,441 @@
+# Peerz - P2P python library using ZeroMQ sockets and gevent
+# Copyright (C) 2014-2015 Steve Henderson
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import socket
+
+import pytest
+
+from peerz.routing import Node
+from peerz.transport import DefragMap, Packet, PacketWriter, Payload
+from peerz.transport import AdmissionControl, RetransmitCache, SendScheduler
+from peerz.transport import pack_nack, pack_nodes, unpack_nack, unpack_nodes
+from peerz import transport
+
+def fragments(content, txid='tx01', fragsize=None, version=0):
+    p = Payload()
+    p.pack(txid, 0x03, content, fragsize, version)
+    for x in p.fragments:
+        y = Payload()
+        y.unpack(x, version)
+        yield y
+
+def test_pack_nodes():
+    nodes = [Node('10.1.2.3', 7111, 'a' * 32),
+             Node('fe80::1', 65535, 'b' * 32),
+             Node('seed.example', 7112, 'c' * 32),
+             Node('127.0.0.1', 1, 'd' * 32)]
+    packed = pack_nodes(nodes)
+    assert len(packed) == 39 + 51 + 36 + len('seed.example') + 39
+    assert unpack_nodes(packed) == [('10.1.2.3', 7111, 'a' * 32),
+                                    ('fe80::1', 65535, 'b' * 32),
+                                    ('seed.example', 7112, 'c' * 32),
+                                    ('127.0.0.1', 1, 'd' * 32)]
+    # a full response fits in one fragment
+    assert len(pack_nodes([nodes[1]] * 20)) <= Payload.MAX_FRAGMENT
+    # truncated or corrupt entries end decoding
+    assert unpack_nodes(packed[:-1]) == unpack_nodes(packed)[:3]
+    assert unpack_nodes(packed[:39] + 'x' * 40) == unpack_nodes(packed)[:1]
+    assert unpack_nodes('') == []
+
+def test_pack_nodes_text():
+    nodes = [Node('10.1.2.3', 7111, '\x04' * 32),
+             Node('seed.example', 7112, 'c' * 32)]
+    # peers without the feature get the older text format
+    packed = pack_nodes(nodes, support=0)
+    assert packed == '\x04' * 32 + '10.1.2.3\x007111\x00' + \
+        'c' * 32 + 'seed.example\x007112\x00'
+    assert unpack_nodes(packed) == [('10.1.2.3', 7111, '\x04' * 32),
+                                    ('seed.example', 7112, 'c' * 32)]
+    assert unpack_nodes(packed[:-1]) == unpack_nodes(packed)[:1]
+
+def test_pack_nack():
+    assert unpack_nack(pack_nack([3])) == [3]
+    missing = [70000 % 65536, 1, 9, 8, 300]
+    assert unpack_nack(pack_nack(missing)) == sorted(missing)
+    assert len(pack_nack(range(100, 164))) == 2 + 8
+    # numbers past the size limit are left out
+    assert unpack_nack(pack_nack([0, 7, 8, 100], size=3)) == [0, 7]
+    assert pack_nack([]) == '' and unpack_nack('') == []
+
+class TestCompression(object):
+
+    def test_round_trip(self):
+        text = 'the quick brown fox jumps over the lazy dog ' * 2000
+        for bits in set([ x[0] for x in transport.CODECS.values() ]):
+            msgtype, data = transport.compress(0x09, text, bits)
+            assert msgtype == 0x09 | transport.COMPRESSED
+            assert len(data) < len(text) / 10
+            assert transport.decompress(msgtype, data) == (0x09, text)
+        # zlib alone
+        msgtype, data = transport.compress(0x09, text, 0x10)
+        assert ord(data[0]) == transport.CODEC_ZLIB
+
+    def test_skipped(self):
+        text = 'abc' * 1000
+        # receiver without codecs, small and incompressible content
+        assert transport.compress(0x09, text, 0) == (0x09, text)
+        assert transport.compress(0x09, 'abc', 0xF0) == (0x09, 'abc')
+        noise = os.urandom(20000)
+        assert transport.compress(0x09, noise, 0xF0) == (0x09, noise)
+        assert transport.decompress(0x09, text) == (0x09, text)
+
+    def test_limits(self):
+        text = 'a' * 100000
+        for bits in set([ x[0] for x in transport.CODECS.values() ]):
+            msgtype, data = transport.compress(0x09, text, bits)
+            with pytest.raises(transport.CodecError):
+                transport.decompress(msgtype, data, limit=1000)
+        with pytest.raises(transport.CodecError):
+            transport.decompress(0x89, '\x7fjunk')
+        with pytest.raises(transport.CodecError):
+            transport.decompress(0x89, '\x01junk')
+
+class TestPayload(object):
+
+    def test_fragment_count(self):
+        for size, count in ((0, 1), (1, 1), (1100, 1), (1101, 2), (2200, 2), (2201, 3)):
+            frags = list(fragments('x' * size))
+            assert len(frags) == count
+            assert all(x.lastfrag == count - 1 for x in frags)
+            assert ''.join(x.content for x in frags) == 'x' * size
+
+    def test_version1(self):
+        content = 'x' * 300000
+        # legacy headers number at most 256 fragments
+        with pytest.raises(transport.InvalidPacket):
+            list(fragments(content))
+        frags = list(fragments(content, version=transport.PAYLOAD_V1))
+        assert len(frags) == 273
+        assert frags[-1].lastfrag == 272 and frags[0].fragsize == 1100
+        frags = list(fragments(content, fragsize=8000,
+                               version=transport.PAYLOAD_V1))
+        assert len(frags) == 38 and frags[0].fragsize == 8000
+        assert ''.join(x.content for x in frags) == content
+        # sizes beyond the largest supported are capped
+        frags = list(fragments(content, fragsize=65000,
+                               version=transport.PAYLOAD_V1))
+        assert frags[0].fragsize == transport.MAX_FRAGMENT_V1
+
+class TestPacketWriter(object):
+
+    def test_send(self):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        content = ''.join(chr(x % 251) for x in range(5000))
+        for encrypt in (None, lambda xs: [ x[::-1] for x in xs ]):
+            writer = PacketWriter(sock)
+            assert writer.send(sink.getsockname(), 'n' * 32, 0x01, 'tx01',
+                               0x09, content, encrypt) == 5
+            d = DefragMap()
+            for _ in range(5):
+                p = Packet()
+                p.unpack(sink.recv(2048))
+                assert p.node_id == 'n' * 32 and p.mode == 0x01
+                data = Payload()
+                data.unpack(p.payload[::-1] if encrypt else p.payload)
+                assert data.txid == 'tx01' and data.msgtype == 0x09
+                msg = d.get_msg(data.txid, data.fragment, data.lastfrag,
+                                data.content, p.node_id)
+            assert msg == content
+        sink.close()
+        sock.close()
+
+    def test_send_version1(self):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        content = ''.join(chr(x % 251) for x in range(20000))
+        writer = PacketWriter(sock)
+        assert writer.send(sink.getsockname(), 'n' * 32, 0xC1, 'tx01', 0x09,
+                           content, fragsize=4000,
+                           version=transport.PAYLOAD_V1) == 5
+        d = DefragMap()
+        for _ in range(5):
+            p = Packet()
+            p.unpack(sink.recv(9216))
+            data = Payload()
+            data.unpack(p.payload, transport.PAYLOAD_V1)
+            assert data.fragsize == 4000
+            msg = d.get_msg(data.txid, data.fragment, data.lastfrag,
+                            data.content, p.node_id, fragsize=data.fragsize)
+        assert msg == content
+        sink.close()
+        sock.close()
+
+    def test_send_fragments(self):
+        sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sink.bind(('127.0.0.1', 0))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        writer = PacketWriter(sock)
+        content = 'x' * 1100 + 'y' * 1100 + 'z' * 50
+        # unknown fragment numbers are ignored
+        assert writer.send(sink.getsockname(), 'n' * 32, 0xC1, 'tx01', 0x09,
+                           content, version=transport.PAYLOAD_V1,
+                           fragments=[2, 0, 2, 7]) == 2
+        for expected in ('x' * 1100, 'z' * 50):
+            p = Packet()
+            p.unpack(sink.recv(9216))
+            data = Payload()
+            data.unpack(p.payload, transport.PAYLOAD_V1)
+            assert data.content == expected and data.lastfrag == 2
+        sink.close()
+        sock.close()
+
+class TestRetransmitCache(object):
+
+    def test_get(self):
+        c = RetransmitCache(timeout=10)
+        c.add('peer1', 'tx01', 0x09, 'abc', 1100, now=100)
+        assert c.get('peer1', 'tx01', now=105) == (0x09, 'abc', 1100)
+        assert c.get('peer2', 'tx01', now=105) is None
+        assert c.get('peer1', 'tx01', now=111) is None
+        assert c.stats() == {'messages': 0, 'bytes': 0, 'hits': 1, 'misses': 2}
+
+    def test_limits(self):
+        c = RetransmitCache(max_bytes=25)
+        for x in range(3):
+            c.add('peer', 'tx0%i' % x, 0x09, 'x' * 10, 1100)
+        # oldest makes way
+        assert c.bytes == 20 and c.get('peer', 'tx00') is None
+        assert c.get('peer', 'tx02')
+        c.add('peer', 'tx03', 0x09, 'x' * 26, 1100)
+        assert c.get('peer', 'tx03') is None and c.bytes == 20
+
+class TestAdmissionControl(object):
+
+    def test_per_peer(self):
+        a = AdmissionControl(rate=10, burst=3)
+        assert [ a.admit('peer1', now=100) for _ in range(4) ] == \
+            [True, True, True, False]
+        # others are unaffected
+        assert a.admit('peer2', now=100)
+        # over the limit, further packets are dropped undecrypted
+        assert a.blocked('peer1', now=100.05)
+        assert not a.blocked('peer2', now=100.05)
+        assert not a.blocked('peer1', now=100.15)
+        assert a.admit('peer1', now=100.15)
+        assert not a.admit('peer1', now=100.15)
+        assert a.stats() == {'peers': 2, 'blocked': 1, 'admitted': 5,
+                             'dropped': 2, 'dropped_global': 0,
+                             'dropped_early': 1}
+        # refilled buckets are forgotten
+        a.expire(now=101)
+        assert a.stats()['peers'] == 0 and not a.blocking
+
+    def test_global(self):
+        a = AdmissionControl(rate=10, burst=3, global_rate=1, global_burst=4,
+                             maxpeers=2)
+        assert [ a.admit('peer%i' % x, now=100) for x in range(5) ] == \
+            [True] * 4 + [False]
+        # a peer is not blocked for the global limit
+        assert a.dropped_global == 1 and not a.blocked('peer4', now=100)
+        assert list(a.buckets) == ['peer3', 'peer4']
+        assert a.admit('peer4', now=101)
+
+class RecordingWriter(object):
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, address, node_id, mode, txid, msgtype, content=b'',
+             encrypt=None, fragsize=None, version=0, fragments=None):
+        self.sent += [ (txid, x) for x in fragments ]
+
+class FailingWriter(RecordingWriter):
+
+    def send(self, address, node_id, mode, txid, msgtype, content=b'',
+             encrypt=None, fragsize=None, version=0, fragments=None):
+        if txid == 'bad!':
+            raise socket.error(90, 'Message too long')
+        RecordingWriter.send(self, address, node_id, mode, txid, msgtype,
+                             content, encrypt, fragsize, version, fragments)
+
+class TestSendScheduler(object):
+
+    def test_send_error(self):
+        writer = FailingWriter()
+        s = SendScheduler(writer)
+        node = Node('127.0.0.1', 7111, 'a' * 32)
+        s.send(node, 'n' * 32, 0xC1, 'bad!', 0x01, 'x' * 100,
+               version=transport.PAYLOAD_V1, now=100)
+        s.send(node, 'n' * 32, 0xC1, 'tx01', 0x01, 'x' * 100,
+               version=transport.PAYLOAD_V1, now=100)
+        # the failed message is dropped rather than blocking the queue
+        assert writer.sent == [('tx01', 0)]
+        assert s.stats() == {'peers': 1, 'queued': 0, 'failed': 1}
+
+    def test_pacing(self):
+        writer = RecordingWriter()
+        s = SendScheduler(writer, cwnd=10, burst=4)
+        node = Node('127.0.0.1', 7111, 'a' * 32)
+        node.srtt = 100.0
+        # a burst goes straight out, the rest at cwnd per round trip
+        assert s.send(node, 'n' * 32, 0xC1, 'tx01', 0x09, 'x' * 11000,
+                      version=transport.PAYLOAD_V1, now=100) == 10
+        assert writer.sent == [ ('tx01', x) for x in range(4) ]
+        assert s.stats() == {'peers': 1, 'queued': 6, 'failed': 0}
+        assert abs(s.next_send() - 100.01) < 1e-9
+        s.flush(now=100.025)
+        assert len(writer.sent) == 6
+        s.flush(now=100.2)
+        assert len(writer.sent) == 10 and s.next_send() is None
+        # other peers are not held up
+        s.send(Node('127.0.0.1', 7112, 'b' * 32), 'n' * 32, 0xC1, 'tx02',
+               0x09, 'x' * 2200, version=transport.PAYLOAD_V1, now=100.2)
+        assert writer.sent[-2:] == [('tx02', 0), ('tx02', 1)]
+
+    def test_window(self):
+        s = SendScheduler(RecordingWriter(), cwnd=10)
+        node = Node('127.0.0.1', 7111, 'a' * 32)
+        s.send(node, 'n' * 32, 0xC1, 'tx01', 0x09, 'x' * 1100, now=100)
+        # doubles per round trip until the first loss
+        s.ack(node.node_id, 10)
+        assert s.peers[node.node_id].cwnd == 20
+        s.loss(node.node_id, now=101)
+        s.loss(node.node_id, now=101.01)
+        assert s.peers[node.node_id].cwnd == 10
+        # then grows by one fragment per window
+        s.ack(node.node_id, 10)
+        assert s.peers[node.node_id].cwnd == 11
+        s.loss(node.node_id, now=102)
+        for _ in range(3):
+            s.loss(node.node_id, now=103 + _)
+        assert s.peers[node.node_id].cwnd == transport.PACE_CWND_MIN
+        s.expire(now=100 + s.idle + 1)
+        assert not s.peers
+
+    def test_pending(self):
+        s = SendScheduler(RecordingWriter(), cwnd=10, burst=2)
+        node = Node('127.0.0.1', 7111, 'a' * 32)
+        s.send(node, 'n' * 32, 0xC1, 'tx01', 0x09, 'x' * 4400,
+               version=transport.PAYLOAD_V1, now=100)
+        assert s.pending(node.node_id, 'tx01') == set([2, 3])
+        assert s.pending(node.node_id, 'tx02') == set()
+
+class TestDefragMap(object):
+
+    def test_reassembly(self):
+        d = DefragMap()
+        content = ''.join(chr(x % 256) for x in range(3000))
+        frags = list(fragments(content))
+        # arrival order and duplicates do not matter
+        frags = [frags[2], frags[0], frags[0], frags[1]]
+        results = [ d.get_msg(x.txid, x.fragment, x.lastfrag, x.content, 'peer')
+                    for x in frags ]
+        assert results[:3] == [None, None, None]
+        assert results[3] == content
+        assert not d.map and d.bytes == 0 and not d.per_peer
+        assert not d.peer_bytes
+        # unfragmented messages pass straight through
+        x = next(fragments('small'))
+        assert d.get_msg(x.txid, x.fragment, x.lastfrag, x.content) == 'small'
+
+    def test_same_txid_different_peers(self):
+        d = DefragMap()
+        a = list(fragments('a' * 2000))
+        b = list(fragments('b' * 2000))
+        assert d.get_msg('tx01', 0, 1, a[0].content, 'peer1') is None
+        assert d.get_msg('tx01', 0, 1, b[0].content, 'peer2') is None
+        assert d.get_msg('tx01', 1, 1, b[1].content, 'peer2') == 'b' * 2000
+        assert d.get_msg('tx01', 1, 1, a[1].content, 'peer1') == 'a' * 2000
+
+    def test_expiry(self):
+        d = DefragMap(timeout=10)
+        assert d.get_msg('tx01', 0, 1, 'x' * 1100, 'peer', now=100) is None
+        assert d.get_msg('tx02', 0, 1, 'x' * 1100, 'peer', now=105) is None
+        d.expire(now=111)
+        assert d.expired == 1 and len(d.map) == 1
+        # late fragment starts over rather than completing
+        assert d.get_msg('tx01', 1, 1, 'y', 'peer', now=112) is None
+        assert d.stats()['partial'] == 2
+
+    def test_limits(self):
+        d = DefragMap(max_bytes=4 * 1100, max_per_peer=2,
+                      max_peer_bytes=3 * 1100)
+        for x in range(3):
+            d.get_msg('tx0%i' % x, 0, 2, 'x' * 1100, 'peer1', now=100)
+        # oldest from the same peer makes way
+        assert d.evicted == 1 and len(d.map) == 2
+        assert ('peer1', 'tx00') not in d.map
+        # as do its oldest once over its share of the budget
+        d.get_msg('tx01', 1, 2, 'x' * 1100, 'peer1', now=100)
+        d.get_msg('tx02', 1, 2, 'x' * 1100, 'peer1', now=100)
+        assert d.evicted == 2 and list(d.map) == [('peer1', 'tx02')]
+        assert d.peer_bytes == {'peer1': 2 * 1100}
+        d.get_msg('tx01', 0, 1, 'x' * 1100, 'peer2', now=100)
+        d.get_msg('tx01', 0, 1, 'x' * 1100, 'peer3', now=100)
+        d.get_msg('tx02', 0, 1, 'x' * 1100, 'peer3', now=100)
+        # over budget, oldest overall makes way
+        assert d.evicted == 3 and len(d.map) == 3
+        assert ('peer1', 'tx02') not in d.map
+        assert d.bytes == 3 * 1100 and 'peer1' not in d.peer_bytes
+        # messages larger than a peer's share are refused
+        assert d.get_msg('tx09', 0, 3, 'x' * 1100, 'peer4') is None
+        assert ('peer4', 'tx09') not in d.map
+        # malformed fragments are ignored
+        assert d.get_msg('tx08', 0, 1, 'x' * 10, 'peer4') is None
+        assert d.get_msg('tx08', 2, 1, 'x' * 1100, 'peer4') is None
+        assert ('peer4', 'tx08') not in d.map
+
+    def test_declared_size(self):
+        d = DefragMap()
+        assert d.get_msg('tx01', 0, 1, 'x' * 1100, 'peer1') is None
+        # a single fragment claiming a large message holds only itself
+        assert d.get_msg('tx02', 3000, 3000, 'y', 'peer2') is None
+        assert d.bytes == 1101 and d.evicted == 0
+        assert d.get_msg('tx01', 1, 1, 'z', 'peer1') == 'x' * 1100 + 'z'
+        assert d.peer_bytes == {'peer2': 1}
+
+    def test_fragsize_per_message(self):
+        d = DefragMap()
+        small = list(fragments('s' * 3000))
+        large = list(fragments('l' * 3000, txid='tx02', fragsize=2000,
+                               version=transport.PAYLOAD_V1))
+        assert d.get_msg('tx01', 0, 2, small[0].content, 'peer') is None
+        assert d.get_msg('tx02', 0, 1, large[0].content, 'peer',
+                         fragsize=2000) is None
+        # fragments must agree with the size the message started with
+        assert d.get_msg('tx02', 1, 1, large[1].content, 'peer',
+                         fragsize=1100) is None
+        assert d.get_msg('tx02', 1, 1, large[1].content, 'peer',
+                         fragsize=2000) == 'l' * 3000
+        assert d.get_msg('tx01', 1, 2, small[1].content, 'peer') is None
+        assert d.get_msg('tx01', 2, 2, small[2].content, 'peer') == 's' * 3000
+        # oversized fragments are refused
+        assert d.get_msg('tx03', 0, 1, 'x' * 10000, 'peer',
+                         fragsize=10000) is None
+
+    def test_gaps(self):
+        d = DefragMap()
+        frags = list(fragments('x' * 5000))
+        for x in frags[1:3]:
+            d.get_msg(x.txid, x.fragment, x.lastfrag, x.content, 'peer',
+                      now=100, address=('10.0.0.1', 7111))
+        assert d.gaps(now=100.1, idle=0.25) == []
+        # missing fragments either side of those received are requested
+        assert d.gaps(now=100.3, idle=0.25) == [('peer', ('10.0.0.1', 7111),
+                                                 'tx01', [0, 3, 4], 0)]
+        # at most once per idle period and a limited number of times
+        assert d.gaps(now=100.4, idle=0.25) == []
+        assert len(d.gaps(now=101, idle=0.25, retries=2)) == 1
+        assert d.gaps(now=102, idle=0.25, retries=2) == []
+        assert d.stats()['nacked'] == 2
+        for x in (frags[0], frags[3], frags[4]):
+            msg = d.get_msg(x.txid, x.fragment, x.lastfrag, x.content, 'peer',
+                            now=103)
+        assert msg == 'x' * 5000